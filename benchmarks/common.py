@@ -0,0 +1,76 @@
+"""
+Helpers shared by the benchmarks
+"""
+
+import sys
+import json
+import time
+import asyncio
+import resource
+import subprocess
+
+from mugen.bench import percentile
+
+
+def peak_rss_kb():
+    rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    # bytes on macOS, kilobytes on Linux
+    return rss // 1024 if sys.platform == "darwin" else rss
+
+
+async def drive(make_request, requests, concurrency):
+    """
+    Call `make_request()` `requests` times with `concurrency` workers
+
+    Return (latencies, errors, elapsed). `errors` maps an error type to its
+    count.
+    """
+
+    latencies = []
+    errors = {}
+    remaining = iter(range(requests))
+
+    async def worker():
+        for _ in remaining:
+            start = time.perf_counter()
+            try:
+                await make_request()
+            except Exception as err:
+                name = type(err).__name__
+                errors[name] = errors.get(name, 0) + 1
+                continue
+            latencies.append(time.perf_counter() - start)
+
+    start = time.perf_counter()
+    await asyncio.gather(*[worker() for _ in range(concurrency)])
+    elapsed = time.perf_counter() - start
+    return latencies, errors, elapsed
+
+
+def summarize(latencies, errors, elapsed):
+    latencies = sorted(latencies)
+    return {
+        "requests": len(latencies),
+        "errors": errors,
+        "seconds": round(elapsed, 4),
+        "rps": round(len(latencies) / elapsed, 1) if elapsed else None,
+        "p50_ms": round(percentile(latencies, 50) * 1000, 3) if latencies else None,
+        "p99_ms": round(percentile(latencies, 99) * 1000, 3) if latencies else None,
+        "peak_rss_kb": peak_rss_kb(),
+    }
+
+
+def run_worker(module, args):
+    """
+    Run `python -m module args...` and return the JSON it prints
+
+    Every measurement runs in a fresh process: the event loop policy, the
+    connection pool and the dns cache are process wide.
+    """
+
+    output = subprocess.run(
+        [sys.executable, "-m", module] + [str(arg) for arg in args],
+        check=True,
+        stdout=subprocess.PIPE,
+    ).stdout
+    return json.loads(output)
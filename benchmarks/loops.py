@@ -0,0 +1,81 @@
+"""
+Compare mugen on the asyncio and the uvloop event loops
+
+    python -m benchmarks.loops [--requests N] [--concurrency C]
+
+Small keep-alive GETs against a local server, req/s and p99 latency are
+reported for each loop.
+"""
+
+import json
+import asyncio
+import argparse
+
+import mugen
+
+from benchmarks.common import drive, summarize, run_worker
+from tests.servers import StandInHTTPServer, StandInResponse
+
+LOOPS = ("asyncio", "uvloop")
+
+
+def measure(loop_name, requests, concurrency):
+    if loop_name == "uvloop" and not mugen.install_fast_loop():
+        return None
+
+    loop = asyncio.new_event_loop()
+    asyncio.set_event_loop(loop)
+
+    async def run():
+        server = await StandInHTTPServer(
+            {"/": lambda req: StandInResponse(body=b"x" * 128)}
+        ).start()
+        session = mugen.session()
+        url = server.url("/")
+
+        # warm up the connection pool
+        await drive(lambda: session.get(url), concurrency, concurrency)
+        result = summarize(
+            *await drive(lambda: session.get(url), requests, concurrency)
+        )
+        await server.close()
+        return result
+
+    return loop.run_until_complete(run())
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument("--requests", type=int, default=5000)
+    parser.add_argument("--concurrency", type=int, default=50)
+    parser.add_argument("--worker", choices=LOOPS, help=argparse.SUPPRESS)
+    args = parser.parse_args()
+
+    if args.worker:
+        print(json.dumps(measure(args.worker, args.requests, args.concurrency)))
+        return
+
+    results = {}
+    for loop_name in LOOPS:
+        results[loop_name] = run_worker(
+            "benchmarks.loops",
+            [
+                "--worker",
+                loop_name,
+                "--requests",
+                args.requests,
+                "--concurrency",
+                args.concurrency,
+            ],
+        )
+
+    print("{:<10}{:>12}{:>12}".format("loop", "req/s", "p99 ms"))
+    for loop_name, result in results.items():
+        if result is None:
+            print("{:<10}{:>24}".format(loop_name, "not installed"))
+            continue
+        print("{:<10}{:>12}{:>12}".format(loop_name, result["rps"], result["p99_ms"]))
+
+
+if __name__ == "__main__":
+    main()
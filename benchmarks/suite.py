@@ -0,0 +1,230 @@
+"""
+Benchmark suite of mugen against local stand-in servers
+
+    python -m benchmarks.suite [--requests N] [--concurrency C]
+                               [--scenario NAME ...] [--output FILE]
+                               [--compare FILE] [--tolerance RATIO]
+
+Throughput, p50/p99 latency and memory are measured for every scenario,
+each in its own process. Results are written as JSON to `--output`. With
+`--compare`, the run fails when req/s drops, or p99 latency or memory
+grows, by more than `--tolerance` against a previous result file.
+"""
+
+import os
+import sys
+import gzip
+import json
+import time
+import asyncio
+import argparse
+import platform
+import tempfile
+import tracemalloc
+
+import mugen
+from mugen.connect import default_ssl_context
+
+from benchmarks.common import drive, summarize, run_worker
+from tests.servers import (
+    StandInHTTPServer,
+    StandInHTTPProxy,
+    StandInSocksServer,
+    StandInResponse,
+    make_self_signed_cert,
+    server_ssl_context,
+)
+
+SMALL_BODY = b"x" * 128
+LARGE_BODY = os.urandom(1024 * 1024)
+CHUNKED_BODY = [os.urandom(16 * 1024) for _ in range(64)]
+GZIP_BODY = gzip.compress(b'{"key": "value", "list": [1, 2, 3]}\n' * 8192)
+
+ROUTES = {
+    "/small": lambda req: StandInResponse(body=SMALL_BODY),
+    "/large": lambda req: StandInResponse(body=LARGE_BODY),
+    "/chunked": lambda req: StandInResponse(body=CHUNKED_BODY),
+    "/gzip": lambda req: StandInResponse(
+        headers=[("Content-Encoding", "gzip")], body=GZIP_BODY
+    ),
+    "/redirect": lambda req: StandInResponse(
+        302, headers=[("Location", "/small")], reason="Found"
+    ),
+}
+
+# name: (server, path, proxy)
+SCENARIOS = {
+    "small_get": ("http", "/small", None),
+    "large_body": ("http", "/large", None),
+    "chunked_body": ("http", "/chunked", None),
+    "gzip_body": ("http", "/gzip", None),
+    "redirect": ("http", "/redirect", None),
+    "https_get": ("https", "/small", None),
+    "http_proxy_get": ("http", "/small", "http"),
+    "https_proxy_get": ("https", "/small", "http"),
+    "socks5_proxy_get": ("http", "/small", "socks5"),
+}
+
+# The share of the requests measured again under tracemalloc
+MEMORY_SAMPLE = 0.1
+
+# metric: True if higher is better
+METRICS = {"rps": True, "p99_ms": False, "alloc_peak_kb": False}
+
+
+async def start_servers(scenario, certdir):
+    server_kind, _, proxy_kind = SCENARIOS[scenario]
+
+    ssl = None
+    if server_kind == "https":
+        cert = make_self_signed_cert(certdir)
+        if cert is None:
+            return None
+        default_ssl_context().load_verify_locations(cert[0])
+        ssl = server_ssl_context(*cert)
+
+    servers = [await StandInHTTPServer(ROUTES, ssl=ssl).start()]
+    if proxy_kind == "http":
+        servers.append(await StandInHTTPProxy().start())
+    elif proxy_kind == "socks5":
+        servers.append(await StandInSocksServer().start())
+    return servers
+
+
+def measure(scenario, requests, concurrency):
+    loop = asyncio.new_event_loop()
+    asyncio.set_event_loop(loop)
+    _, path, proxy_kind = SCENARIOS[scenario]
+
+    async def run(certdir):
+        servers = await start_servers(scenario, certdir)
+        if servers is None:
+            return None
+
+        session = mugen.session()
+        url = servers[0].url(path)
+        proxy = servers[1].url() if proxy_kind else None
+
+        async def make_request():
+            resp = await session.get(url, proxy=proxy)
+            assert resp.status_code == 200, resp.status_code
+            assert resp.content
+
+        # warm up the connection pool
+        await drive(make_request, concurrency, concurrency)
+        result = summarize(*await drive(make_request, requests, concurrency))
+
+        tracemalloc.start()
+        await drive(make_request, max(1, int(requests * MEMORY_SAMPLE)), concurrency)
+        _, peak = tracemalloc.get_traced_memory()
+        tracemalloc.stop()
+        result["alloc_peak_kb"] = peak // 1024
+
+        for server in servers:
+            await server.close()
+        return result
+
+    with tempfile.TemporaryDirectory() as certdir:
+        return loop.run_until_complete(run(certdir))
+
+
+def compare(results, baseline, tolerance):
+    """
+    Return the regressions of `results` against `baseline`
+    """
+
+    regressions = []
+    for scenario, result in results.items():
+        old = baseline.get("results", {}).get(scenario)
+        if not result or not old:
+            continue
+        for metric, higher_is_better in METRICS.items():
+            new_value, old_value = result.get(metric), old.get(metric)
+            if not new_value or not old_value:
+                continue
+            change = (new_value - old_value) / old_value
+            if (change < -tolerance) if higher_is_better else (change > tolerance):
+                regressions.append(
+                    "{}.{}: {} -> {} ({:+.1%})".format(
+                        scenario, metric, old_value, new_value, change
+                    )
+                )
+    return regressions
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument("--requests", type=int, default=2000)
+    parser.add_argument("--concurrency", type=int, default=20)
+    parser.add_argument(
+        "--scenario", action="append", choices=list(SCENARIOS), dest="scenarios"
+    )
+    parser.add_argument("--output", default="benchmark-results.json")
+    parser.add_argument("--compare")
+    parser.add_argument("--tolerance", type=float, default=0.2)
+    parser.add_argument("--worker", choices=list(SCENARIOS), help=argparse.SUPPRESS)
+    args = parser.parse_args()
+
+    if args.worker:
+        print(json.dumps(measure(args.worker, args.requests, args.concurrency)))
+        return
+
+    results = {}
+    for scenario in args.scenarios or SCENARIOS:
+        results[scenario] = run_worker(
+            "benchmarks.suite",
+            [
+                "--worker",
+                scenario,
+                "--requests",
+                args.requests,
+                "--concurrency",
+                args.concurrency,
+            ],
+        )
+
+    report = {
+        "meta": {
+            "time": time.strftime("%Y-%m-%dT%H:%M:%S%z"),
+            "mugen": mugen.__version__,
+            "python": platform.python_version(),
+            "platform": platform.platform(),
+            "requests": args.requests,
+            "concurrency": args.concurrency,
+        },
+        "results": results,
+    }
+    with open(args.output, "w") as fd:
+        json.dump(report, fd, indent=2)
+
+    row = "{:<18}{:>10}{:>10}{:>10}{:>14}{:>12}"
+    print(
+        row.format("scenario", "req/s", "p50 ms", "p99 ms", "alloc peak KB", "errors")
+    )
+    for scenario, result in results.items():
+        if result is None:
+            print("{:<18}{:>10}".format(scenario, "skipped"))
+            continue
+        print(
+            row.format(
+                scenario,
+                result["rps"],
+                result["p50_ms"],
+                result["p99_ms"],
+                result["alloc_peak_kb"],
+                sum(result["errors"].values()),
+            )
+        )
+
+    if args.compare:
+        with open(args.compare) as fd:
+            regressions = compare(results, json.load(fd), args.tolerance)
+        if regressions:
+            print("\nRegressions:")
+            for regression in regressions:
+                print("  " + regression)
+            sys.exit(1)
+
+
+if __name__ == "__main__":
+    main()
@@ -5,5 +5,11 @@ from mugen.api import (
     request,
     session,
 )
+from mugen.utils import install_fast_loop
+from mugen.parallel import run_parallel
+from mugen.sync import SyncSession
+from mugen.timeouts import Timeout
+from mugen.models import Limits
+from mugen.multipart import MultipartEncoder
 
 __version__ = "0.6.1"
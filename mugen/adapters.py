@@ -1,10 +1,17 @@
+import time
 import logging
 import asyncio
 
-from mugen.utils import is_ip, parse_proxy
+from mugen.utils import is_ip, parse_proxy, parse_keep_alive
 from mugen.exceptions import UnknownProxyScheme
-from mugen.proxy import _make_https_proxy_connection, Socks5Proxy
+from mugen.proxy import (
+    _make_https_proxy_connection,
+    Socks5Proxy,
+    Socks4Proxy,
+    GeneralProxyError,
+)
 from mugen.models import Singleton, Response, DEFAULT_ENCODING
+from mugen.structures import Timings
 
 logger = logging.getLogger(__name__)
 
@@ -20,32 +27,71 @@ class HTTPAdapter(Singleton):
         self.recycle = recycle
         self.loop = loop or asyncio.get_event_loop()
         self.connection_pool = connection_pool
+        # (ip, port) of the SOCKS5 proxies which failed a pipelined handshake,
+        # they are negotiated with one message per round trip
+        self.lockstep_proxies = set()
+
+    async def generate_direct_connect(
+        self, host, port, ssl, dns_cache, recycle=True, timings=None, adaptive=None
+    ):
+        timings = timings or Timings()
+        start = time.monotonic()
+        key = await self.direct_key(host, port, ssl, dns_cache)
+        timings.dns = time.monotonic() - start
+        conn = await self.get_connection(
+            key, recycle=recycle, timings=timings, adaptive=adaptive
+        )
+        return conn
+
+    async def direct_key(self, host, port, ssl, dns_cache):
+        """
+        The pool key of direct connections to host:port
+        """
 
-    async def generate_direct_connect(self, host, port, ssl, dns_cache, recycle=True):
-        key = None
         if is_ip(host):
             ip = host.split(":")[0]
-            key = (ip, port, ssl)
-
-        if not key and not ssl:
-            ip, port = await dns_cache.get(host, port)
-            key = (ip, port, ssl)
+            return (ip, port, ssl)
 
-        if not key and ssl:
-            key = (host, port, ssl)
+        ip, port = await dns_cache.get(host, port)
+        if ssl:
+            # Connected by ip, TLS is handshaked with the host name
+            return (ip, port, ssl, host)
+        return (ip, port, ssl)
 
-        conn = await self.get_connection(key, recycle=recycle)
+    async def generate_unix_connect(
+        self, path, host, ssl, recycle=True, timings=None, adaptive=None
+    ):
+        # Pooled as the tcp connections, with no port. TLS needs the host name.
+        key = (path, None, ssl, host) if ssl else (path, None, ssl)
+        conn = await self.get_connection(
+            key, recycle=recycle, timings=timings, adaptive=adaptive
+        )
         return conn
 
     async def generate_proxy_connect(
-        self, host, port, ssl, proxy, proxy_auth, dns_cache, recycle=True
+        self,
+        host,
+        port,
+        ssl,
+        proxy,
+        proxy_auth,
+        dns_cache,
+        recycle=True,
+        timings=None,
+        adaptive=None,
     ):
+        timings = timings or Timings()
         proxy_scheme, proxy_host, proxy_port, username, password = parse_proxy(proxy)
         if not proxy_auth and username and password:
             proxy_auth = f"{username}:{password}"
 
+        start = time.monotonic()
         proxy_ip, proxy_port = await dns_cache.get(proxy_host, proxy_port)
-        key = (proxy_ip, proxy_port, False, host)
+        timings.dns = time.monotonic() - start
+        # A tunnel is bound to its destination and to the proxy user, so it is
+        # pooled per (proxy, target host, proxy user)
+        proxy_user = proxy_auth.split(":", 1)[0] if proxy_auth else None
+        key = (proxy_ip, proxy_port, False, host, port, proxy_user)
 
         if proxy_scheme.lower() == "http":
             if not ssl:
@@ -55,11 +101,47 @@ class HTTPAdapter(Singleton):
                     False,
                 )  # http proxy not needs CONNECT request
             conn = await self.generate_http_proxy_connect(
-                key, host, port, ssl, proxy_auth, recycle=recycle
+                key,
+                host,
+                port,
+                ssl,
+                proxy_auth,
+                recycle=recycle,
+                timings=timings,
+                adaptive=adaptive,
+            )
+        elif proxy_scheme.lower() in ("socks5", "socks5h"):
+            conn = await self.generate_socks_proxy_connect(
+                Socks5Proxy,
+                key,
+                host,
+                port,
+                ssl,
+                username,
+                password,
+                recycle=recycle,
+                timings=timings,
+                adaptive=adaptive,
             )
-        elif proxy_scheme.lower() == "socks5":
-            conn = await self.generate_socks5_proxy_connect(
-                key, host, port, ssl, username, password, recycle=recycle
+        elif proxy_scheme.lower() in ("socks4", "socks4a"):
+            dest_host = host
+            if proxy_scheme.lower() == "socks4":
+                # SOCKS4 can not resolve domain names, so we do it locally
+                start = time.monotonic()
+                dest_host, _ = await dns_cache.get(host, port)
+                timings.dns += time.monotonic() - start
+            conn = await self.generate_socks_proxy_connect(
+                Socks4Proxy,
+                key,
+                dest_host,
+                port,
+                ssl,
+                username,
+                password,
+                server_hostname=host,
+                recycle=recycle,
+                timings=timings,
+                adaptive=adaptive,
             )
         else:
             raise UnknownProxyScheme(proxy_scheme)
@@ -67,41 +149,134 @@ class HTTPAdapter(Singleton):
         return conn
 
     async def generate_http_proxy_connect(
-        self, key, host, port, ssl, proxy_auth, recycle=True
+        self,
+        key,
+        host,
+        port,
+        ssl,
+        proxy_auth,
+        recycle=True,
+        timings=None,
+        adaptive=None,
     ):
-        conn = await self.get_connection(key, recycle=recycle)
+        timings = timings or Timings()
+        conn = await self.get_connection(
+            key, recycle=recycle, timings=timings, adaptive=adaptive
+        )
 
         if ssl and not conn.ssl_on:
             logger.debug("[ssl_handshake]: {}".format(key))
-            await _make_https_proxy_connection(
-                conn, host, port, proxy_auth, recycle=recycle
-            )
+            start = time.monotonic()
+            try:
+                await _make_https_proxy_connection(conn, host, port, proxy_auth)
+            except (Exception, asyncio.CancelledError) as err:
+                logger.debug("Fail to make tunnel to %s, error: %s", key, err)
+                conn.close(error=True)
+                raise err
             conn.ssl_on = True
+            # The TLS handshake with the host is done in the tunnel
+            timings.tls = conn.tls_time
+            timings.proxy = time.monotonic() - start - conn.tls_time
         return conn
 
-    async def generate_socks5_proxy_connect(
-        self, key, host, port, ssl, username, password, recycle=True
+    async def generate_socks_proxy_connect(
+        self,
+        proxy_class,
+        key,
+        host,
+        port,
+        ssl,
+        username,
+        password,
+        server_hostname=None,
+        recycle=True,
+        timings=None,
+        adaptive=None,
     ):
-        conn = await self.get_connection(key, recycle=recycle)
+        timings = timings or Timings()
+        conn = await self.get_connection(
+            key, recycle=recycle, timings=timings, adaptive=adaptive
+        )
         if conn.socks_on:
             return conn
 
-        socks5_proxy = Socks5Proxy(conn, host, port, ssl, username, password)
-        await socks5_proxy.init()
+        proxy_address = key[:2]
+        pipeline = proxy_address not in self.lockstep_proxies
+        socks_proxy = proxy_class(
+            conn,
+            host,
+            port,
+            ssl,
+            username,
+            password,
+            pipeline=pipeline,
+            server_hostname=server_hostname,
+        )
+        start = time.monotonic()
+        try:
+            await socks_proxy.init()
+        except GeneralProxyError as err:
+            conn.close(error=True)
+            if not pipeline or proxy_class is not Socks5Proxy:
+                raise err
+
+            # The server does not take the messages of the handshake in one
+            # flight, negotiate again on a new connection, in lockstep
+            logger.debug(
+                "[HTTPAdapter.generate_socks_proxy_connect]: "
+                "{} fails a pipelined handshake, {!r}".format(key, err)
+            )
+            self.lockstep_proxies.add(proxy_address)
+            return await self.generate_socks_proxy_connect(
+                proxy_class,
+                key,
+                host,
+                port,
+                ssl,
+                username,
+                password,
+                server_hostname=server_hostname,
+                recycle=recycle,
+                timings=timings,
+                adaptive=adaptive,
+            )
+        except (Exception, asyncio.CancelledError) as err:
+            logger.debug("Fail to negotiate with socks proxy %s, error: %s", key, err)
+            conn.close(error=True)
+            raise err
+        if ssl:
+            timings.tls = conn.tls_time
+        timings.proxy = time.monotonic() - start - timings.tls
         return conn
 
-    async def get_connection(self, key, recycle=True):
-        conn = await self.connection_pool.get_connection(key, recycle=recycle)
+    async def get_connection(self, key, recycle=True, timings=None, adaptive=None):
+        start = time.monotonic()
+        conn = await self.connection_pool.get_connection(
+            key, recycle=recycle, adaptive=adaptive
+        )
+        if timings is not None:
+            timings.queue += time.monotonic() - start
         if not conn.reader:
             try:
                 await conn.connect()
             except Exception as err:
                 logger.debug("Fail connect to %s, error: %s", key, err)
-                conn.close()
+                conn.close(error=True)
                 raise err
+            if timings is not None:
+                timings.connect = conn.connect_time
+                timings.tls = conn.tls_time
         return conn
 
-    async def send_request(self, conn, request):
+    async def send_request(self, conn, request, timings=None):
+        if timings is not None:
+            timings.reuse_count = conn.requests
+            timings.reused = conn.requests > 0
+        conn.requests += 1
+        if conn.requests_left is not None:
+            conn.requests_left -= 1
+
+        await request.prepare_body()
         request_line, headers, data = request.make_request()
         request_line = request_line.encode("utf-8")
         headers = headers.encode("utf-8")
@@ -113,14 +288,53 @@ class HTTPAdapter(Singleton):
         conn.send(b"\r\n")
         if data:
             conn.send(data)
+        elif request.streaming and request.stream_length() is not None:
+            send = getattr(request.data, "send", None)
+            if send is not None:
+                # Files are sent by sendfile on plain connections
+                await send(conn, sendfile=not (conn.ssl or conn.ssl_on))
+            else:
+                async for chunk in request.iter_body():
+                    conn.send(chunk)
+                    await conn.drain()
+        elif request.streaming:
+            async for chunk in request.iter_body():
+                conn.send(b"%x\r\n" % len(chunk))
+                conn.send(chunk)
+                conn.send(b"\r\n")
+                await conn.drain()
+            conn.send(b"0\r\n\r\n")
+
+    async def get_response(
+        self,
+        method,
+        conn,
+        encoding=DEFAULT_ENCODING,
+        stream=False,
+        timings=None,
+        limits=None,
+        spool_size=None,
+    ):
+        response = Response(
+            method,
+            conn,
+            encoding=encoding,
+            timings=timings,
+            limits=limits,
+            spool_size=spool_size,
+        )
+        await response.receive(stream=stream)
 
-    async def get_response(self, method, conn, encoding=DEFAULT_ENCODING):
-        response = Response(method, conn, encoding=encoding)
-        await response.receive()
+        keep_alive = response.headers.get("Keep-Alive")
+        if keep_alive:
+            timeout, max_requests = parse_keep_alive(keep_alive)
+            conn.keep_alive(timeout, max_requests)
 
-        if response.headers.get("connection") == "close":
+        if response.headers.get("connection", "").lower() == "close":
             conn.recycle = False
-            conn.close()
+            # A streamed body is read until the connection is closed
+            if response.content is not None:
+                conn.close()
         return response
 
     def closed(self):
@@ -1,5 +1,9 @@
 from mugen.session import Session
-from mugen.models import MAX_CONNECTION_POOL, MAX_POOL_TASKS
+from mugen.models import (
+    MAX_CONNECTION_POOL,
+    MAX_POOL_TASKS,
+    DEFAULT_REDIRECT_CACHE_SIZE,
+)
 
 
 async def head(
@@ -14,6 +18,10 @@ async def head(
     encoding=None,
     timeout=None,
     connection=None,
+    stream=False,
+    unix_socket=None,
+    limits=None,
+    compress=None,
     loop=None,
 ):
     response = await request(
@@ -29,6 +37,10 @@ async def head(
         encoding=encoding,
         timeout=timeout,
         connection=connection,
+        stream=stream,
+        unix_socket=unix_socket,
+        limits=limits,
+        compress=compress,
         loop=loop,
     )
     return response
@@ -46,6 +58,10 @@ async def get(
     encoding=None,
     timeout=None,
     connection=None,
+    stream=False,
+    unix_socket=None,
+    limits=None,
+    compress=None,
     loop=None,
 ):
     response = await request(
@@ -61,6 +77,10 @@ async def get(
         encoding=encoding,
         timeout=timeout,
         connection=connection,
+        stream=stream,
+        unix_socket=unix_socket,
+        limits=limits,
+        compress=compress,
         loop=loop,
     )
     return response
@@ -79,6 +99,10 @@ async def post(
     encoding=None,
     timeout=None,
     connection=None,
+    stream=False,
+    unix_socket=None,
+    limits=None,
+    compress=None,
     loop=None,
 ):
     response = await request(
@@ -95,6 +119,10 @@ async def post(
         encoding=encoding,
         timeout=timeout,
         connection=connection,
+        stream=stream,
+        unix_socket=unix_socket,
+        limits=limits,
+        compress=compress,
         loop=loop,
     )
     return response
@@ -114,6 +142,10 @@ async def request(
     encoding=None,
     timeout=None,
     connection=None,
+    stream=False,
+    unix_socket=None,
+    limits=None,
+    compress=None,
     loop=None,
 ):
     session = Session(recycle=recycle, encoding=encoding, loop=loop)
@@ -131,6 +163,10 @@ async def request(
         encoding=encoding,
         timeout=timeout,
         connection=connection,
+        stream=stream,
+        unix_socket=unix_socket,
+        limits=limits,
+        compress=compress,
     )
 
     return response
@@ -143,6 +179,16 @@ def session(
     encoding=None,
     max_pool=MAX_CONNECTION_POOL,
     max_tasks=MAX_POOL_TASKS,
+    rate_limit=None,
+    scheduler=None,
+    timeout=None,
+    adaptive_pool=False,
+    unix_socket=None,
+    limits=None,
+    compress=None,
+    spool_size=None,
+    full_history=True,
+    redirect_cache_size=DEFAULT_REDIRECT_CACHE_SIZE,
     loop=None,
 ):
     return Session(
@@ -152,5 +198,15 @@ def session(
         encoding=encoding,
         max_pool=max_pool,
         max_tasks=max_tasks,
+        rate_limit=rate_limit,
+        scheduler=scheduler,
+        timeout=timeout,
+        adaptive_pool=adaptive_pool,
+        unix_socket=unix_socket,
+        limits=limits,
+        compress=compress,
+        spool_size=spool_size,
+        full_history=full_history,
+        redirect_cache_size=redirect_cache_size,
         loop=loop,
     )
@@ -0,0 +1,266 @@
+"""
+A load generator built on Session, in the spirit of wrk and hey
+
+    python -m mugen.bench [-c CONCURRENCY] [-d SECONDS] [-n REQUESTS]
+                          [-r RATE] [-m METHOD] [-H "Name: value" ...]
+                          [-D BODY_FILE] [--timeout SECONDS] [--json] URL
+
+`concurrency` workers send requests until `duration` seconds have passed,
+or `requests` requests are sent. With `rate`, requests are started at that
+many per second in total, and their latency is counted from when they were
+due, so a slow server is not hidden by the workers waiting for it.
+
+Reported are req/s, the latency percentiles and histogram, the status codes,
+the errors by type, and the share of requests sent on a connection reused
+from the pool.
+"""
+
+import sys
+import json
+import math
+import time
+import asyncio
+import argparse
+import itertools
+
+from mugen.session import Session
+
+DEFAULT_CONCURRENCY = 50
+DEFAULT_DURATION = 10
+PERCENTILES = (50, 75, 90, 95, 99, 99.9)
+HISTOGRAM_BUCKETS = 10
+HISTOGRAM_WIDTH = 40
+
+
+def percentile(values, q):
+    """
+    The q-th percentile of sorted values, by nearest rank
+    """
+
+    if not values:
+        return None
+    # The smallest value with at least q% of the values at or below it
+    index = max(0, math.ceil(q / 100 * len(values)) - 1)
+    return values[min(index, len(values) - 1)]
+
+
+class BenchResult(object):
+    def __init__(self):
+        # Seconds of the successful requests
+        self.latencies = []
+        self.status_codes = {}
+        self.errors = {}
+        self.reused = 0
+        self.elapsed = 0.0
+
+    def __repr__(self):
+        return "<BenchResult: requests: {}, errors: {}, elapsed: {:.2f}>".format(
+            len(self.latencies), sum(self.errors.values()), self.elapsed
+        )
+
+    @property
+    def requests(self):
+        return len(self.latencies)
+
+    @property
+    def rps(self):
+        return self.requests / self.elapsed if self.elapsed else 0.0
+
+    @property
+    def reuse_ratio(self):
+        return self.reused / self.requests if self.requests else 0.0
+
+    def add(self, response, latency):
+        self.latencies.append(latency)
+        code = response.status_code
+        self.status_codes[code] = self.status_codes.get(code, 0) + 1
+        if response.timings.reused:
+            self.reused += 1
+
+    def add_error(self, err):
+        name = type(err).__name__
+        self.errors[name] = self.errors.get(name, 0) + 1
+
+    def percentiles(self):
+        latencies = sorted(self.latencies)
+        return [(q, percentile(latencies, q)) for q in PERCENTILES]
+
+    def histogram(self, buckets=HISTOGRAM_BUCKETS):
+        """
+        Return (upper bound, count) of equal width latency buckets
+        """
+
+        if not self.latencies:
+            return []
+        low, high = min(self.latencies), max(self.latencies)
+        width = (high - low) / buckets or 1.0
+        counts = [0] * buckets
+        for latency in self.latencies:
+            counts[min(buckets - 1, int((latency - low) / width))] += 1
+        return [(low + width * (i + 1), count) for i, count in enumerate(counts)]
+
+    def as_dict(self):
+        return {
+            "requests": self.requests,
+            "seconds": round(self.elapsed, 4),
+            "rps": round(self.rps, 1),
+            "latency_ms": {
+                "p{:g}".format(q): round(value * 1000, 3)
+                for q, value in self.percentiles()
+                if value is not None
+            },
+            "status_codes": {str(code): n for code, n in self.status_codes.items()},
+            "errors": self.errors,
+            "reuse_ratio": round(self.reuse_ratio, 4),
+        }
+
+    def report(self):
+        lines = [
+            "Requests:      {}".format(self.requests),
+            "Duration:      {:.2f} s".format(self.elapsed),
+            "Requests/sec:  {:.1f}".format(self.rps),
+            "Reused conns:  {:.1%}".format(self.reuse_ratio),
+            "",
+            "Latency percentiles:",
+        ]
+        for q, value in self.percentiles():
+            if value is not None:
+                lines.append("  p{:<6g}{:>10.3f} ms".format(q, value * 1000))
+
+        histogram = self.histogram()
+        if histogram:
+            lines += ["", "Latency histogram:"]
+            top = max(count for _, count in histogram)
+            for bound, count in histogram:
+                bar = "#" * (count * HISTOGRAM_WIDTH // top)
+                lines.append(
+                    "  {:>10.3f} ms [{:>7}] {}".format(bound * 1000, count, bar)
+                )
+
+        lines += ["", "Status codes:"]
+        for code, count in sorted(self.status_codes.items()):
+            lines.append("  [{}] {}".format(code, count))
+
+        if self.errors:
+            lines += ["", "Errors:"]
+            for name, count in sorted(self.errors.items(), key=lambda e: -e[1]):
+                lines.append("  {}: {}".format(name, count))
+        return "\n".join(lines)
+
+
+async def run_bench(
+    url,
+    concurrency=DEFAULT_CONCURRENCY,
+    duration=DEFAULT_DURATION,
+    requests=None,
+    rate=None,
+    method="GET",
+    headers=None,
+    data=None,
+    timeout=None,
+    session=None,
+):
+    """
+    Load `url` and return a BenchResult
+    """
+
+    session = session or Session()
+    result = BenchResult()
+    tickets = itertools.count() if requests is None else iter(range(requests))
+
+    start = time.perf_counter()
+    stop = start + duration if duration else None
+
+    async def worker():
+        for ticket in tickets:
+            now = time.perf_counter()
+            if stop is not None and now >= stop:
+                return
+            due = now
+            if rate:
+                due = start + ticket / rate
+                if due > now:
+                    await asyncio.sleep(due - now)
+            try:
+                response = await session.request(
+                    method, url, headers=headers, data=data, timeout=timeout
+                )
+            except Exception as err:
+                result.add_error(err)
+                continue
+            result.add(response, time.perf_counter() - due)
+
+    await asyncio.gather(*[worker() for _ in range(concurrency)])
+    result.elapsed = time.perf_counter() - start
+    return result
+
+
+def parse_header(value):
+    name, sep, header = value.partition(":")
+    if not sep:
+        raise argparse.ArgumentTypeError("header must be 'Name: value'")
+    return name.strip(), header.strip()
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(
+        prog="python -m mugen.bench",
+        description=__doc__.strip().splitlines()[0],
+    )
+    parser.add_argument("url")
+    parser.add_argument("-c", "--concurrency", type=int, default=DEFAULT_CONCURRENCY)
+    parser.add_argument(
+        "-d",
+        "--duration",
+        type=float,
+        default=DEFAULT_DURATION,
+        help="seconds, 0 runs until --requests are sent",
+    )
+    parser.add_argument("-n", "--requests", type=int)
+    parser.add_argument("-r", "--rate", type=float, help="requests per second")
+    parser.add_argument("-m", "--method", default="GET")
+    parser.add_argument(
+        "-H", "--header", action="append", type=parse_header, default=[]
+    )
+    parser.add_argument("-D", "--body-file")
+    parser.add_argument("--timeout", type=float)
+    parser.add_argument("--json", action="store_true", help="print the result as JSON")
+    args = parser.parse_args(argv)
+
+    if not args.duration and not args.requests:
+        parser.error("one of --duration and --requests is needed")
+
+    data = None
+    if args.body_file:
+        with open(args.body_file, "rb") as f:
+            data = f.read()
+
+    loop = asyncio.get_event_loop()
+    session = Session(loop=loop)
+    try:
+        result = loop.run_until_complete(
+            run_bench(
+                args.url,
+                concurrency=args.concurrency,
+                duration=args.duration,
+                requests=args.requests,
+                rate=args.rate,
+                method=args.method,
+                headers=dict(args.header) or None,
+                data=data,
+                timeout=args.timeout,
+                session=session,
+            )
+        )
+    finally:
+        session.close()
+
+    if args.json:
+        print(json.dumps(result.as_dict()))
+    else:
+        print(result.report())
+    return 0 if result.requests else 1
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,120 @@
+import mmap
+import logging
+import tempfile
+
+from mugen.exceptions import ResponseTooLarge
+from mugen.utils import make_decompressor, decompress_limited
+
+logger = logging.getLogger(__name__)
+
+DEFAULT_SPOOL_CHUNK_SIZE = 64 * 1024
+
+
+class SpooledBody(object):
+    """
+    A response body kept in memory up to `max_size` bytes, and rolled over to
+    a temporary file beyond, None keeps it in memory
+
+    `getvalue()` returns bytes for a body in memory, and a read-only mmap of
+    the file for a body on disk, which is paged in as it is read.
+    """
+
+    __slots__ = ("max_size", "size", "_chunks", "_file")
+
+    def __init__(self, max_size=None):
+        self.max_size = max_size
+        self.size = 0
+        self._chunks = []
+        self._file = None
+
+    def __repr__(self):
+        return "<SpooledBody: size: {}, rolled: {}>".format(self.size, self.rolled)
+
+    def __len__(self):
+        return self.size
+
+    @property
+    def rolled(self):
+        return self._file is not None
+
+    def write(self, data):
+        if not data:
+            return
+
+        self.size += len(data)
+        if self._file is not None:
+            self._file.write(data)
+            return
+
+        self._chunks.append(data)
+        if self.max_size is not None and self.size > self.max_size:
+            self.rollover()
+
+    def rollover(self):
+        if self._file is not None:
+            return
+
+        logger.debug("[SpooledBody.rollover]: {} bytes".format(self.size))
+        self._file = tempfile.TemporaryFile()
+        self._file.writelines(self._chunks)
+        self._chunks = []
+
+    def chunks(self, chunk_size=DEFAULT_SPOOL_CHUNK_SIZE):
+        """
+        Iterate over the body in blocks of at most chunk_size
+        """
+
+        if self._file is None:
+            content = self.getvalue()
+            for i in range(0, len(content), chunk_size):
+                yield content[i : i + chunk_size]
+            return
+
+        self._file.flush()
+        self._file.seek(0)
+        while True:
+            chunk = self._file.read(chunk_size)
+            if not chunk:
+                break
+            yield chunk
+
+    def getvalue(self):
+        if self._file is None:
+            if len(self._chunks) > 1:
+                self._chunks = [b"".join(self._chunks)]
+            return self._chunks[0] if self._chunks else b""
+
+        self._file.flush()
+        # The file is unlinked, the mapping keeps its pages until it is freed
+        content = mmap.mmap(self._file.fileno(), 0, access=mmap.ACCESS_READ)
+        self.close()
+        return content
+
+    def close(self):
+        self._chunks = []
+        if self._file is not None:
+            self._file.close()
+
+
+def decompress_spooled(body, content_encoding, max_size=None, spool_size=None):
+    """
+    Decompress a SpooledBody into a new one, block by block, and return its
+    value. At most max_size bytes of decompressed content are accepted.
+    """
+
+    decompressor = make_decompressor(content_encoding)
+    content = SpooledBody(spool_size)
+    for chunk in body.chunks():
+        if max_size is None:
+            content.write(decompressor.decompress(chunk))
+        else:
+            content.write(
+                decompress_limited(decompressor, chunk, max_size - content.size)
+            )
+    content.write(decompressor.flush())
+    body.close()
+
+    if max_size is not None and content.size > max_size:
+        content.close()
+        raise ResponseTooLarge("decompressed body exceeds {} bytes".format(max_size))
+    return content.getvalue()
@@ -3,14 +3,19 @@ import time
 import logging
 import asyncio
 from asyncio import streams
+from ssl import create_default_context
 
 from functools import wraps
 
 from mugen.exceptions import ConnectionIsStale
-from mugen.models import MAX_CONNECTION_TIMEOUT, MAX_KEEP_ALIVE_TIME
+from mugen.models import MAX_KEEP_ALIVE_TIME
 
 logger = logging.getLogger(__name__)
 
+# Seconds before the Keep-Alive timeout of the server at which a connection
+# is not reused anymore
+KEEP_ALIVE_MARGIN = 1.0
+
 
 def async_error_proof(gen):
     @wraps(gen)
@@ -20,7 +25,7 @@ def async_error_proof(gen):
             return rs
         except Exception as err:
             logger.error("[{}]: {}".format(gen, repr(err)))
-            self.close()
+            self.close(error=True)
             raise err
 
     return wrap
@@ -34,7 +39,7 @@ def error_proof(func):
             return rs
         except Exception as err:
             logger.error("[{}]: {}".format(func, repr(err)))
-            self.close()
+            self.close(error=True)
             raise err
 
     return wrap
@@ -42,15 +47,67 @@ def error_proof(func):
 
 FD_USED_ERROR = re.compile(r"File descriptor (\d+) is used by transport")
 
+_default_ssl_context = None
+
+
+def default_ssl_context():
+    """
+    Return the SSLContext shared by all connections
+
+    Creating a context loads the system CA store, which is too expensive to do
+    for every handshake.
+    """
+
+    global _default_ssl_context
+    if _default_ssl_context is None:
+        _default_ssl_context = create_default_context()
+    return _default_ssl_context
+
 
 class Connection(object):
+    __slots__ = (
+        "ip",
+        "port",
+        "ssl",
+        "unix_socket",
+        "server_hostname",
+        "key",
+        "recycle",
+        "loop",
+        "reader",
+        "writer",
+        "ssl_on",
+        "socks_on",
+        "timeout",
+        "__last_action",
+        "on_release",
+        "limit",
+        "acquired_at",
+        "connect_time",
+        "tls_time",
+        "requests",
+        "keep_alive_timeout",
+        "requests_left",
+    )
+
     def __init__(
-        self, ip, port, ssl=False, key=None, recycle=True, timeout=None, loop=None
+        self,
+        ip,
+        port,
+        ssl=False,
+        key=None,
+        recycle=True,
+        timeout=None,
+        unix_socket=None,
+        server_hostname=None,
+        loop=None,
     ):
         self.ip = ip
         self.port = port
         self.ssl = ssl
-        self.key = key or (ip, port, ssl)
+        self.unix_socket = unix_socket
+        self.server_hostname = server_hostname
+        self.key = key or (unix_socket or ip, port, ssl)
         self.recycle = recycle
         self.loop = loop or asyncio.get_event_loop()
         self.reader = None
@@ -59,6 +116,20 @@ class Connection(object):
         self.socks_on = False  # socks proxy which needs to be initiated
         self.timeout = timeout or MAX_KEEP_ALIVE_TIME
         self.__last_action = time.time()
+        # Called with (connection, error) when the connection is given back,
+        # set for the AdaptiveLimit the connection is counted in
+        self.on_release = None
+        self.limit = None
+        self.acquired_at = None
+        # Seconds taken by the tcp connect and the last TLS handshake, and the
+        # number of requests sent
+        self.connect_time = 0.0
+        self.tls_time = 0.0
+        self.requests = 0
+        # Told by the Keep-Alive header of the server: the idle seconds after
+        # which it closes the connection, and the requests it still accepts
+        self.keep_alive_timeout = None
+        self.requests_left = None
 
     def __repr__(self):
         return "<Connection: {!r}>".format(self.key)
@@ -67,46 +138,103 @@ class Connection(object):
         self.__last_action = time.time()
         return self.__last_action
 
+    def idle(self):
+        """
+        Seconds since the last read or send
+        """
+
+        return time.time() - self.__last_action
+
     def is_timeout(self):
-        return time.time() - self.__last_action > self.timeout
+        timeout = self.timeout
+        if self.keep_alive_timeout is not None:
+            # Give up before the server does, a request sent as it closes the
+            # connection is lost
+            keep_alive = self.keep_alive_timeout
+            timeout = min(timeout, keep_alive - min(KEEP_ALIVE_MARGIN, keep_alive / 2))
+        return time.time() - self.__last_action > timeout
+
+    def keep_alive(self, timeout=None, max_requests=None):
+        """
+        Apply the Keep-Alive header of a response
+        """
+
+        if timeout is not None:
+            self.keep_alive_timeout = timeout
+        if max_requests is not None:
+            self.requests_left = max_requests
+
+    def exhausted(self):
+        """
+        The server accepts no more requests on the connection
+        """
+
+        return self.requests_left is not None and self.requests_left <= 0
+
+    def reusable(self):
+        return not self.stale() and not self.is_timeout() and not self.exhausted()
 
     @async_error_proof
     async def connect(self):
         logger.debug(f"[Connection.connect]: {self.key}")
 
+        start = time.monotonic()
         try:
-            reader, writer = await streams.open_connection(
-                self.ip, self.port, ssl=self.ssl
-            )
+            # TLS is handshaked after, to be timed apart
+            if self.unix_socket:
+                reader, writer = await streams.open_unix_connection(self.unix_socket)
+            else:
+                reader, writer = await streams.open_connection(self.ip, self.port)
         except RuntimeError as err:
-            logger.error("[Connection.connect]: %s:%s, %s", self.ip, self.port, err)
+            logger.error("[Connection.connect]: %s, %s", self.key, err)
             info = str(err)
 
             # If the fd is used, we remove it
+            # `_transports` is private to the asyncio loops, uvloop does not
+            # have it
             m = FD_USED_ERROR.search(info)
-            if m:
+            transports = getattr(self.loop, "_transports", None)
+            if m and transports is not None:
                 fd = int(m.group(1))
-                transp = self.loop._transports[fd]
+                transp = transports.get(fd)
                 if transp:
                     transp.close()
-                del self.loop._transports[fd]
+                transports.pop(fd, None)
 
             raise err
         except Exception as err:
-            logger.error("[Connection.connect]: %s:%s, %s", self.ip, self.port, err)
+            logger.error("[Connection.connect]: %s, %s", self.key, err)
             raise err
 
         self.reader = reader
         self.writer = writer
+        self.connect_time = time.monotonic() - start
+
+        if self.ssl:
+            ssl_context = None if self.ssl is True else self.ssl
+            await self.ssl_handshake(self.server_hostname or self.ip, ssl_context)
 
     @async_error_proof
-    async def ssl_handshake(self, host):
+    async def ssl_handshake(self, host, ssl_context=None):
+        """
+        Upgrade the established stream to TLS in place
+        """
+
         logger.debug("[Connection.ssl_handshake]: {}, {}".format(self.key, host))
-        transport = self.reader._transport
-        raw_socket = transport.get_extra_info("socket", default=None)
-        self.reader, self.writer = await streams.open_connection(
-            ssl=True, sock=raw_socket, server_hostname=host
-        )
+        start = time.monotonic()
+        ssl_context = ssl_context or default_ssl_context()
+        if hasattr(self.writer, "start_tls"):  # Python 3.11+
+            await self.writer.start_tls(ssl_context, server_hostname=host)
+        else:
+            transport = self.writer.transport
+            protocol = transport.get_protocol()
+            ssl_transport = await self.loop.start_tls(
+                transport, protocol, ssl_context, server_hostname=host
+            )
+            self.writer = streams.StreamWriter(
+                ssl_transport, protocol, self.reader, self.loop
+            )
+        self.tls_time = time.monotonic() - start
 
     @error_proof
     def send(self, data):
@@ -115,6 +243,49 @@ class Connection(object):
 
         self.writer.write(data)
 
+    @async_error_proof
+    async def drain(self):
+        """
+        Wait until the write buffer is flushed, to send a large body with
+        bounded memory
+        """
+
+        self._watch()
+        await self.writer.drain()
+
+    @async_error_proof
+    async def sendfile(self, file, offset=0, count=None):
+        """
+        Send count bytes of a binary file from offset, zero-copy on plain
+        connections
+        """
+
+        logger.debug(
+            "[Connection.sendfile]: {}: offset = {}, count = {}".format(
+                self.key, offset, count
+            )
+        )
+        self._watch()
+        try:
+            # Falls back to reads and writes on the transports which can not
+            # sendfile, such as ssl ones
+            await self.loop.sendfile(
+                self.writer.transport, file, offset, count, fallback=True
+            )
+        except NotImplementedError:
+            # uvloop has no sendfile
+            file.seek(offset)
+            while count is None or count > 0:
+                size = 64 * 1024 if count is None else min(64 * 1024, count)
+                chunk = await self.loop.run_in_executor(None, file.read, size)
+                if not chunk:
+                    break
+                if count is not None:
+                    count -= len(chunk)
+                self.writer.write(chunk)
+                await self.writer.drain()
+        self._watch()
+
     @async_error_proof
     async def read(self, size=-1):
         logger.debug("[Connection.read]: {}: size = {}".format(self.key, size))
@@ -128,21 +299,36 @@ class Connection(object):
             )
             raise ConnectionIsStale("{}".format(self.key))
 
+        # Timeouts are handled by the Deadline of the request
         if size < 0:
-            chunk = await asyncio.wait_for(
-                self.reader.read(size), timeout=MAX_CONNECTION_TIMEOUT
-            )
+            chunk = await self.reader.read(size)
             return chunk
         else:
             chunks = b""
             while size:
-                chunk = await asyncio.wait_for(
-                    self.reader.read(size), timeout=MAX_CONNECTION_TIMEOUT
-                )
+                chunk = await self.reader.read(size)
+                if not chunk:
+                    raise asyncio.IncompleteReadError(chunks, len(chunks) + size)
+                self._watch()
                 size -= len(chunk)
                 chunks += chunk
             return chunks
 
+    @async_error_proof
+    async def read_some(self, size):
+        """
+        Read at most size bytes, return b"" at EOF
+        """
+
+        logger.debug("[Connection.read_some]: {}: size = {}".format(self.key, size))
+        self._watch()
+
+        if self.reader is None:
+            raise ConnectionIsStale("{}".format(self.key))
+
+        chunk = await self.reader.read(size)
+        return chunk
+
     @async_error_proof
     async def readline(self):
         # assert self.closed() is False, 'connection is closed'
@@ -154,9 +340,8 @@ class Connection(object):
             )
             raise ConnectionIsStale("{}".format(self.key))
 
-        chunk = await asyncio.wait_for(
-            self.reader.readline(), timeout=MAX_CONNECTION_TIMEOUT
-        )
+        self._watch()
+        chunk = await self.reader.readline()
 
         logger.debug(
             "[Connection.readline]: " "{}: size = {}".format(self.key, len(chunk))
@@ -164,11 +349,19 @@ class Connection(object):
 
         return chunk
 
-    def close(self):
+    def release(self, error=False):
+        on_release = self.on_release
+        if on_release is not None:
+            self.on_release = None
+            on_release(self, error)
+
+    def close(self, error=False):
         logger.debug(
             "[Connection.close]: {}, " "recycle: {}".format(self.key, self.recycle)
         )
 
+        self.release(error)
+
         if not self.closed():
             self.reader.feed_eof()
             self.writer.close()
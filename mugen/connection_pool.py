@@ -1,3 +1,5 @@
+import time
+import weakref
 import logging
 import asyncio
 
@@ -14,6 +16,141 @@ from mugen.models import (
 
 logger = logging.getLogger(__name__)
 
+# AIMD parameters of the adaptive pool
+DEFAULT_MIN_PER_HOST = 2
+LATENCY_EWMA_WEIGHT = 0.2
+BASE_LATENCY_DRIFT = 0.01
+CONGESTION_LATENCY_FACTOR = 2.0
+# Latency jitter below this is not congestion
+CONGESTION_LATENCY_SLACK = 0.01
+DECREASE_FACTOR = 0.5
+
+
+class AdaptiveLimit(object):
+    """
+    AIMD controller of the connections in use for one key
+
+    While the limit is reached and the host answers well, the target grows by
+    one connection per round of requests. On errors, or when the latency
+    rises to CONGESTION_LATENCY_FACTOR times its base, the target is halved,
+    at most once per round trip.
+    """
+
+    __slots__ = ("target", "active", "waiters", "latency", "base_latency", "hold_until")
+
+    def __init__(self, target):
+        self.target = target
+        self.active = 0
+        self.waiters = deque()
+        self.latency = None
+        self.base_latency = None
+        self.hold_until = 0.0
+
+    def __repr__(self):
+        return "<AdaptiveLimit: target: {:.2f}, active: {}, latency: {}>".format(
+            self.target, self.active, self.latency
+        )
+
+    def available(self):
+        return self.active < int(self.target)
+
+    def update(self, latency, error, demand, now, min_size, max_size):
+        if self.latency is None:
+            self.latency = self.base_latency = latency
+        else:
+            self.latency += (latency - self.latency) * LATENCY_EWMA_WEIGHT
+            # Follow a lasting change of the host slowly
+            self.base_latency += (self.latency - self.base_latency) * BASE_LATENCY_DRIFT
+            self.base_latency = min(self.base_latency, latency)
+
+        congested = self.latency > max(
+            self.base_latency * CONGESTION_LATENCY_FACTOR,
+            self.base_latency + CONGESTION_LATENCY_SLACK,
+        )
+        if error or congested:
+            if now >= self.hold_until:
+                self.target = max(min_size, self.target * DECREASE_FACTOR)
+                self.hold_until = now + self.latency
+        elif demand:
+            self.target = min(max_size, self.target + 1 / self.target)
+
+
+class AdaptiveLimits(object):
+    """
+    The AdaptiveLimit of each key, for the Session which owns them
+
+    The connections a Session takes for a key from the shared pool are
+    limited between `min_per_host` and `max_per_host`. Other sessions of the
+    loop are not limited by them. At least one connection is allowed.
+    """
+
+    def __init__(self, min_per_host=DEFAULT_MIN_PER_HOST, max_per_host=None):
+        self.min_per_host = max(1, min_per_host)
+        self.max_per_host = max_per_host or MAX_POOL_TASKS
+        self.__limits = {}
+
+    def __repr__(self):
+        return "<AdaptiveLimits: keys: {}>".format(len(self.__limits))
+
+    def get_limit(self, key):
+        limit = self.__limits.get(key)
+        if limit is None:
+            limit = AdaptiveLimit(self.min_per_host)
+            self.__limits[key] = limit
+        return limit
+
+    async def acquire(self, key, loop):
+        limit = self.get_limit(key)
+        if limit.available() and not limit.waiters:
+            limit.active += 1
+            return limit
+
+        waiter = loop.create_future()
+        limit.waiters.append(waiter)
+        try:
+            await waiter
+        except asyncio.CancelledError:
+            if waiter.done() and not waiter.cancelled():
+                limit.active -= 1
+                self._wakeup(limit)
+            raise
+        return limit
+
+    def release(self, conn, error):
+        limit = conn.limit
+        if limit is None:
+            return
+
+        conn.limit = None
+        now = time.monotonic()
+        demand = bool(limit.waiters) or not limit.available()
+        limit.active -= 1
+        limit.update(
+            now - conn.acquired_at,
+            error,
+            demand,
+            now,
+            self.min_per_host,
+            self.max_per_host,
+        )
+        self._wakeup(limit)
+
+    def _wakeup(self, limit):
+        while limit.waiters and limit.available():
+            waiter = limit.waiters.popleft()
+            if not waiter.done():
+                limit.active += 1
+                waiter.set_result(None)
+
+    def forget(self, keys_in_use):
+        """
+        Forget the limits of the keys which are not used anymore
+        """
+
+        for key, limit in list(self.__limits.items()):
+            if not limit.active and not limit.waiters and key not in keys_in_use:
+                del self.__limits[key]
+
 
 class ConnectionPool(Singleton):
     """
@@ -42,6 +179,8 @@ class ConnectionPool(Singleton):
         self.__connection_sizes = defaultdict(int)
         self.__recheck_internal = recheck_internal
         self.__call_count = 0
+        # The AdaptiveLimits of the sessions, forgotten with them
+        self.__adaptive = weakref.WeakSet()
 
         asyncio.ensure_future(self._keep_alive_watcher(), loop=loop)
 
@@ -67,11 +206,36 @@ class ConnectionPool(Singleton):
     def get_connections(self, key):
         return self.__connections[key]
 
-    async def get_connection(self, key, recycle=None, timeout=None):
+    def count_idle(self, key):
+        """
+        The number of usable connections parked for key
+        """
+
+        conns = self.__connections.get(key, ())
+        return sum(1 for conn in conns if conn.reusable())
+
+    async def get_connection(self, key, recycle=None, timeout=None, adaptive=None):
+        """
+        `adaptive` is the AdaptiveLimits of the session, which the connection
+        waits for
+        """
+
         logger.debug(
             "[ConnectionPool.get_connection]: " "{}, recycle: {}".format(key, recycle)
         )
 
+        if adaptive is None:
+            return self._get_connection(key, recycle=recycle, timeout=timeout)
+
+        self.__adaptive.add(adaptive)
+        limit = await adaptive.acquire(key, self.loop)
+        conn = self._get_connection(key, recycle=recycle, timeout=timeout)
+        conn.limit = limit
+        conn.on_release = adaptive.release
+        conn.acquired_at = time.monotonic()
+        return conn
+
+    def _get_connection(self, key, recycle=None, timeout=None):
         if recycle is None:
             recycle = self.recycle
 
@@ -82,7 +246,7 @@ class ConnectionPool(Singleton):
         while len(conns):
             conn = conns.popleft()
             self.count_connections(key, -1)
-            if not conn.stale():
+            if conn.reusable():
                 return conn
             else:
                 conn.close()
@@ -101,19 +265,50 @@ class ConnectionPool(Singleton):
         if recycle is None:
             recycle = self.recycle
 
-        ip, port, ssl, *_ = key
-        conn = Connection(
-            ip, port, ssl=ssl, key=key, recycle=recycle, timeout=timeout, loop=self.loop
-        )
+        ip, port, ssl, *rest = key
+        if port is None:
+            # (path, None, ssl[, host]) is a unix socket
+            conn = Connection(
+                None,
+                None,
+                ssl=ssl,
+                key=key,
+                recycle=recycle,
+                timeout=timeout,
+                unix_socket=ip,
+                server_hostname=rest[0] if rest else None,
+                loop=self.loop,
+            )
+        else:
+            # (ip, port, True, host) is a TLS connection to host
+            conn = Connection(
+                ip,
+                port,
+                ssl=ssl,
+                key=key,
+                recycle=recycle,
+                timeout=timeout,
+                server_hostname=rest[0] if ssl and rest else None,
+                loop=self.loop,
+            )
         return conn
 
     def recycle_connection(self, conn):
         logger.debug("[ConnectionPool.recycle_connection]: {}".format(conn))
 
-        if conn.recycle and not conn.stale() and not conn.is_timeout():
+        limit = conn.limit
+        conn.release()
+        if conn.recycle and conn.reusable():
             key = conn.key
             conns = self.__connections[key]
-            if len(conns) < self.max_tasks or len(self.__connections) < self.max_pool:
+            if limit is not None:
+                keep = len(conns) < limit.target
+            else:
+                keep = (
+                    len(conns) < self.max_tasks
+                    or len(self.__connections) < self.max_pool
+                )
+            if keep:
                 conns.append(conn)
                 self.count_connections(key, 1)
                 return None
@@ -138,6 +333,9 @@ class ConnectionPool(Singleton):
         for key in empty_conns:
             del self.__connections[key]
 
+        for adaptive in list(self.__adaptive):
+            adaptive.forget(self.__connections)
+
     def count_connections(self, key, incr):
         if self.__connection_sizes[key] > 0:
             self.__connection_sizes[key] += incr
@@ -1,6 +1,10 @@
 import json
+import time
+import ipaddress
+from collections import OrderedDict
+from email.utils import parsedate_to_datetime
 
-from http.cookies import BaseCookie, Morsel
+from http.cookies import BaseCookie, CookieError, Morsel
 
 
 class DictCookie(BaseCookie):
@@ -25,3 +29,310 @@ class DictCookie(BaseCookie):
         return " ".join(
             ["{}={};".format(key, value) for key, value in self.get_dict().items()]
         )
+
+
+def _parse_expires(value):
+    try:
+        return parsedate_to_datetime(value).timestamp()
+    except (TypeError, ValueError, IndexError, OverflowError):
+        return None
+
+
+def default_path(path):
+    """
+    The default cookie path of a request path, RFC 6265 5.1.4
+    """
+
+    if not path or not path.startswith("/") or path.count("/") == 1:
+        return "/"
+    return path[: path.rfind("/")]
+
+
+def path_match(request_path, cookie_path):
+    if request_path == cookie_path:
+        return True
+    return request_path.startswith(cookie_path) and (
+        cookie_path.endswith("/") or request_path[len(cookie_path)] == "/"
+    )
+
+
+# The (host, secure) pairs whose Cookie header is cached
+DEFAULT_COOKIE_CACHE_SIZE = 1024
+# Hosts no cookie applies to are not cached
+_NO_COOKIES = (None, (), None)
+
+
+class Cookie(object):
+    __slots__ = ("name", "value", "domain", "path", "host_only", "secure", "expires")
+
+    def __init__(
+        self,
+        name,
+        value,
+        domain="",
+        path="/",
+        host_only=False,
+        secure=False,
+        expires=None,
+    ):
+        self.name = name
+        self.value = value
+        self.domain = domain
+        self.path = path
+        self.host_only = host_only
+        self.secure = secure
+        self.expires = expires
+
+    def __repr__(self):
+        return "<Cookie {}={} for {}{}>".format(
+            self.name, self.value, self.domain or "*", self.path
+        )
+
+    def is_expired(self, now):
+        return self.expires is not None and self.expires <= now
+
+
+class CookieJar(object):
+    """
+    Cookies indexed by domain, then by (path, name)
+
+    Cookies of the domain "" apply to every host, such as those given by the
+    user. The serialized Cookie header is cached per (host, secure) until a
+    cookie of a matching domain changes or expires, so the cost of a request
+    does not depend on how many domains the jar holds. The `cache_size` most
+    recently used hosts with cookies are cached.
+    """
+
+    def __init__(self, cookies=None, cache_size=DEFAULT_COOKIE_CACHE_SIZE):
+        # domain -> {(path, name): Cookie}
+        self._domains = {}
+        # (host, secure) -> (header or None, [Cookie], expires), LRU
+        self._cache = OrderedDict()
+        self._cache_size = cache_size
+        # domain -> {(host, secure)}, the cache entries depending on a domain
+        self._dependents = {}
+
+        if cookies:
+            self.update(cookies)
+
+    def __repr__(self):
+        return "<CookieJar: {}>".format(json.dumps(self.get_dict(), ensure_ascii=False))
+
+    def __len__(self):
+        return sum(len(cookies) for cookies in self._domains.values())
+
+    def __bool__(self):
+        return bool(self._domains)
+
+    def __iter__(self):
+        now = time.time()
+        for cookies in list(self._domains.values()):
+            for cookie in list(cookies.values()):
+                if not cookie.is_expired(now):
+                    yield cookie
+
+    def get_dict(self):
+        return {cookie.name: cookie.value for cookie in self}
+
+    def get(self, name, default=None):
+        return self.get_dict().get(name, default)
+
+    def format_cookie(self):
+        return " ".join(["{}={};".format(k, v) for k, v in self.get_dict().items()])
+
+    def _changed(self, domain):
+        if domain == "":
+            self._cache.clear()
+            self._dependents.clear()
+            return
+
+        for key in list(self._dependents.get(domain, ())):
+            self._uncache(key)
+
+    def _uncache(self, key):
+        self._cache.pop(key, None)
+        for domain in self._domains_of(key[0]):
+            dependents = self._dependents.get(domain)
+            if dependents is not None:
+                dependents.discard(key)
+                if not dependents:
+                    del self._dependents[domain]
+
+    def set(
+        self,
+        name,
+        value,
+        domain="",
+        path="/",
+        host_only=False,
+        secure=False,
+        expires=None,
+    ):
+        domain = domain.lower()
+        cookie = Cookie(name, value, domain, path, host_only, secure, expires)
+        self._domains.setdefault(domain, {})[(path, name)] = cookie
+        self._changed(domain)
+
+    def remove(self, name, domain="", path="/"):
+        cookies = self._domains.get(domain.lower())
+        if cookies and cookies.pop((path, name), None):
+            if not cookies:
+                del self._domains[domain.lower()]
+            self._changed(domain.lower())
+
+    def update(self, cookies, domain="", host_only=False):
+        """
+        Add cookies from a dict, a BaseCookie or a CookieJar
+        """
+
+        if isinstance(cookies, CookieJar):
+            for cookie in cookies:
+                self.set(
+                    cookie.name,
+                    cookie.value,
+                    cookie.domain,
+                    cookie.path,
+                    cookie.host_only,
+                    cookie.secure,
+                    cookie.expires,
+                )
+            return
+
+        for name, value in cookies.items():
+            if isinstance(value, Morsel):
+                value = value.value
+            self.set(name, value, domain=domain, host_only=host_only)
+
+    def extract(self, set_cookies, host, request_path="/"):
+        """
+        Store the cookies of `Set-Cookie` header values received from host
+        """
+
+        host = host.lower()
+        now = time.time()
+        for set_cookie in set_cookies:
+            parsed = BaseCookie()
+            try:
+                parsed.load(set_cookie)
+            except CookieError:
+                continue
+
+            for name, morsel in parsed.items():
+                domain = morsel["domain"].lower().lstrip(".")
+                host_only = not domain
+                if host_only:
+                    domain = host
+                elif not (host == domain or host.endswith("." + domain)):
+                    # A host can not set cookies for other domains
+                    continue
+
+                path = morsel["path"]
+                if not path.startswith("/"):
+                    path = default_path(request_path)
+
+                expires = None
+                if morsel["max-age"]:
+                    try:
+                        expires = now + int(morsel["max-age"])
+                    except ValueError:
+                        pass
+                elif morsel["expires"]:
+                    expires = _parse_expires(morsel["expires"])
+
+                if expires is not None and expires <= now:
+                    self.remove(name, domain, path)
+                    continue
+
+                self.set(
+                    name,
+                    morsel.value,
+                    domain=domain,
+                    path=path,
+                    host_only=host_only,
+                    secure=bool(morsel["secure"]),
+                    expires=expires,
+                )
+
+    def _domains_of(self, host):
+        yield ""
+        try:
+            ipaddress.ip_address(host)
+        except ValueError:
+            pass
+        else:
+            # No domain matching for IP addresses
+            yield host
+            return
+
+        labels = host.split(".")
+        for i in range(len(labels)):
+            yield ".".join(labels[i:])
+
+    def _lookup(self, host, secure, now):
+        key = (host, secure)
+        entry = self._cache.get(key)
+        if entry is not None:
+            if entry[2] is None or entry[2] > now:
+                self._cache.move_to_end(key)
+                return entry
+            self._uncache(key)
+
+        cookies = []
+        expires = None
+        domains = []
+        for domain in self._domains_of(host):
+            domains.append(domain)
+            bucket = self._domains.get(domain)
+            if not bucket:
+                continue
+
+            for cookie_key, cookie in list(bucket.items()):
+                if cookie.is_expired(now):
+                    del bucket[cookie_key]
+                    continue
+                if cookie.host_only and cookie.domain != host:
+                    continue
+                if cookie.secure and not secure:
+                    continue
+                cookies.append(cookie)
+                if cookie.expires is not None:
+                    expires = min(expires or cookie.expires, cookie.expires)
+
+        # Cookies with longer paths are listed first, RFC 6265 5.4
+        cookies.sort(key=lambda cookie: len(cookie.path), reverse=True)
+        header = None
+        if all(cookie.path == "/" for cookie in cookies):
+            header = "; ".join([f"{cookie.name}={cookie.value}" for cookie in cookies])
+
+        if not cookies:
+            return _NO_COOKIES
+
+        entry = (header, cookies, expires)
+        self._cache[key] = entry
+        for domain in domains:
+            self._dependents.setdefault(domain, set()).add(key)
+        if len(self._cache) > self._cache_size:
+            self._uncache(next(iter(self._cache)))
+        return entry
+
+    def cookie_header(self, host, path="/", secure=False):
+        """
+        Return the value of the Cookie header to send to host, or ""
+        """
+
+        header, cookies, _ = self._lookup(host.lower(), secure, time.time())
+        if header is not None:
+            return header
+
+        return "; ".join(
+            [
+                f"{cookie.name}={cookie.value}"
+                for cookie in cookies
+                if path_match(path or "/", cookie.path)
+            ]
+        )
+
+    def clear(self):
+        self._domains.clear()
+        self._cache.clear()
+        self._dependents.clear()
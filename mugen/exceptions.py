@@ -1,3 +1,6 @@
+import asyncio
+
+
 class NotFindIP(Exception):
     pass
 
@@ -20,3 +23,31 @@ class UnknownProxyScheme(Exception):
 
 class CanNotCreateConnect(Exception):
     pass
+
+
+class StreamConsumed(Exception):
+    pass
+
+
+class LineTooLong(Exception):
+    pass
+
+
+class ResponseTooLarge(Exception):
+    pass
+
+
+class RequestTimeout(asyncio.TimeoutError):
+    pass
+
+
+class PoolTimeout(RequestTimeout):
+    pass
+
+
+class ConnectTimeout(RequestTimeout):
+    pass
+
+
+class ReadTimeout(RequestTimeout):
+    pass
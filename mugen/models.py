@@ -1,22 +1,40 @@
+import re
 import json
+import time
 import logging
 import asyncio
 import socket
 import base64
-from urllib.parse import urlparse, ParseResult
+from functools import partial
+from urllib.parse import urlparse, urlunparse, ParseResult
 
 from http.cookies import SimpleCookie, Morsel
 from collections import OrderedDict
 
-from mugen.cookies import DictCookie
-from mugen.exceptions import NotFindIP
-from mugen.structures import CaseInsensitiveDict
+from mugen.cookies import DictCookie, CookieJar
+from mugen.exceptions import (
+    NotFindIP,
+    ConnectionIsStale,
+    StreamConsumed,
+    LineTooLong,
+    ResponseTooLarge,
+)
+from mugen.body import SpooledBody, decompress_spooled
+from mugen.sse import SSEParser
+from mugen.timeouts import Timeout, Deadline
+from mugen.structures import CaseInsensitiveDict, ResponseHeaders, Timings
 from mugen.utils import (
     default_headers,
     url_params_encode,
     form_encode,
     decode_gzip,
     decode_deflate,
+    make_decompressor,
+    decompress_limited,
+    decode_limited,
+    make_compressor,
+    encode_content,
+    offload,
     find_encoding,
     is_ip,
     parse_proxy,
@@ -25,34 +43,71 @@ from mugen.utils import (
 
 from httptools import HttpResponseParser
 
-
 MAX_CONNECTION_POOL = 100
 MAX_POOL_TASKS = 100
 MAX_REDIRECTIONS = 1000
 MAX_CONNECTION_TIMEOUT = 1 * 60
 MAX_KEEP_ALIVE_TIME = 10 * 60
 DEFAULT_DNS_CACHE_SIZE = 5000
+DEFAULT_REDIRECT_CACHE_SIZE = 10000
 DEFAULT_REDIRECT_LIMIT = 100
 DEFAULT_RECHECK_INTERNAL = 100
 HTTP_VERSION = "HTTP/1.1"
 DEFAULT_ENCODING = "utf-8"
+# Bodies larger than this are decompressed, decoded and parsed in a thread
+DEFAULT_OFFLOAD_SIZE = 1024 * 1024
 
 
 # https://magic.io/blog/uvloop-blazing-fast-python-networking/
 DEFAULT_READ_SIZE = 1024
+DEFAULT_CHUNK_SIZE = 64 * 1024
+DEFAULT_MAX_LINE_SIZE = 1024 * 1024
+LINE_ENDINGS = re.compile(rb"\r\n|\r|\n")
+DEFAULT_MAX_HEADER_BYTES = 64 * 1024
 
 logger = logging.getLogger(__name__)
 
 
 class Singleton(object):
+    """
+    One instance per event loop, given as `loop` or the current one
+
+    The instances hold futures, tasks and connections bound to their loop,
+    so the loops of other threads, or of `asyncio.run`, get their own.
+    """
+
     def __new__(cls, *args, **kwargs):
-        if not hasattr(cls, "_instance"):
-            instance = object.__new__(cls)
-            cls._instance = instance
-        return cls._instance
+        loop = kwargs.get("loop") or asyncio.get_event_loop()
+        if "_instances" not in cls.__dict__:
+            cls._instances = {}
+        instances = cls._instances
+        instance = instances.get(loop)
+        if instance is None:
+            # Forget the instances of the loops which are closed
+            for closed in [other for other in instances if other.is_closed()]:
+                del instances[closed]
+            instance = instances[loop] = object.__new__(cls)
+        return instance
 
 
 class Request(object):
+    __slots__ = (
+        "method",
+        "url",
+        "params",
+        "headers",
+        "data",
+        "encoding",
+        "cookies",
+        "proxy",
+        "proxy_auth",
+        "url_parse_result",
+        "ssl",
+        "forward_proxy",
+        "compress",
+        "_body",
+    )
+
     def __init__(
         self,
         method,
@@ -64,6 +119,7 @@ class Request(object):
         proxy=None,
         proxy_auth=None,
         encoding=None,
+        compress=None,
     ):
         self.method = method.upper()
         self.url = url
@@ -73,6 +129,11 @@ class Request(object):
         self.headers = CaseInsensitiveDict(headers or default_headers())
         self.data = data
         self.encoding = encoding
+        # "gzip" or "deflate", the content coding of the body
+        if compress is not None:
+            make_compressor(compress)
+        self.compress = compress
+        self._body = None
         if cookies is None:
             self.cookies = DictCookie()
         else:
@@ -114,18 +175,93 @@ class Request(object):
 
         self.ssl = scheme.lower() == "https"
 
+        # Only plain http requests through an http proxy are forwarded by the
+        # proxy. Others go through a tunnel and are sent in origin-form.
+        self.forward_proxy = bool(
+            self.proxy
+            and (self.method == "CONNECT" or not self.ssl)
+            and urlparse(self.proxy).scheme.lower() == "http"
+        )
+
     def make_request(self):
         host = self.url_parse_result.netloc
         request_line = self.make_request_line()
         headers = self.make_request_headers(
             self.method, host, self.headers, self.cookies
         )
-        data = self.make_request_data(self.data)
-
-        # TODO: encoding file
+        data = self.make_request_body()
 
         return request_line, headers, data
 
+    @property
+    def streaming(self):
+        """
+        The body is an iterable, or an async iterable, of bytes, sent chunked
+        """
+
+        data = self.data
+        if data is None or isinstance(data, (bytes, bytearray, str, dict)):
+            return False
+        return hasattr(data, "__aiter__") or hasattr(data, "__iter__")
+
+    def stream_length(self):
+        """
+        The length of a streamed body known ahead, such as a
+        MultipartEncoder's, None sends it chunked
+        """
+
+        if self.compress:
+            return None
+        return getattr(self.data, "content_length", None)
+
+    def make_request_body(self):
+        """
+        The encoded, and compressed, body. None for a streamed body, which is
+        sent by `iter_body`.
+        """
+
+        if self._body is None and not self.streaming:
+            data = self.make_request_data(self.data)
+            if data and self.compress:
+                data = encode_content(self.compress, _to_bytes(data))
+            self._body = data
+        return self._body
+
+    async def prepare_body(self, offload_size=DEFAULT_OFFLOAD_SIZE):
+        """
+        Compress a body larger than offload_size in a thread
+        """
+
+        if self._body is not None or not self.compress or self.streaming:
+            return
+        data = self.make_request_data(self.data)
+        if data:
+            self._body = await offload(
+                partial(encode_content, self.compress), _to_bytes(data), offload_size
+            )
+
+    async def iter_body(self, offload_size=DEFAULT_OFFLOAD_SIZE):
+        """
+        Iterate over the blocks of a streamed body, compressed incrementally
+        """
+
+        data = self.data
+        compressor = make_compressor(self.compress) if self.compress else None
+        if not hasattr(data, "__aiter__"):
+            data = _aiter(data)
+
+        async for chunk in data:
+            chunk = _to_bytes(chunk)
+            if compressor is not None:
+                chunk = await offload(compressor.compress, chunk, offload_size)
+            if chunk:
+                yield chunk
+
+        if compressor is not None:
+            chunk = compressor.flush()
+            if chunk:
+                yield chunk
+
     def make_request_line(self):
         method = self.method
         scheme = self.url_parse_result.scheme
@@ -143,7 +279,7 @@ class Request(object):
         if method.lower() == "connect":
             request_line = "{} {} {}".format(method, host, HTTP_VERSION)
         else:
-            if self.proxy:
+            if self.forward_proxy:
                 uri = f"{scheme}://{host}{path}"
             else:
                 uri = path
@@ -162,15 +298,35 @@ class Request(object):
         if method.lower() == "post" and not self.data:
             _headers.append("Content-Length: 0")
 
-        if self.data:
-            data = self.make_request_data(self.data)
+        if self.streaming:
+            length = self.stream_length()
+            if length is None:
+                _headers.append("Transfer-Encoding: chunked")
+            else:
+                _headers.append("Content-Length: {}".format(length))
+            if self.compress:
+                _headers.append("Content-Encoding: " + self.compress)
+            content_type = getattr(self.data, "content_type", None)
+            if content_type and not headers.get("Content-Type"):
+                _headers.append("Content-Type: " + content_type)
+        elif self.data:
+            data = self.make_request_body()
             _headers.append("Content-Length: {}".format(len(data)))
+            if self.compress:
+                _headers.append("Content-Encoding: " + self.compress)
             if isinstance(self.data, dict) and not headers.get("Content-Type"):
                 _headers.append("Content-Type: application/x-www-form-urlencoded")
 
         # add cookies
         if cookies:
-            if isinstance(cookies, (DictCookie, SimpleCookie)):
+            if isinstance(cookies, CookieJar):
+                parse_result = self.url_parse_result
+                cookie = cookies.cookie_header(
+                    parse_result.hostname or "", parse_result.path or "/", self.ssl
+                )
+                if cookie:
+                    _headers.append("Cookie: " + cookie)
+            elif isinstance(cookies, (DictCookie, SimpleCookie)):
                 _cookies = []
                 for k in cookies:
                     # TODO, path ?
@@ -191,7 +347,7 @@ class Request(object):
                 _headers.append(cookie)
 
         # Add Proxy-Authorization header
-        if self.proxy_auth:
+        if self.proxy_auth and self.forward_proxy:
             basic = base64encode(self.proxy_auth)
             proxy_auth = f"Proxy-Authorization: Basic {basic}"
             _headers.append(proxy_auth)
@@ -211,64 +367,194 @@ class Request(object):
             enc_data = form_encode(data)
         elif isinstance(data, str):
             enc_data = bytes(data, "utf-8")
-        elif isinstance(data, bytes):
-            enc_data = data
+        elif isinstance(data, (bytes, bytearray)):
+            enc_data = bytes(data)
         else:
             TypeError("request data must be str or dict, NOT {!r}".format(data))
 
         return enc_data
 
 
+def _to_bytes(data):
+    if isinstance(data, str):
+        return data.encode("utf-8")
+    return data
+
+
+async def _aiter(iterable):
+    for item in iterable:
+        yield item
+
+
 class HttpResonse(object):
+    __slots__ = ("encoding", "headers", "content", "cookies")
+
     def __init__(self, cookies=None, encoding=None):
-        self.headers = CaseInsensitiveDict()
-        self.content = b""
         self.encoding = encoding or DEFAULT_ENCODING
+        self.headers = ResponseHeaders(encoding=self.encoding)
+        self.content = b""
         if cookies is None:
             self.cookies = DictCookie()
         else:
             self.cookies = cookies
 
     def on_header(self, name, value):
-        name = name.decode(self.encoding)
-        value = value.decode(self.encoding)
-        if name.lower() == "set-cookie":
-            self.cookies.load(value)
-            if self.headers.get(name):
-                self.headers[name] += ", " + value
-                return None
-        self.headers[name] = value
+        # Headers are decoded lazily, see ResponseHeaders. The length is
+        # checked first to not lowercase every header name.
+        self.headers.add(name, value)
+        if len(name) == 10 and name.lower() == b"set-cookie":
+            self.cookies.load(value.decode(self.encoding))
 
     def on_body(self, value):
         self.content += value
 
 
+class Limits(object):
+    """
+    Size limits of a response, in bytes, None is no limit
+
+    `max_header_bytes` covers the status line and the headers,
+    `max_body_bytes` the body as it is sent, and `max_decompressed_bytes`
+    the body once decompressed. ResponseTooLarge is raised as soon as a limit
+    is exceeded, and the connection is closed.
+    """
+
+    __slots__ = ("max_header_bytes", "max_body_bytes", "max_decompressed_bytes")
+
+    def __init__(
+        self,
+        max_header_bytes=DEFAULT_MAX_HEADER_BYTES,
+        max_body_bytes=None,
+        max_decompressed_bytes=None,
+    ):
+        self.max_header_bytes = max_header_bytes
+        self.max_body_bytes = max_body_bytes
+        self.max_decompressed_bytes = max_decompressed_bytes
+
+    def __repr__(self):
+        return (
+            "<Limits: max_header_bytes: {}, max_body_bytes: {}, "
+            "max_decompressed_bytes: {}>".format(
+                self.max_header_bytes, self.max_body_bytes, self.max_decompressed_bytes
+            )
+        )
+
+
+DEFAULT_LIMITS = Limits()
+
+
+class RedirectRecord(object):
+    """
+    What is kept of a redirection in `response.history` when the session
+    does not keep the full responses
+    """
+
+    __slots__ = ("status_code", "headers", "url")
+
+    def __init__(self, status_code, headers, url):
+        self.status_code = status_code
+        self.headers = headers
+        self.url = url
+
+    def __repr__(self):
+        return "<RedirectRecord [{}] {}>".format(self.status_code, self.url)
+
+
 class Response(object):
-    def __init__(self, method, connection, encoding=None):
+    __slots__ = (
+        "method",
+        "connection",
+        "headers",
+        "content",
+        "cookies",
+        "encoding",
+        "offload_size",
+        "status_code",
+        "history",
+        "request",
+        "timings",
+        "timeout",
+        "limits",
+        "spool_size",
+        "_text",
+        "_json",
+        "_json_loaded",
+        "_consumed",
+        "_session",
+        "_request_kwargs",
+    )
+
+    def __init__(
+        self,
+        method,
+        connection,
+        encoding=None,
+        offload_size=DEFAULT_OFFLOAD_SIZE,
+        timings=None,
+        limits=None,
+        spool_size=None,
+    ):
         self.method = method
         self.connection = connection
         self.headers = None
         self.content = None
         self.cookies = DictCookie()
         self.encoding = encoding
+        self.offload_size = offload_size
         self.status_code = None
         self.history = []
         self.request = None
+        self.timings = timings or Timings()
+        self.limits = limits or DEFAULT_LIMITS
+        # Bodies larger than this are kept in a temporary file, and `content`
+        # is a mmap of it
+        self.spool_size = spool_size
+        # (encoding, text) of the decoded content
+        self._text = None
+        self._json = None
+        self._json_loaded = False
+        # For streamed responses
+        self._consumed = False
+        self._session = None
+        # Arguments of the request which are not kept by the Request, to
+        # send it again
+        self._request_kwargs = {}
+        # Timeout of the request, its read timeout applies to streamed bodies
+        self.timeout = None
 
     def __repr__(self):
         return "<Response [{}]>".format(self.status_code)
 
-    async def receive(self):
+    @property
+    def url(self):
+        if self.request is None:
+            return None
+        return urlunparse(self.request.url_parse_result)
+
+    async def receive(self, stream=False):
+        """
+        Receive the response. With `stream`, only the headers are read, the
+        body is read by `iter_content` or `read`.
+        """
+
         http_response = HttpResonse(cookies=self.cookies, encoding=self.encoding)
         http_response_parser = HttpResponseParser(http_response)
 
         conn = self.connection
+        timings = self.timings
+        max_header_bytes = self.limits.max_header_bytes
+        start = time.monotonic()
 
-        # TODO, handle Maximum amount of incoming data to buffer
-        chucks = b""
+        chucks = await conn.readline()
+        timings.ttfb = time.monotonic() - start
         while True:
             chuck = await conn.readline()
             chucks += chuck
+            # Counted once the line is in, the blank line ending the headers too
+            if max_header_bytes is not None and len(chucks) > max_header_bytes:
+                raise ResponseTooLarge(
+                    "headers exceed {} bytes: {}".format(max_header_bytes, conn.key)
+                )
             if chuck == b"\r\n":
                 break
 
@@ -278,76 +564,379 @@ class Response(object):
         headers = http_response.headers
         self.headers = headers
 
-        # (protocol, status_code, ok), headers, cookies = parse_headers(chucks)
-        # self.headers = headers
-        # self.status_code = status_code
-        # self.cookies = cookies
+        if not self.encoding:
+            # find charset from content-type
+            encoding = find_encoding(self.headers.get("Content-Type", ""))
+            if encoding:
+                self.encoding = encoding
+
+        # These responses have no body
+        if (
+            self.method.lower() == "head"
+            or self.status_code in (204, 304)
+            or 100 <= self.status_code < 200
+        ):
+            self.content = b""
+            self.connection = None
+            return None
 
-        # TODO, handle redirect
+        # Do not wait for the body to know it is too large
+        max_body_bytes = self.limits.max_body_bytes
+        nbytes = self.headers.get("Content-Length")
+        if max_body_bytes is not None and nbytes and int(nbytes) > max_body_bytes:
+            raise ResponseTooLarge(
+                "Content-Length {} exceeds {} bytes".format(nbytes, max_body_bytes)
+            )
 
-        body = b""
-        if self.method.lower() == "head":  # HEAD
-            self.content = body
+        if stream:
             return None
 
+        start = time.monotonic()
+        if self.spool_size is None:
+            body = b"".join([chunk async for chunk in self._iter_raw()])
+        else:
+            body = SpooledBody(self.spool_size)
+            async for chunk in self._iter_raw(DEFAULT_CHUNK_SIZE):
+                body.write(chunk)
+        timings.transfer = time.monotonic() - start
+        # The connection goes back to the pool, do not hold it
+        self.connection = None
+
+        content_encoding = self.headers.get("Content-Encoding", "").lower()
+        if body and content_encoding in ("gzip", "deflate"):
+            max_size = self.limits.max_decompressed_bytes
+            if self.spool_size is not None:
+                decode = partial(
+                    decompress_spooled,
+                    content_encoding=content_encoding,
+                    max_size=max_size,
+                    spool_size=self.spool_size,
+                )
+            elif max_size is not None:
+                decode = partial(decode_limited, content_encoding, max_size=max_size)
+            elif content_encoding == "gzip":
+                decode = decode_gzip
+            else:
+                decode = decode_deflate
+            start = time.monotonic()
+            self.content = await self._offload(decode, body)
+            timings.decompress = time.monotonic() - start
+        elif self.spool_size is not None:
+            self.content = body.getvalue()
+        else:
+            self.content = body
+
+    async def _iter_raw(self, chunk_size=None):
+        """
+        Iterate over the body as it is sent, in blocks of at most chunk_size
+        """
+
+        conn = self.connection
+        headers = self.headers
+        max_size = self.limits.max_body_bytes
+        received = 0
+
         nbytes = headers.get("Content-Length")
         if nbytes:
-            nbytes = int(nbytes)
-        if nbytes:
-            body += await conn.read(nbytes)
-        else:
-            if headers.get("Transfer-Encoding") == "chunked":
-                blocks = []
-                while True:
-                    size_header = await conn.readline()
-                    if not size_header:
-                        # logging
+            remaining = int(nbytes)
+            while remaining > 0:
+                chunk = await conn.read(min(chunk_size or remaining, remaining))
+                remaining -= len(chunk)
+                yield chunk
+        elif headers.get("Transfer-Encoding", "").lower().endswith("chunked"):
+            while True:
+                size_header = await conn.readline()
+                if not size_header:
+                    # logging
+                    break
+
+                parts = size_header.split(b";")
+                size = int(parts[0], 16)
+                received += size
+                if max_size is not None and received > max_size:
+                    raise ResponseTooLarge(
+                        "chunked body exceeds {} bytes".format(max_size)
+                    )
+                if not size:
+                    # the last chunk, skip trailers
+                    while True:
+                        line = await conn.readline()
+                        if line in (b"\r\n", b"\n", b""):
+                            break
+                    break
+
+                while size:
+                    chunk = await conn.read(min(chunk_size or size, size))
+                    size -= len(chunk)
+                    yield chunk
+
+                crlf = await conn.readline()
+                assert crlf == b"\r\n", repr(crlf)
+        elif headers.get("Connection", "").lower() == "close":
+            # reading until EOF
+            while True:
+                chunk = await conn.read_some(chunk_size or DEFAULT_CHUNK_SIZE)
+                if not chunk:
+                    break
+                received += len(chunk)
+                if max_size is not None and received > max_size:
+                    raise ResponseTooLarge("body exceeds {} bytes".format(max_size))
+                yield chunk
+
+    async def iter_content(self, chunk_size=DEFAULT_CHUNK_SIZE):
+        """
+        Iterate over the decompressed body
+
+        For a streamed response, the body is read from the connection as it
+        arrives, and the connection is recycled once the body is consumed.
+        """
+
+        if self.content is not None:
+            for i in range(0, len(self.content), chunk_size):
+                yield self.content[i : i + chunk_size]
+            return
+
+        if self._consumed:
+            raise StreamConsumed(repr(self))
+        self._consumed = True
+
+        decompressor = make_decompressor(self.headers.get("Content-Encoding", ""))
+        max_size = self.limits.max_decompressed_bytes
+        decompressed = 0
+        read_timeout = self.timeout.read if self.timeout else None
+        deadline = Deadline(Timeout(read=read_timeout))
+        raw = self._iter_raw(chunk_size)
+        completed = False
+        try:
+            timings = self.timings
+            while True:
+                start = time.monotonic()
+                with deadline:
+                    deadline.phase("read", self.connection)
+                    try:
+                        chunk = await raw.__anext__()
+                    except StopAsyncIteration:
                         break
+                    finally:
+                        timings.transfer += time.monotonic() - start
 
-                    parts = size_header.split(b";")
-                    size = int(parts[0], 16)
-                    if size:
-                        block = await conn.read(size)
-                        assert len(block) == size, (
-                            "[Response.receive] [Transfer-Encoding]",
-                            len(block),
-                            size,
+                if decompressor is not None:
+                    start = time.monotonic()
+                    if max_size is None:
+                        chunk = decompressor.decompress(chunk)
+                    else:
+                        chunk = decompress_limited(
+                            decompressor, chunk, max_size - decompressed
                         )
-                        blocks.append(block)
+                        decompressed += len(chunk)
+                    timings.decompress += time.monotonic() - start
+                if chunk:
+                    yield chunk
+
+            if decompressor is not None:
+                start = time.monotonic()
+                chunk = decompressor.flush()
+                timings.decompress += time.monotonic() - start
+                if max_size is not None and decompressed + len(chunk) > max_size:
+                    raise ResponseTooLarge(
+                        "decompressed body exceeds {} bytes".format(max_size)
+                    )
+                if chunk:
+                    yield chunk
+            completed = True
+        finally:
+            self._release(completed)
+
+    async def read(self):
+        """
+        Read the whole body of a streamed response into `content`
+        """
+
+        if self.content is None:
+            if self.spool_size is None:
+                self.content = b"".join([chunk async for chunk in self.iter_content()])
+            else:
+                body = SpooledBody(self.spool_size)
+                async for chunk in self.iter_content():
+                    body.write(chunk)
+                self.content = body.getvalue()
+        return self.content
+
+    async def iter_lines(
+        self, chunk_size=DEFAULT_CHUNK_SIZE, max_line_size=DEFAULT_MAX_LINE_SIZE
+    ):
+        """
+        Iterate over the lines of the body, without line endings
+
+        Lines end with "\\r\\n", "\\n" or "\\r". At most max_line_size bytes
+        are buffered, LineTooLong is raised for longer lines.
+        """
+
+        buffer = b""
+        # A "\\r" ended the last chunk, the "\\n" of its "\\r\\n" may follow
+        after_cr = False
+        async for chunk in self.iter_content(chunk_size):
+            if after_cr and chunk.startswith(b"\n"):
+                chunk = chunk[1:]
+            after_cr = chunk.endswith(b"\r")
+
+            buffer += chunk
+            if b"\n" in chunk or b"\r" in chunk:
+                lines = LINE_ENDINGS.split(buffer)
+                buffer = lines.pop()
+                for line in lines:
+                    yield line
+
+            if len(buffer) > max_line_size:
+                self.close()
+                raise LineTooLong(
+                    "line exceeds {} bytes: {!r}".format(max_line_size, self)
+                )
+
+        if buffer:
+            yield buffer
+
+    async def iter_ndjson(
+        self, chunk_size=DEFAULT_CHUNK_SIZE, max_line_size=DEFAULT_MAX_LINE_SIZE
+    ):
+        """
+        Iterate over the objects of a newline-delimited json body
+        """
 
-                    crlf = await conn.readline()
-                    assert crlf == b"\r\n", repr(crlf)
-                    if not size:
-                        break
+        async for line in self.iter_lines(chunk_size, max_line_size):
+            if line.strip():
+                yield json.loads(line)
 
-                body += b"".join(blocks)
-            else:
-                # reading until EOF
-                pass
-                # body += await conn.read(-1)
-
-        if body and self.headers.get("Content-Encoding", "").lower() == "gzip":
-            self.content = decode_gzip(body)
-        elif body and self.headers.get("Content-Encoding", "").lower() == "deflate":
-            self.content = decode_deflate(body)
+    async def iter_events(self, reconnect=False, max_line_size=DEFAULT_MAX_LINE_SIZE):
+        """
+        Iterate over the events of a text/event-stream body
+
+        With `reconnect`, the request is sent again when the stream ends or
+        breaks, after the retry delay given by the server, with the
+        Last-Event-ID header. The server stops it by a non-200 response.
+        """
+
+        parser = SSEParser()
+        response = self
+        while True:
+            try:
+                async for line in response.iter_lines(max_line_size=max_line_size):
+                    event = parser.feed_line(line.decode("utf-8", errors="replace"))
+                    if event is not None:
+                        yield event
+            except (
+                ConnectionError,
+                ConnectionIsStale,
+                asyncio.IncompleteReadError,
+                asyncio.TimeoutError,
+            ) as err:
+                if not reconnect:
+                    raise err
+                logger.debug("[Response.iter_events]: stream breaks, {!r}".format(err))
+
+            if not reconnect or self._session is None:
+                return
+
+            parser.reset()
+            await asyncio.sleep(parser.retry_delay())
+            response = await self._reconnect(parser.last_event_id)
+            if response.status_code != 200:
+                response.close()
+                return
+
+    async def _reconnect(self, last_event_id=None):
+        request = self.request
+        headers = dict(request.headers)
+        if last_event_id:
+            headers["Last-Event-ID"] = last_event_id
+
+        return await self._session.request(
+            request.method,
+            urlunparse(request.url_parse_result),
+            headers=headers,
+            data=request.data,
+            proxy=request.proxy,
+            proxy_auth=request.proxy_auth,
+            encoding=self.encoding,
+            compress=request.compress,
+            stream=True,
+            **self._request_kwargs,
+        )
+
+    def _release(self, reusable):
+        conn = self.connection
+        if conn is None:
+            return
+
+        self.connection = None
+        if reusable and self._session is not None and self.method.lower() != "connect":
+            self._session.connection_pool.recycle_connection(conn)
         else:
-            self.content = body
+            conn.close()
 
-        if not self.encoding:
-            # find charset from content-type
-            encoding = find_encoding(self.headers.get("Content-Type", ""))
-            if encoding:
-                self.encoding = encoding
+    def close(self):
+        """
+        Close the connection of a streamed response whose body is not consumed
+        """
 
-    @property
-    def text(self):
+        if self.content is None and not self._consumed:
+            self._consumed = True
+            self._release(False)
+
+    async def _offload(self, func, data):
+        return await offload(func, data, self.offload_size)
+
+    def _decode(self, content):
         # TODO, use chardet to detect charset
         encoding = self.encoding or DEFAULT_ENCODING
 
-        return str(self.content, encoding, errors="replace")
+        text = str(content, encoding, errors="replace")
+        self._text = (encoding, text)
+        return text
+
+    def _cached_text(self):
+        encoding = self.encoding or DEFAULT_ENCODING
+        if self._text is not None and self._text[0] == encoding:
+            return self._text[1]
+        return None
+
+    @property
+    def text(self):
+        text = self._cached_text()
+        if text is None:
+            text = self._decode(self.content)
+        return text
+
+    async def atext(self):
+        """
+        Like `text`, but decode a big content in a thread
+        """
+
+        text = self._cached_text()
+        if text is None:
+            text = await self._offload(self._decode, self.content)
+        return text
 
     def json(self):
-        return json.loads(self.text)
+        """
+        The parsed json is cached, every call returns the same object
+        """
+
+        if not self._json_loaded:
+            self._json = json.loads(self.text)
+            self._json_loaded = True
+        return self._json
+
+    async def ajson(self):
+        """
+        Like `json()`, but decode and parse a big content in a thread
+        """
+
+        if not self._json_loaded:
+            text = await self.atext()
+            self._json = await self._offload(json.loads, text)
+            self._json_loaded = True
+        return self._json
 
 
 class DNSCache(Singleton):
@@ -369,6 +958,10 @@ class DNSCache(Singleton):
     def __repr__(self):
         return repr(dict(self.__hosts))
 
+    def __contains__(self, key):
+        # key is (host, port)
+        return key in self.__hosts
+
     async def get(self, host, port, uncache=False):
         if is_ip(host):
             return host, port
@@ -412,3 +1005,66 @@ class DNSCache(Singleton):
 
     def clear(self):
         self.__hosts.clear()
+
+
+class RedirectCache(object):
+    """
+    LRU cache of permanent redirections (301, 308)
+
+    `resolve` follows the cached redirections of a url, so the known hops are
+    not requested again. `hits` and `misses` count the lookups.
+    """
+
+    PERMANENT_STATUS_CODES = (301, 308)
+
+    def __init__(self, size=DEFAULT_REDIRECT_CACHE_SIZE):
+        self.size = size
+        self.hits = 0
+        self.misses = 0
+        # url -> (status code, location)
+        self.__redirects = OrderedDict()
+
+    def __repr__(self):
+        return "<RedirectCache: size: {}, hits: {}, misses: {}>".format(
+            len(self.__redirects), self.hits, self.misses
+        )
+
+    def __len__(self):
+        return len(self.__redirects)
+
+    def add(self, url, status_code, location):
+        if status_code not in self.PERMANENT_STATUS_CODES or not self.size:
+            return
+
+        self.__redirects[url] = (status_code, location)
+        self.__redirects.move_to_end(url)
+        while len(self.__redirects) > self.size:
+            self.__redirects.popitem(last=False)
+
+    def resolve(self, url):
+        """
+        Return the status codes of the cached hops from url and the final url
+        """
+
+        status_codes = []
+        seen = {url}
+        while True:
+            redirect = self.__redirects.get(url)
+            if redirect is None:
+                break
+            self.__redirects.move_to_end(url)
+            status_code, url = redirect
+            status_codes.append(status_code)
+            if url in seen:
+                # A loop is found by requesting it
+                break
+            seen.add(url)
+
+        if status_codes:
+            self.hits += 1
+        else:
+            self.misses += 1
+        return status_codes, url
+
+    def clear(self):
+        self.__redirects.clear()
@@ -0,0 +1,213 @@
+import io
+import os
+import uuid
+import asyncio
+import logging
+import mimetypes
+
+from mugen.exceptions import StreamConsumed
+
+logger = logging.getLogger(__name__)
+
+DEFAULT_CHUNK_SIZE = 64 * 1024
+# A file part is sent by sendfile in slices of this size, so the read
+# timeout sees the connection progressing
+DEFAULT_SENDFILE_SIZE = 8 * 1024 * 1024
+DEFAULT_CONTENT_TYPE = "application/octet-stream"
+
+
+def _quote(name):
+    # As browsers do, https://html.spec.whatwg.org/#multipart-form-data
+    return name.replace('"', "%22").replace("\r", "%0D").replace("\n", "%0A")
+
+
+def _file_size(fileobj):
+    """
+    The bytes left to read in fileobj, or None if it can not seek
+    """
+
+    try:
+        if not fileobj.seekable():
+            return None
+        position = fileobj.tell()
+        end = fileobj.seek(0, io.SEEK_END)
+        fileobj.seek(position)
+    except (AttributeError, OSError):
+        return None
+    return end - position
+
+
+def _fileno(fileobj):
+    """
+    The file descriptor of a binary file, which can be sent by sendfile
+    """
+
+    if "b" not in getattr(fileobj, "mode", ""):
+        return None
+    try:
+        return fileobj.fileno()
+    except (AttributeError, OSError):
+        return None
+
+
+class Part(object):
+    __slots__ = ("head", "body", "size", "start")
+
+    def __init__(self, head, body, size, start=None):
+        self.head = head
+        # bytes, or a file object read from its current position
+        self.body = body
+        self.size = size
+        # Where a file which can seek is read from, on each send
+        self.start = start
+
+    @property
+    def length(self):
+        if self.size is None:
+            return None
+        return len(self.head) + self.size + 2
+
+
+class MultipartEncoder(object):
+    """
+    A multipart/form-data request body, streamed with bounded memory
+
+    `fields` is a dict, or a list of (name, value) pairs. A value is a str or
+    bytes, a file object opened in binary mode, or a tuple of
+    (filename, file object or bytes[, content type]).
+
+        with open("report.csv", "rb") as f:
+            data = MultipartEncoder({"kind": "daily", "report": f})
+            await session.post(url, data=data)
+
+    File parts are read from disk as they are sent, or sent by
+    `loop.sendfile` on plain connections. `content_length` is known when
+    every file can seek, otherwise the body is sent chunked.
+
+    Files which can seek are read again from their first position each time
+    the body is sent, after a redirect or on a reconnection. A body with a
+    file which can not seek is sent once, then raises StreamConsumed.
+    """
+
+    def __init__(self, fields, boundary=None, chunk_size=DEFAULT_CHUNK_SIZE):
+        self.boundary = boundary or uuid.uuid4().hex
+        self.chunk_size = chunk_size
+        if isinstance(fields, dict):
+            fields = fields.items()
+        self.parts = [self._make_part(name, value) for name, value in fields]
+        self.closing = "--{}--\r\n".format(self.boundary).encode("latin-1")
+        self._sent = False
+
+    def __repr__(self):
+        return "<MultipartEncoder: parts: {}, content_length: {}>".format(
+            len(self.parts), self.content_length
+        )
+
+    @property
+    def content_type(self):
+        return "multipart/form-data; boundary={}".format(self.boundary)
+
+    @property
+    def content_length(self):
+        length = len(self.closing)
+        for part in self.parts:
+            if part.length is None:
+                return None
+            length += part.length
+        return length
+
+    def _make_part(self, name, value):
+        filename = None
+        content_type = None
+        if isinstance(value, tuple):
+            filename, value, *rest = value
+            if rest:
+                content_type = rest[0]
+        elif not isinstance(value, (str, bytes, bytearray)):
+            filename = os.path.basename(str(getattr(value, "name", name)))
+
+        lines = ["--{}".format(self.boundary)]
+        disposition = 'Content-Disposition: form-data; name="{}"'.format(_quote(name))
+        if filename is not None:
+            disposition += '; filename="{}"'.format(_quote(filename))
+            if content_type is None:
+                content_type = mimetypes.guess_type(filename)[0] or DEFAULT_CONTENT_TYPE
+        lines.append(disposition)
+        if content_type is not None:
+            lines.append("Content-Type: {}".format(content_type))
+        head = ("\r\n".join(lines) + "\r\n\r\n").encode("utf-8")
+
+        if isinstance(value, str):
+            value = value.encode("utf-8")
+        if isinstance(value, (bytes, bytearray)):
+            return Part(head, bytes(value), len(value))
+        size = _file_size(value)
+        return Part(head, value, size, value.tell() if size is not None else None)
+
+    def rewind(self):
+        """
+        Seek the files back to where the first send read them from
+        """
+
+        for part in self.parts:
+            if isinstance(part.body, bytes):
+                continue
+            if part.start is not None:
+                part.body.seek(part.start)
+            elif self._sent:
+                raise StreamConsumed(repr(self))
+        self._sent = True
+
+    async def _read(self, part):
+        # Disk reads are kept off the event loop
+        loop = asyncio.get_event_loop()
+        return await loop.run_in_executor(None, part.body.read, self.chunk_size)
+
+    def __aiter__(self):
+        return self._iter_blocks()
+
+    async def _iter_blocks(self):
+        self.rewind()
+        for part in self.parts:
+            yield part.head
+            if isinstance(part.body, bytes):
+                yield part.body
+            else:
+                while True:
+                    chunk = await self._read(part)
+                    if not chunk:
+                        break
+                    yield chunk
+            yield b"\r\n"
+        yield self.closing
+
+    async def send(self, conn, sendfile=True):
+        """
+        Write the body to the connection. File parts are sent by sendfile,
+        unless `sendfile` is False or they have no file descriptor.
+        """
+
+        self.rewind()
+        for part in self.parts:
+            conn.send(part.head)
+            if isinstance(part.body, bytes):
+                conn.send(part.body)
+            elif sendfile and part.size and _fileno(part.body) is not None:
+                logger.debug(
+                    "[MultipartEncoder.send]: sendfile {} bytes".format(part.size)
+                )
+                offset = part.start
+                end = offset + part.size
+                while offset < end:
+                    count = min(DEFAULT_SENDFILE_SIZE, end - offset)
+                    await conn.sendfile(part.body, offset, count)
+                    offset += count
+            else:
+                while True:
+                    chunk = await self._read(part)
+                    if not chunk:
+                        break
+                    conn.send(chunk)
+                    await conn.drain()
+            conn.send(b"\r\n")
+        conn.send(self.closing)
@@ -0,0 +1,191 @@
+from typing import List
+import queue
+import asyncio
+import logging
+import threading
+import multiprocessing
+from collections import namedtuple
+
+from mugen.session import Session
+from mugen.adapters import HTTPAdapter
+from mugen.connection_pool import ConnectionPool
+from mugen.models import DNSCache
+
+logger = logging.getLogger(__name__)
+
+DEFAULT_CONCURRENCY_PER_PROCESS = 50
+
+# `value` is what the handler returned for `item`, or `error` what it raised
+ParallelResult = namedtuple("ParallelResult", ["item", "value", "error"])
+
+FetchResult = namedtuple("FetchResult", ["url", "status_code", "headers", "content"])
+
+_DONE = "mugen.parallel.done"
+
+# Loops a forked worker inherited from its parent
+_parent_loops: List[asyncio.AbstractEventLoop] = []
+
+
+async def fetch(session, item):
+    """
+    The default handler of `run_parallel`
+
+    An item is an url, or a dict of the arguments of `Session.request`,
+    `method` defaults to "GET".
+    """
+
+    if isinstance(item, str):
+        item = {"url": item}
+
+    kwargs = dict(item)
+    method = kwargs.pop("method", "GET")
+    url = kwargs.pop("url")
+    response = await session.request(method, url, **kwargs)
+    return FetchResult(
+        url, response.status_code, dict(response.headers), response.content
+    )
+
+
+def _keep_parent_loop():
+    # The inherited loop shares its epoll instance with the parent. Closing
+    # it, as the garbage collector does, would unregister the file
+    # descriptors of the parent loop, so it is kept and never closed.
+    try:
+        _parent_loops.append(asyncio.get_event_loop())
+    except RuntimeError:
+        pass
+
+
+def _reset_singletons():
+    # A forked worker must not share the pool, the adapter and the dns cache
+    # of its parent, which belong to the parent's event loop
+    for cls in (ConnectionPool, HTTPAdapter, DNSCache):
+        if "_instances" in cls.__dict__:
+            del cls._instances
+
+
+async def _work(work_queue, result_queue, handler, concurrency, session_kwargs, loop):
+    session = Session(loop=loop, **session_kwargs)
+    items = asyncio.Queue(maxsize=concurrency)
+
+    async def feed():
+        while True:
+            item = await loop.run_in_executor(None, work_queue.get)
+            if item is None:
+                break
+            await items.put(item)
+        for _ in range(concurrency):
+            await items.put(None)
+
+    async def consume():
+        while True:
+            item = await items.get()
+            if item is None:
+                return
+            try:
+                value = await handler(session, item)
+            except Exception as err:
+                logger.debug("[run_parallel]: {!r} fails, {!r}".format(item, err))
+                result_queue.put(ParallelResult(item, None, err))
+            else:
+                result_queue.put(ParallelResult(item, value, None))
+
+    await asyncio.gather(feed(), *[consume() for _ in range(concurrency)])
+    session.close()
+
+
+def _worker(work_queue, result_queue, handler, concurrency, session_kwargs):
+    _keep_parent_loop()
+    _reset_singletons()
+    loop = asyncio.new_event_loop()
+    asyncio.set_event_loop(loop)
+    try:
+        loop.run_until_complete(
+            _work(work_queue, result_queue, handler, concurrency, session_kwargs, loop)
+        )
+    finally:
+        result_queue.put(_DONE)
+
+
+def run_parallel(
+    work_iterable,
+    handler=None,
+    processes=None,
+    concurrency_per_process=DEFAULT_CONCURRENCY_PER_PROCESS,
+    queue_size=None,
+    session_kwargs=None,
+    mp_context=None,
+):
+    """
+    Run the work items in worker processes, and yield `ParallelResult`s as
+    they complete
+
+    Every worker process has its own event loop, Session, ConnectionPool and
+    DNSCache, and handles `concurrency_per_process` items at once with
+    `await handler(session, item)`, by default `fetch`. Items are sent to
+    the workers through a queue bounded by `queue_size`, so the iterable can
+    be lazy and endless. Items, handler and results must be picklable.
+    """
+
+    handler = handler or fetch
+    processes = processes or multiprocessing.cpu_count()
+    queue_size = queue_size or processes * concurrency_per_process * 2
+    ctx = mp_context or multiprocessing.get_context()
+
+    work_queue = ctx.Queue(maxsize=queue_size)
+    result_queue = ctx.Queue()
+    workers = [
+        ctx.Process(
+            target=_worker,
+            args=(
+                work_queue,
+                result_queue,
+                handler,
+                concurrency_per_process,
+                session_kwargs or {},
+            ),
+            daemon=True,
+        )
+        for _ in range(processes)
+    ]
+    for worker in workers:
+        worker.start()
+
+    stopped = threading.Event()
+
+    def feed():
+        for item in work_iterable:
+            while not stopped.is_set():
+                try:
+                    work_queue.put(item, timeout=0.1)
+                    break
+                except queue.Full:
+                    continue
+            if stopped.is_set():
+                return
+        for _ in workers:
+            work_queue.put(None)
+
+    feeder = threading.Thread(target=feed, daemon=True)
+    feeder.start()
+
+    done = 0
+    try:
+        while done < len(workers):
+            try:
+                result = result_queue.get(timeout=1)
+            except queue.Empty:
+                if not any(worker.is_alive() for worker in workers):
+                    raise RuntimeError("mugen.run_parallel: worker processes died")
+                continue
+
+            if isinstance(result, ParallelResult):
+                yield result
+            else:
+                done += 1
+    finally:
+        stopped.set()
+        for worker in workers:
+            if done < len(workers):
+                worker.terminate()
+            worker.join()
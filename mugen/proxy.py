@@ -1,12 +1,13 @@
 from typing import Optional
 import logging
+import asyncio
 import socket
 import struct
 
 from urllib.parse import urlparse
 
-import mugen
-from mugen.utils import is_ip
+from mugen.models import HTTP_VERSION
+from mugen.utils import is_ip, base64encode
 
 logger = logging.getLogger(__name__)
 
@@ -15,6 +16,10 @@ class GeneralProxyError(Exception):
     pass
 
 
+class HTTPProxyError(Exception):
+    pass
+
+
 class SOCKS5AuthError(Exception):
     pass
 
@@ -23,6 +28,10 @@ class SOCKS5Error(Exception):
     pass
 
 
+class SOCKS4Error(Exception):
+    pass
+
+
 class ProxyNotPort(Exception):
     pass
 
@@ -69,147 +78,329 @@ async def _make_https_proxy_connection(
     host,
     port,
     proxy_auth: Optional[str] = None,
-    recycle=None,
 ):
-    url = "https://" + host
-    if port:
-        url = url + f":{port}"
+    """
+    Open a CONNECT tunnel through the http proxy and upgrade it to TLS
+
+    The CONNECT request is written directly to the connection, no Session or
+    Request is involved.
+    """
+
+    target = f"{host}:{port or 443}"
+    lines = [f"CONNECT {target} {HTTP_VERSION}", f"Host: {target}"]
+    if proxy_auth:
+        lines.append(f"Proxy-Authorization: Basic {base64encode(proxy_auth)}")
+    lines.append("Proxy-Connection: Keep-Alive")
+    conn.send(("\r\n".join(lines) + "\r\n\r\n").encode("utf-8"))
+
+    status_line = await conn.readline()
+    parts = status_line.split(None, 2)
+    if len(parts) < 2 or not parts[0].startswith(b"HTTP/") or not parts[1].isdigit():
+        raise HTTPProxyError(f"http proxy sent invalid data: {status_line!r}")
+
+    # Skip the response headers, a successful CONNECT response has no body
+    while True:
+        line = await conn.readline()
+        if not line:
+            raise HTTPProxyError("http proxy closed the connection")
+        if line in (b"\r\n", b"\n"):
+            break
+
+    status = int(parts[1])
+    if status != 200:
+        reason = status_line.decode("utf-8", errors="replace").strip()
+        raise HTTPProxyError(f"CONNECT {target} failed: {reason}")
 
-    await mugen.request(
-        "CONNECT", url, recycle=recycle, proxy_auth=proxy_auth, connection=conn
-    )
     await conn.ssl_handshake(host)
     return conn
 
 
-class Socks5Proxy:
-    def __init__(self, conn, dest_host, dest_port, ssl, username, password):
-        self.conn = conn
-        self.dest_host = dest_host
-        self.dest_port = dest_port
-        self.ssl = ssl
-        self.username = username
-        self.password = password
+def _to_bytes(value):
+    if value is None:
+        return b""
+    if isinstance(value, str):
+        return value.encode("utf-8")
+    return value
 
-    async def init(self):
-        # 1. connect to socks server and to authorize
-        await self.auth()
 
-        # 2. let socks server to connect dest_host
-        await self.connect()
+class Socks5Handshake:
+    """
+    Sans-IO state machine of a SOCKS5 client handshake (RFC 1928, RFC 1929)
 
-        # 3. SSL/TLS handshake
-        if self.ssl:
-            await self.connect_ssl()
+    `initial()` gives the bytes to send first. Then, until `done`, read exactly
+    `need` bytes, `feed` them, and send what `feed` returns.
 
-        self.conn.socks_on = True
+    With `pipeline`, only the method we are going to use is offered, so the
+    greeting, the authentication and the CONNECT request are sent in one
+    flight and the handshake costs a single round trip.
 
-    async def auth(self):
-        logger.debug("[Socks5Proxy.init.auth]: {}".format(self.conn))
+    A domain name is sent to the server as is, to be resolved remotely.
+    """
 
-        # sending the authentication packages we support.
-        if self.username and self.password:
-            self.conn.send(b"\x05\x02\x00\x02")
-        else:
-            # VER, NMETHODS, and at least 1 METHODS
-            self.conn.send(b"\x05\x01\x00")
+    METHOD, AUTH, REPLY, REPLY_ADDR, DONE = range(5)
 
-        chosen_auth = await self.conn.read(2)
+    def __init__(
+        self, dest_host, dest_port, username=None, password=None, pipeline=True
+    ):
+        self.dest_host = dest_host
+        self.dest_port = dest_port
+        self.username = _to_bytes(username)
+        self.password = _to_bytes(password)
+        self.pipeline = pipeline
+        self.state = self.METHOD
+        self.need = 2
+        self.bound_address = None
+        self._atyp = None
+        self._addr_head = b""
+
+        if len(self.username) > 255 or len(self.password) > 255:
+            raise SOCKS5AuthError("SOCKS5 username and password must be <= 255 bytes")
+
+    @property
+    def done(self):
+        return self.state == self.DONE
+
+    def initial(self):
+        if self.pipeline:
+            if self.username:
+                return b"\x05\x01\x02" + self.auth_request() + self.connect_request()
+            return b"\x05\x01\x00" + self.connect_request()
+
+        # VER, NMETHODS, and at least 1 METHODS
+        if self.username:
+            return b"\x05\x02\x00\x02"
+        return b"\x05\x01\x00"
+
+    def auth_request(self):
+        return (
+            b"\x01"
+            + bytes([len(self.username)])
+            + self.username
+            + bytes([len(self.password)])
+            + self.password
+        )
+
+    def connect_request(self):
+        # VER, CMD (CONNECT), RSV
+        header = b"\x05\x01\x00"
+        port = struct.pack(">H", self.dest_port)
+
+        for family, atyp in ((socket.AF_INET, b"\x01"), (socket.AF_INET6, b"\x04")):
+            try:
+                return header + atyp + socket.inet_pton(family, self.dest_host) + port
+            except (socket.error, ValueError):
+                continue
+
+        host = self.dest_host.encode("idna")
+        return header + b"\x03" + bytes([len(host)]) + host + port
 
-        if chosen_auth[0:1] != b"\x05":
+    def feed(self, data):
+        """
+        Consume `need` bytes, return the bytes which must be sent next
+        """
+
+        assert len(data) == self.need, (len(data), self.need)
+
+        if self.state == self.METHOD:
+            return self._on_method(data)
+        elif self.state == self.AUTH:
+            return self._on_auth(data)
+        elif self.state == self.REPLY:
+            return self._on_reply(data)
+        elif self.state == self.REPLY_ADDR:
+            return self._on_reply_addr(data)
+        raise GeneralProxyError("SOCKS5 handshake is already done")
+
+    def _on_method(self, data):
+        if data[0] != 0x05:
             raise GeneralProxyError("SOCKS5 proxy server sent invalid data")
 
-        if chosen_auth[1:2] == b"\x02":
+        method = data[1]
+        if method == 0xFF:
+            raise SOCKS5AuthError(
+                "All offered SOCKS5 authentication methods were rejected"
+            )
+        elif method == 0x02 and self.username:
             # Okay, we need to perform a basic username/password
             # authentication.
-            self.conn.send(
-                b"\x01"
-                + chr(len(self.username)).encode()
-                + self.username
-                + chr(len(self.password)).encode()
-                + self.password
-            )
-
-            auth_status = await self.conn.reader.read()
-            if auth_status[0:1] != b"\x01":
-                # Bad response
-                raise GeneralProxyError("SOCKS5 proxy server sent invalid data")
-            if auth_status[1:2] != b"\x00":
-                # Authentication failed
-                raise SOCKS5AuthError("SOCKS5 authentication failed")
-
-        # No authentication is required if 0x00
-        elif chosen_auth[1:2] != b"\x00":
-            # Reaching here is always bad
-            if chosen_auth[1:2] == b"\xFF":
-                raise SOCKS5AuthError(
-                    "All offered SOCKS5 authentication methods were rejected"
-                )
-            else:
-                raise GeneralProxyError("SOCKS5 proxy server sent invalid data")
-        # Otherwise, authentication succeeded
-
-    async def connect(self):
-        logger.debug("[Socks5Proxy.init.connect]: {}".format(self.conn))
-
-        cmd = b"\x01"  # CONNECT
-        # Now we can request the actual connection
-        header = b"\x05" + cmd + b"\x00"
-
-        family_to_byte = {socket.AF_INET: b"\x01", socket.AF_INET6: b"\x04"}
-        for family in (socket.AF_INET, socket.AF_INET6, None):
-            if not family:
-                self.conn.send(
-                    header
-                    + b"\x03"
-                    + bytes([len(self.dest_host)])
-                    + self.dest_host.encode("utf-8")
-                    + struct.pack(">H", self.dest_port)
-                )
-                break
+            self.state, self.need = self.AUTH, 2
+            return b"" if self.pipeline else self.auth_request()
+        elif method == 0x00 and not (self.pipeline and self.username):
+            # No authentication is required
+            self.state, self.need = self.REPLY, 5
+            return b"" if self.pipeline else self.connect_request()
+
+        # Reaching here is always bad
+        raise GeneralProxyError("SOCKS5 proxy server sent invalid data")
+
+    def _on_auth(self, data):
+        if data[0] != 0x01:
+            # Bad response
+            raise GeneralProxyError("SOCKS5 proxy server sent invalid data")
+        if data[1] != 0x00:
+            # Authentication failed
+            raise SOCKS5AuthError("SOCKS5 authentication failed")
 
-            try:
-                addr_bytes = socket.inet_pton(family, self.dest_host)
-                self.conn.send(
-                    header
-                    + family_to_byte[family]
-                    + addr_bytes
-                    + struct.pack(">H", self.dest_port)
-                )
-                break
-            except socket.error:
-                continue
+        self.state, self.need = self.REPLY, 5
+        return b"" if self.pipeline else self.connect_request()
 
-        # Get the response
-        resp = await self.conn.read(3)
-        if resp[0:1] != b"\x05":
+    def _on_reply(self, data):
+        # VER, REP, RSV, ATYP and the first byte of BND.ADDR
+        if data[0] != 0x05:
             raise GeneralProxyError("SOCKS5 proxy server sent invalid data")
 
-        status = ord(resp[1:2])
+        status = data[1]
         if status != 0x00:
             # Connection failed: server returned an error
             error = SOCKS5_ERRORS.get(status, "Unknown error")
             raise SOCKS5Error("{0:#04x}: {1}".format(status, error))
 
-        # Get the bound address/port
-        tp = await self.conn.read(1)
-        if tp == b"\x01":
-            chk = await self.conn.read(4)
+        self._atyp = data[3]
+        self._addr_head = data[4:5]
+        if self._atyp == 0x01:
+            need = 3 + 2
+        elif self._atyp == 0x03:
+            need = data[4] + 2
+            self._addr_head = b""
+        elif self._atyp == 0x04:
+            need = 15 + 2
+        else:
+            raise GeneralProxyError("SOCKS5 proxy server sent invalid data")
+
+        self.state, self.need = self.REPLY_ADDR, need
+        return b""
+
+    def _on_reply_addr(self, data):
+        chk = self._addr_head + data[:-2]
+        if self._atyp == 0x01:
             addr = socket.inet_ntoa(chk)
-        elif tp == b"\x03":
-            length = await self.conn.read(1)
-            addr = await self.conn.read(ord(length))
-        elif tp == b"\x04":
-            chk = await self.conn.read(16)
+        elif self._atyp == 0x04:
             addr = socket.inet_ntop(socket.AF_INET6, chk)
         else:
-            raise GeneralProxyError("SOCKS5 proxy server sent invalid data")
+            addr = chk.decode("utf-8", errors="replace")
+
+        port = struct.unpack(">H", data[-2:])[0]
+        self.bound_address = (addr, port)
+        self.state, self.need = self.DONE, 0
+        return b""
+
+
+class Socks4Handshake:
+    """
+    Sans-IO state machine of a SOCKS4/SOCKS4a client handshake
+
+    A domain name is resolved remotely with the SOCKS4a extension.
+    """
+
+    REPLY, DONE = range(2)
+
+    def __init__(self, dest_host, dest_port, userid=None):
+        self.dest_host = dest_host
+        self.dest_port = dest_port
+        self.userid = _to_bytes(userid)
+        self.state = self.REPLY
+        self.need = 8
+        self.bound_address = None
+
+    @property
+    def done(self):
+        return self.state == self.DONE
+
+    def initial(self):
+        # VN, CD (CONNECT), DSTPORT
+        header = b"\x04\x01" + struct.pack(">H", self.dest_port)
+        try:
+            return header + socket.inet_aton(self.dest_host) + self.userid + b"\x00"
+        except (socket.error, ValueError):
+            # SOCKS4a: DSTIP is 0.0.0.x and the host follows the user id
+            host = self.dest_host.encode("idna")
+            return header + b"\x00\x00\x00\x01" + self.userid + b"\x00" + host + b"\x00"
+
+    def feed(self, data):
+        assert len(data) == self.need, (len(data), self.need)
+
+        if self.state != self.REPLY:
+            raise GeneralProxyError("SOCKS4 handshake is already done")
+        if data[0] != 0x00:
+            raise GeneralProxyError("SOCKS4 proxy server sent invalid data")
+
+        status = data[1]
+        if status != 0x5A:
+            error = SOCKS4_ERRORS.get(status, "Unknown error")
+            raise SOCKS4Error("{0:#04x}: {1}".format(status, error))
+
+        port = struct.unpack(">H", data[2:4])[0]
+        self.bound_address = (socket.inet_ntoa(data[4:8]), port)
+        self.state, self.need = self.DONE, 0
+        return b""
+
+
+class Socks5Proxy:
+    def __init__(
+        self,
+        conn,
+        dest_host,
+        dest_port,
+        ssl,
+        username,
+        password,
+        pipeline=True,
+        server_hostname=None,
+    ):
+        self.conn = conn
+        self.dest_host = dest_host
+        self.dest_port = dest_port
+        self.ssl = ssl
+        self.username = username
+        self.password = password
+        self.pipeline = pipeline
+        self.server_hostname = server_hostname or dest_host
+
+    async def init(self):
+        # 1. authorize and let socks server to connect dest_host
+        await self.negotiate()
+
+        # 2. SSL/TLS handshake
+        if self.ssl:
+            await self.connect_ssl()
+
+        self.conn.socks_on = True
 
-        pt = await self.conn.read(2)
-        port = struct.unpack(">H", pt)[0]
-        return addr, port
+    def make_handshake(self):
+        return Socks5Handshake(
+            self.dest_host,
+            self.dest_port,
+            username=self.username,
+            password=self.password,
+            pipeline=self.pipeline,
+        )
+
+    async def negotiate(self):
+        logger.debug("[Socks5Proxy.negotiate]: {}".format(self.conn))
+
+        handshake = self.make_handshake()
+        self.conn.send(handshake.initial())
+
+        # Replies are parsed from the buffer of the stream reader
+        reader = self.conn.reader
+        while not handshake.done:
+            try:
+                data = await reader.readexactly(handshake.need)
+            except asyncio.IncompleteReadError:
+                raise GeneralProxyError("SOCKS proxy server closed the connection")
+
+            data = handshake.feed(data)
+            if data:
+                self.conn.send(data)
+
+        return handshake.bound_address
 
     async def connect_ssl(self):
         logger.debug("[Socks5Proxy.connect_ssl]: {}".format(self.conn))
-        await self.conn.ssl_handshake(self.dest_host)
+        await self.conn.ssl_handshake(self.server_hostname)
         self.conn.ssl_on = True
+
+
+class Socks4Proxy(Socks5Proxy):
+    def make_handshake(self):
+        return Socks4Handshake(self.dest_host, self.dest_port, userid=self.username)
@@ -0,0 +1,158 @@
+import time
+import asyncio
+import logging
+from email.utils import parsedate_to_datetime
+
+logger = logging.getLogger(__name__)
+
+# Status codes telling that we are too fast
+THROTTLE_STATUS_CODES = (429, 503)
+
+
+def parse_retry_after(value, now=None):
+    """
+    Return the seconds to wait given by a Retry-After header, or None
+    """
+
+    if not value:
+        return None
+
+    value = value.strip()
+    if value.isdigit():
+        return float(value)
+
+    try:
+        date = parsedate_to_datetime(value)
+    except (TypeError, ValueError, IndexError):
+        return None
+    return max(0.0, date.timestamp() - (now or time.time()))
+
+
+def host_key(request):
+    return request.url_parse_result.hostname
+
+
+class TokenBucket(object):
+    __slots__ = ("rate", "max_rate", "burst", "tokens", "updated", "hold_until")
+
+    def __init__(self, rate, burst, now):
+        self.rate = rate
+        self.max_rate = rate
+        self.burst = burst
+        self.tokens = burst
+        self.updated = now
+        self.hold_until = 0.0
+
+    def __repr__(self):
+        return "<TokenBucket: rate: {:.2f}/s, tokens: {:.2f}>".format(
+            self.rate, self.tokens
+        )
+
+    def refill(self, now):
+        self.tokens = min(self.burst, self.tokens + (now - self.updated) * self.rate)
+        self.updated = now
+
+    def reserve(self, now):
+        """
+        Take a token, return the seconds to wait until it is available
+
+        Tokens are reserved ahead, the balance goes negative, so concurrent
+        callers are spaced by 1/rate without waking each other up.
+        """
+
+        self.refill(now)
+        self.tokens -= 1
+        if self.tokens < 0:
+            return -self.tokens / self.rate
+        return 0.0
+
+    def pause(self, seconds, now):
+        """
+        Give no token for the next seconds
+        """
+
+        self.refill(now)
+        self.tokens = min(self.tokens, 0) - seconds * self.rate
+
+
+class RateLimiter(object):
+    """
+    Token-bucket rate limiting per key, by default per host
+
+    `rate` is the requests per second allowed for a key, `rates` overrides it
+    for some keys, and `burst` is the size of the buckets. `key` computes the
+    key of a Request.
+
+    If `adaptive`, the rate of a key is halved on 429/503 responses, at most
+    once per `hold` seconds, as the requests already sent answer alike. The
+    key is paused for Retry-After seconds, and the rate grows back by
+    `increase` requests per second on each other response.
+    """
+
+    def __init__(
+        self,
+        rate,
+        burst=None,
+        rates=None,
+        key=None,
+        adaptive=True,
+        min_rate=0.1,
+        increase=None,
+        hold=1.0,
+    ):
+        for value in [rate, *(rates or {}).values()]:
+            if value <= 0:
+                raise ValueError("rate must be positive, NOT {!r}".format(value))
+
+        self.rate = rate
+        self.burst = burst or max(1, rate)
+        self.rates = rates or {}
+        self.key = key or host_key
+        self.adaptive = adaptive
+        self.min_rate = min_rate
+        self.increase = increase or max(rate / 20, 0.05)
+        self.hold = hold
+        self.__buckets = {}
+
+    def __repr__(self):
+        return "<RateLimiter: rate: {}/s, keys: {}>".format(
+            self.rate, len(self.__buckets)
+        )
+
+    def get_bucket(self, key):
+        bucket = self.__buckets.get(key)
+        if bucket is None:
+            rate = self.rates.get(key, self.rate)
+            bucket = TokenBucket(rate, self.burst, time.monotonic())
+            self.__buckets[key] = bucket
+        return bucket
+
+    async def acquire(self, key):
+        delay = self.get_bucket(key).reserve(time.monotonic())
+        if delay > 0:
+            logger.debug("[RateLimiter.acquire]: {} waits {:.3f}s".format(key, delay))
+            await asyncio.sleep(delay)
+
+    def feedback(self, key, response):
+        """
+        Adapt the rate of key to the response
+        """
+
+        if not self.adaptive:
+            return
+
+        bucket = self.get_bucket(key)
+        if response.status_code in THROTTLE_STATUS_CODES:
+            now = time.monotonic()
+            bucket.refill(now)
+            if now >= bucket.hold_until:
+                bucket.rate = max(self.min_rate, bucket.rate / 2)
+                bucket.hold_until = now + self.hold
+            retry_after = parse_retry_after(response.headers.get("Retry-After"))
+            if retry_after:
+                bucket.pause(retry_after, now)
+            logger.debug(
+                "[RateLimiter.feedback]: slow down {}, {!r}".format(key, bucket)
+            )
+        elif bucket.rate < bucket.max_rate:
+            bucket.rate = min(bucket.max_rate, bucket.rate + self.increase)
@@ -0,0 +1,120 @@
+import asyncio
+import logging
+import heapq
+import itertools
+
+from collections import defaultdict
+
+from mugen.ratelimit import host_key
+
+logger = logging.getLogger(__name__)
+
+
+class Scheduler(object):
+    """
+    Share `max_active` request slots between hosts, or tenants
+
+    A request waits for a slot before it takes a connection from the pool,
+    and holds it until its response is received. Waiting requests with a
+    higher `priority` are served first. Requests of the same priority are
+    served by weighted fair queuing across keys: a key with weight 2 gets
+    twice the slots of a key with weight 1 while both are waiting.
+
+    No key holds more than `max_per_key` slots, half of `max_active` by
+    default, so one busy host can not take the whole budget.
+    """
+
+    def __init__(self, max_active, max_per_key=None, weights=None, key=None):
+        self.max_active = max_active
+        if max_per_key is None:
+            max_per_key = max(1, max_active // 2)
+        self.max_per_key = max_per_key
+        self.weights = weights or {}
+        self.key = key or host_key
+        self.active = 0
+        self.__active_keys = defaultdict(int)
+        # key -> heap of (-priority, virtual start, seq, future)
+        self.__waiters = {}
+        self.__last_tags = {}
+        self.__virtual_time = 0.0
+        self.__seq = itertools.count()
+
+    def __repr__(self):
+        return "<Scheduler: active: {}/{}, waiting keys: {}>".format(
+            self.active, self.max_active, len(self.__waiters)
+        )
+
+    def waiting(self):
+        return sum(
+            1
+            for waiters in self.__waiters.values()
+            for *_, future in waiters
+            if not future.done()
+        )
+
+    def _available(self, key):
+        return (
+            self.active < self.max_active
+            and self.__active_keys.get(key, 0) < self.max_per_key
+        )
+
+    def _take(self, key):
+        self.active += 1
+        self.__active_keys[key] += 1
+
+    async def acquire(self, key, priority=0):
+        if key not in self.__waiters and self._available(key):
+            self._take(key)
+            return
+
+        weight = self.weights.get(key, 1)
+        tag = max(self.__virtual_time, self.__last_tags.get(key, 0.0))
+        self.__last_tags[key] = tag + 1.0 / weight
+
+        future = asyncio.get_event_loop().create_future()
+        heapq.heappush(
+            self.__waiters.setdefault(key, []),
+            (-priority, tag, next(self.__seq), future),
+        )
+        try:
+            await future
+        except asyncio.CancelledError:
+            if future.done() and not future.cancelled():
+                # The slot was given to us just before the cancellation
+                self.release(key)
+            raise
+
+    def release(self, key):
+        self.active -= 1
+        self.__active_keys[key] -= 1
+        if not self.__active_keys[key]:
+            del self.__active_keys[key]
+        self._wakeup()
+
+    def _wakeup(self):
+        while self.active < self.max_active:
+            best = None
+            for key, waiters in list(self.__waiters.items()):
+                # Drop waiters which are cancelled
+                while waiters and waiters[0][-1].done():
+                    heapq.heappop(waiters)
+                if not waiters:
+                    del self.__waiters[key]
+                    self.__last_tags.pop(key, None)
+                    continue
+                if self.__active_keys.get(key, 0) >= self.max_per_key:
+                    continue
+                if best is None or waiters[0] < self.__waiters[best][0]:
+                    best = key
+
+            if best is None:
+                return
+
+            waiters = self.__waiters[best]
+            _, tag, _, future = heapq.heappop(waiters)
+            if not waiters:
+                del self.__waiters[best]
+                self.__last_tags.pop(best, None)
+            self.__virtual_time = max(self.__virtual_time, tag)
+            self._take(best)
+            future.set_result(None)
@@ -1,14 +1,21 @@
+import time
 import logging
 import asyncio
-from urllib.parse import urljoin
+from urllib.parse import urljoin, urlparse
 
-from mugen.cookies import DictCookie
-from mugen.connection_pool import ConnectionPool
+from mugen.cookies import CookieJar
+from mugen.connection_pool import ConnectionPool, AdaptiveLimits
 from mugen.connect import Connection
 from mugen.adapters import HTTPAdapter
-from mugen.structures import CaseInsensitiveDict
+from mugen.ratelimit import RateLimiter
+from mugen.scheduler import Scheduler
+from mugen.timeouts import Timeout, Deadline
+from mugen.structures import CaseInsensitiveDict, Timings
 from mugen.models import (
     Request,
+    RedirectRecord,
+    RedirectCache,
+    DEFAULT_REDIRECT_CACHE_SIZE,
     DNSCache,
     DEFAULT_REDIRECT_LIMIT,
     MAX_CONNECTION_POOL,
@@ -16,6 +23,7 @@ from mugen.models import (
     MAX_REDIRECTIONS,
     DEFAULT_ENCODING,
 )
+from mugen.utils import redirect_method
 from mugen.exceptions import RedirectLoop, TooManyRedirections
 
 logger = logging.getLogger(__name__)
@@ -30,6 +38,16 @@ class Session(object):
         encoding=None,
         max_pool=MAX_CONNECTION_POOL,
         max_tasks=MAX_POOL_TASKS,
+        rate_limit=None,
+        scheduler=None,
+        timeout=None,
+        adaptive_pool=False,
+        unix_socket=None,
+        limits=None,
+        compress=None,
+        spool_size=None,
+        full_history=True,
+        redirect_cache_size=DEFAULT_REDIRECT_CACHE_SIZE,
         loop=None,
     ):
         logger.debug(
@@ -42,24 +60,60 @@ class Session(object):
         if headers:
             self.headers.update(headers)
 
-        self.cookies = DictCookie()
+        # Cookies given here are sent to every host
+        self.cookies = CookieJar()
         if cookies:
-            self.cookies = DictCookie.update(cookies)
+            self.cookies.update(cookies)
 
         self.recycle = recycle
         self.encoding = encoding
 
         self.max_redirects = DEFAULT_REDIRECT_LIMIT
+        # A Timeout, or the total timeout in seconds
+        self.timeout = timeout
+        # Path of a unix socket to send the requests to, instead of the host
+        self.unix_socket = unix_socket
+        # Size limits of the responses, a Limits
+        self.limits = limits
+        # Response bodies larger than this are kept in a temporary file
+        self.spool_size = spool_size
+        # Content coding of the request bodies, "gzip" or "deflate"
+        self.compress = compress
+        # Keep the redirected responses in `response.history`, or only their
+        # status, headers and url
+        self.full_history = full_history
+        # Permanent redirections, 0 disables the cache
+        self.redirect_cache = None
+        if redirect_cache_size:
+            self.redirect_cache = RedirectCache(redirect_cache_size)
         self.loop = loop or asyncio.get_event_loop()
 
         self.connection_pool = ConnectionPool(
             recycle=recycle, max_pool=max_pool, max_tasks=max_tasks, loop=self.loop
         )
+        # The pool is shared by the sessions of the loop, `adaptive_pool`
+        # limits the connections this session takes, True or an AdaptiveLimits
+        if adaptive_pool is True:
+            adaptive_pool = AdaptiveLimits(max_per_host=max_tasks)
+        self.adaptive_pool = adaptive_pool or None
         self.adapter = HTTPAdapter(
             self.connection_pool, recycle=recycle, loop=self.loop
         )
         self.dns_cache = DNSCache(loop=self.loop)
 
+        # `rate_limit` is requests per second per host, or a RateLimiter
+        if rate_limit is not None and not isinstance(rate_limit, RateLimiter):
+            rate_limit = RateLimiter(rate_limit)
+        self.rate_limiter = rate_limit
+
+        # `scheduler` is the number of requests in flight, or a Scheduler
+        if scheduler is not None and not isinstance(scheduler, Scheduler):
+            scheduler = Scheduler(scheduler)
+        self.scheduler = scheduler
+
+        # Tasks keeping warmed up connections in the pool
+        self._warmers = []
+
     async def request(
         self,
         method,
@@ -75,13 +129,22 @@ class Session(object):
         encoding=None,
         timeout=None,
         connection=None,
+        stream=False,
+        unix_socket=None,
+        limits=None,
+        compress=None,
+        priority=0,
+        tenant=None,
     ):
         if recycle is None:
             recycle = self.recycle
 
-        if allow_redirects:
-            response = await asyncio.wait_for(
-                self._redirect(
+        if timeout is None:
+            timeout = self.timeout
+        deadline = Deadline(Timeout.make(timeout), loop=self.loop)
+        with deadline:
+            if allow_redirects:
+                response = await self._redirect(
                     method,
                     url,
                     params=params,
@@ -94,12 +157,16 @@ class Session(object):
                     recycle=recycle,
                     encoding=encoding,
                     connection=connection,
-                ),
-                timeout=timeout,
-            )
-        else:
-            response = await asyncio.wait_for(
-                self._request(
+                    stream=stream,
+                    unix_socket=unix_socket,
+                    limits=limits,
+                    compress=compress,
+                    priority=priority,
+                    tenant=tenant,
+                    deadline=deadline,
+                )
+            else:
+                response = await self._request(
                     method,
                     url,
                     params=params,
@@ -112,9 +179,14 @@ class Session(object):
                     recycle=recycle,
                     encoding=encoding,
                     connection=connection,
-                ),
-                timeout=timeout,
-            )
+                    stream=stream,
+                    unix_socket=unix_socket,
+                    limits=limits,
+                    compress=compress,
+                    priority=priority,
+                    tenant=tenant,
+                    deadline=deadline,
+                )
 
         return response
 
@@ -132,6 +204,13 @@ class Session(object):
         recycle=None,
         encoding=None,
         connection=None,
+        stream=False,
+        unix_socket=None,
+        limits=None,
+        compress=None,
+        priority=0,
+        tenant=None,
+        deadline=None,
     ):
         logger.debug(
             "[Session.request]: "
@@ -149,8 +228,9 @@ class Session(object):
         if recycle is None:
             recycle = self.recycle
 
-        if cookies:
-            self.cookies.update(cookies)
+        if deadline is None:
+            # Not timed
+            deadline = Deadline(Timeout(read=None), loop=self.loop)
 
         if headers is None or not dict(headers):
             headers = self.headers
@@ -165,23 +245,146 @@ class Session(object):
             proxy_auth=proxy_auth,
             cookies=self.cookies,
             encoding=encoding,
+            compress=compress or self.compress,
+        )
+
+        # Cookies given to a request are kept for its host
+        hostname = request.url_parse_result.hostname or ""
+        if cookies:
+            self.cookies.update(cookies, domain=hostname, host_only=True)
+
+        timings = Timings()
+        start = time.monotonic()
+
+        # Wait for our turn before taking a connection from the pool
+        if self.rate_limiter:
+            rate_key = self.rate_limiter.key(request)
+            await self.rate_limiter.acquire(rate_key)
+
+        # Wait for a free slot when the in-flight requests are scheduled
+        if self.scheduler:
+            slot_key = tenant or self.scheduler.key(request)
+            deadline.phase("pool_acquire")
+            await self.scheduler.acquire(slot_key, priority=priority)
+            timings.queue = time.monotonic() - start
+            try:
+                response = await self._exchange(
+                    method,
+                    request,
+                    proxy=proxy,
+                    proxy_auth=proxy_auth,
+                    recycle=recycle,
+                    encoding=encoding,
+                    connection=connection,
+                    stream=stream,
+                    unix_socket=unix_socket,
+                    limits=limits,
+                    deadline=deadline,
+                    timings=timings,
+                )
+            finally:
+                self.scheduler.release(slot_key)
+        else:
+            timings.queue = time.monotonic() - start
+            response = await self._exchange(
+                method,
+                request,
+                proxy=proxy,
+                proxy_auth=proxy_auth,
+                recycle=recycle,
+                encoding=encoding,
+                connection=connection,
+                stream=stream,
+                unix_socket=unix_socket,
+                limits=limits,
+                deadline=deadline,
+                timings=timings,
+            )
+        deadline.phase(None)
+
+        if self.rate_limiter:
+            self.rate_limiter.feedback(rate_key, response)
+
+        # update cookies
+        set_cookies = response.headers.getall("Set-Cookie")
+        if set_cookies:
+            self.cookies.extract(
+                set_cookies, hostname, request.url_parse_result.path or "/"
+            )
+        response.cookies = self.cookies
+        response.request = request
+        response._session = self
+        response.timeout = deadline.timeout
+        response._request_kwargs = dict(
+            recycle=recycle,
+            timeout=deadline.timeout,
+            unix_socket=unix_socket,
+            limits=limits,
+            priority=priority,
+            tenant=tenant,
         )
 
+        return response
+
+    async def _exchange(
+        self,
+        method,
+        request,
+        proxy=None,
+        proxy_auth=None,
+        recycle=None,
+        encoding=None,
+        connection=None,
+        stream=False,
+        unix_socket=None,
+        limits=None,
+        deadline=None,
+        timings=None,
+    ):
+        unix_socket = unix_socket or self.unix_socket
+        limits = limits or self.limits
+
         # Make connection
         if not connection:
+            deadline.phase("connect")
             host, *_ = request.url_parse_result.netloc.split(":", 1)
             ssl = request.url_parse_result.scheme.lower() == "https"
             port = request.url_parse_result.port
             if not port:
                 port = 443 if ssl else 80
 
-            if proxy:
+            if unix_socket:
+                if proxy:
+                    raise ValueError("proxy can not be used with unix_socket")
+                conn = await self.adapter.generate_unix_connect(
+                    unix_socket,
+                    host,
+                    ssl,
+                    recycle=recycle,
+                    timings=timings,
+                    adaptive=self.adaptive_pool,
+                )
+            elif proxy:
                 conn = await self.adapter.generate_proxy_connect(
-                    host, port, ssl, proxy, proxy_auth, self.dns_cache, recycle=recycle
+                    host,
+                    port,
+                    ssl,
+                    proxy,
+                    proxy_auth,
+                    self.dns_cache,
+                    recycle=recycle,
+                    timings=timings,
+                    adaptive=self.adaptive_pool,
                 )
             else:
                 conn = await self.adapter.generate_direct_connect(
-                    host, port, ssl, self.dns_cache, recycle=recycle
+                    host,
+                    port,
+                    ssl,
+                    self.dns_cache,
+                    recycle=recycle,
+                    timings=timings,
+                    adaptive=self.adaptive_pool,
                 )
         else:
             if not isinstance(connection, Connection):
@@ -191,29 +394,36 @@ class Session(object):
 
             conn = connection
 
+        deadline.phase("read", conn)
         try:
             # send request
-            await self.adapter.send_request(conn, request)
-        except Exception as err:
+            await self.adapter.send_request(conn, request, timings=timings)
+        except (Exception, asyncio.CancelledError) as err:
             logger.debug("[Session._request]: send_request error, {}".format(err))
             logger.warning("Close connect at request: %s", conn)
-            conn.close()
+            conn.close(error=True)
             raise err
 
         try:
             # receive response
-            response = await self.adapter.get_response(method, conn, encoding=encoding)
-        except Exception as err:
+            response = await self.adapter.get_response(
+                method,
+                conn,
+                encoding=encoding,
+                stream=stream,
+                timings=timings,
+                limits=limits,
+                spool_size=self.spool_size,
+            )
+        except (Exception, asyncio.CancelledError) as err:
             logger.debug("[Session._request]: get_response error, {}".format(err))
             logger.warning("Close connect at response: %s", conn)
-            conn.close()
+            conn.close(error=True)
             raise err
 
-        # update cookies
-        self.cookies.update(response.cookies)
-        response.cookies = self.cookies
-
-        if method.lower() != "connect":
+        # A streamed body still to be read keeps the connection, it is
+        # recycled by the response once the body is consumed
+        if method.lower() != "connect" and response.content is not None:
             self.connection_pool.recycle_connection(conn)
 
         return response
@@ -232,20 +442,34 @@ class Session(object):
         recycle=None,
         encoding=None,
         connection=None,
+        stream=False,
+        unix_socket=None,
+        limits=None,
+        compress=None,
+        priority=0,
+        tenant=None,
+        deadline=None,
     ):
         if recycle is None:
             recycle = self.recycle
 
         history = []
         _URL = url
-        base_url = url
         redirect_urls = set()
 
         while True:
             if len(redirect_urls) > MAX_REDIRECTIONS:
                 raise TooManyRedirections(_URL)
 
-            redirect_urls.add(url)
+            # Skip the permanent redirections we know
+            # Urls with params are not cached
+            if self.redirect_cache is not None and not params:
+                status_codes, url = self.redirect_cache.resolve(url)
+                for status_code in status_codes:
+                    method, data = redirect_method(status_code, method, data)
+            base_url = url
+
+            redirect_urls.add((method, url))
             response = await self._request(
                 method,
                 url,
@@ -259,17 +483,13 @@ class Session(object):
                 recycle=recycle,
                 encoding=encoding,
                 connection=connection,
-            )
-
-            response.request = Request(
-                method,
-                url,
-                params=params,
-                headers=headers,
-                data=data,
-                proxy=proxy,
-                cookies=cookies,
-                encoding=encoding,
+                stream=stream,
+                unix_socket=unix_socket,
+                limits=limits,
+                compress=compress,
+                priority=priority,
+                tenant=tenant,
+                deadline=deadline,
             )
 
             if not response.headers.get("Location"):
@@ -279,14 +499,25 @@ class Session(object):
             # XXX, not store responses in self.history, which could be used by other
             # coroutines
 
+            if response.content is None:
+                # Read the streamed body, so its connection can be recycled
+                await response.read()
+
             location = response.headers["Location"]
             url = urljoin(base_url, location)
-            base_url = url
+            if self.redirect_cache is not None and not params:
+                self.redirect_cache.add(base_url, response.status_code, url)
+            method, data = redirect_method(response.status_code, method, data)
 
-            if url in redirect_urls:
+            if (method, url) in redirect_urls:
                 raise RedirectLoop(url)
 
-            history.append(response)
+            if self.full_history:
+                history.append(response)
+            else:
+                history.append(
+                    RedirectRecord(response.status_code, response.headers, response.url)
+                )
 
     async def head(
         self,
@@ -300,6 +531,12 @@ class Session(object):
         encoding=None,
         timeout=None,
         connection=None,
+        stream=False,
+        unix_socket=None,
+        limits=None,
+        compress=None,
+        priority=0,
+        tenant=None,
     ):
         if recycle is None:
             recycle = self.recycle
@@ -316,6 +553,12 @@ class Session(object):
             encoding=encoding,
             timeout=timeout,
             connection=connection,
+            stream=stream,
+            unix_socket=unix_socket,
+            limits=limits,
+            compress=compress,
+            priority=priority,
+            tenant=tenant,
         )
         return response
 
@@ -331,6 +574,12 @@ class Session(object):
         encoding=None,
         timeout=None,
         connection=None,
+        stream=False,
+        unix_socket=None,
+        limits=None,
+        compress=None,
+        priority=0,
+        tenant=None,
     ):
         if recycle is None:
             recycle = self.recycle
@@ -347,6 +596,12 @@ class Session(object):
             encoding=encoding,
             timeout=timeout,
             connection=connection,
+            stream=stream,
+            unix_socket=unix_socket,
+            limits=limits,
+            compress=compress,
+            priority=priority,
+            tenant=tenant,
         )
         return response
 
@@ -363,6 +618,12 @@ class Session(object):
         encoding=None,
         timeout=None,
         connection=None,
+        stream=False,
+        unix_socket=None,
+        limits=None,
+        compress=None,
+        priority=0,
+        tenant=None,
     ):
         if recycle is None:
             recycle = self.recycle
@@ -380,9 +641,96 @@ class Session(object):
             encoding=encoding,
             timeout=timeout,
             connection=connection,
+            stream=stream,
+            unix_socket=unix_socket,
+            limits=limits,
+            compress=compress,
+            priority=priority,
+            tenant=tenant,
         )
         return response
 
+    async def warmup(self, origins, keep_warm=None, timeout=None):
+        """
+        Open connections before the first requests and park them in the
+        connection pool
+
+        `origins` maps an origin to the number of idle connections wanted,
+        such as {"https://example.com": 10, "http://example.org:8080": 2}. A
+        bare host is an https origin. The connections are opened and TLS
+        handshaked concurrently. With `keep_warm`, the pools are topped up
+        every keep_warm seconds until the session is closed.
+
+        Return the number of connections opened for each origin.
+        """
+
+        targets = {}
+        for origin, size in origins.items():
+            url = urlparse(origin if "://" in origin else "https://" + origin)
+            ssl = url.scheme.lower() == "https"
+            port = url.port or (443 if ssl else 80)
+            targets[origin] = (url.hostname, port, ssl, size)
+
+        opened = await self._warm(targets, timeout)
+        if keep_warm:
+            self._warmers.append(
+                asyncio.ensure_future(self._keep_warm(targets, keep_warm, timeout))
+            )
+        return opened
+
+    async def _warm(self, targets, timeout=None):
+        counts = await asyncio.gather(
+            *[
+                self._top_up(host, port, ssl, size, timeout)
+                for host, port, ssl, size in targets.values()
+            ]
+        )
+        return dict(zip(targets, counts))
+
+    async def _keep_warm(self, targets, interval, timeout=None):
+        while True:
+            await asyncio.sleep(interval)
+            try:
+                await self._warm(targets, timeout)
+            except Exception as err:
+                logger.error("[Session._keep_warm]: {}".format(err))
+
+    async def _top_up(self, host, port, ssl, size, timeout=None):
+        key = await self.adapter.direct_key(host, port, ssl, self.dns_cache)
+        if self.adaptive_pool is not None:
+            # Start the adaptive pool at the demand we expect
+            limit = self.adaptive_pool.get_limit(key)
+            limit.target = max(limit.target, min(size, self.adaptive_pool.max_per_host))
+        missing = size - self.connection_pool.count_idle(key)
+        if missing <= 0:
+            return 0
+
+        results = await asyncio.gather(
+            *[self._open_connection(key, timeout) for _ in range(missing)],
+            return_exceptions=True,
+        )
+        errors = [result for result in results if isinstance(result, BaseException)]
+        if errors:
+            logger.warning(
+                "[Session.warmup]: {} of {} connections to {} failed, {!r}".format(
+                    len(errors), missing, key, errors[0]
+                )
+            )
+        return missing - len(errors)
+
+    async def _open_connection(self, key, timeout=None):
+        if timeout is None:
+            timeout = self.timeout
+        conn = self.connection_pool.make_connection(key, recycle=True)
+        with Deadline(Timeout.make(timeout), loop=self.loop) as deadline:
+            deadline.phase("connect")
+            try:
+                await conn.connect()
+            except asyncio.CancelledError:
+                conn.close()
+                raise
+        self.connection_pool.recycle_connection(conn)
+
     def clear(self):
         """
         Reset cookies and headers to empty
@@ -398,6 +746,9 @@ class Session(object):
         """
 
         # self.adapter.close()   # No sense
+        for warmer in self._warmers:
+            warmer.cancel()
+        self._warmers = []
         self.connection_pool.clear()
         self.dns_cache.clear()
         self.headers = self.cookies = self.dns_cache = None
@@ -0,0 +1,87 @@
+# Seconds to wait before reconnecting, if the server does not give it
+DEFAULT_SSE_RETRY = 3
+
+
+class ServerSentEvent(object):
+    __slots__ = ("event", "data", "id")
+
+    def __init__(self, event="message", data="", id=None):
+        self.event = event
+        self.data = data
+        self.id = id
+
+    def __repr__(self):
+        return "<ServerSentEvent: event={!r}, id={!r}, data={!r}>".format(
+            self.event, self.id, self.data
+        )
+
+
+class SSEParser(object):
+    """
+    Parser of text/event-stream lines
+
+    https://html.spec.whatwg.org/multipage/server-sent-events.html
+
+    The last event id and the retry delay are kept across connections, for
+    reconnecting.
+    """
+
+    def __init__(self):
+        self.last_event_id = None
+        # milliseconds
+        self.retry = None
+        self._event = None
+        self._data = []
+
+    def reset(self):
+        """
+        Drop the event being read, which a broken stream never ends. The last
+        event id and the retry delay are kept.
+        """
+
+        self._event = None
+        self._data = []
+
+    def retry_delay(self):
+        if self.retry is None:
+            return DEFAULT_SSE_RETRY
+        return self.retry / 1000
+
+    def feed_line(self, line):
+        """
+        Feed a line without its line ending, return the event dispatched by
+        a blank line, or None
+        """
+
+        if not line:
+            return self._dispatch()
+
+        if line.startswith(":"):
+            # comment
+            return None
+
+        field, sep, value = line.partition(":")
+        if value.startswith(" "):
+            value = value[1:]
+
+        if field == "data":
+            self._data.append(value)
+        elif field == "event":
+            self._event = value
+        elif field == "id":
+            if "\0" not in value:
+                self.last_event_id = value
+        elif field == "retry":
+            if value.isdigit():
+                self.retry = int(value)
+        return None
+
+    def _dispatch(self):
+        data, event = self._data, self._event
+        self._data, self._event = [], None
+        if not data:
+            return None
+
+        return ServerSentEvent(
+            event=event or "message", data="\n".join(data), id=self.last_event_id
+        )
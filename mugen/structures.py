@@ -1,11 +1,10 @@
-from collections import OrderedDict
 from collections.abc import MutableMapping
 
 
 class CaseInsensitiveDict(MutableMapping):
     def __init__(self, *args, **kwargs):
-        self._store = OrderedDict()
-        self._map = {}
+        # lower key -> (key, value)
+        self._store = {}
 
         self.update(*args, **kwargs)
 
@@ -13,7 +12,7 @@ class CaseInsensitiveDict(MutableMapping):
         if isinstance(key, str):
             key = key.lower()
 
-        return self._store[key]
+        return self._store[key][1]
 
     def __setitem__(self, key, value):
         if isinstance(key, str):
@@ -21,19 +20,169 @@ class CaseInsensitiveDict(MutableMapping):
         else:
             lower_key = key
 
-        self._store[lower_key] = value
-        self._map[lower_key] = key
+        self._store[lower_key] = (key, value)
 
     def __delitem__(self, key):
         if isinstance(key, str):
             key = key.lower()
 
         self._store.pop(key)
-        self._map.pop(key)
 
     def __iter__(self):
-        for k in self._map.values():
+        for k, _ in self._store.values():
             yield k
 
     def __len__(self):
         return len(self._store)
+
+
+class ResponseHeaders(MutableMapping):
+    """
+    Case-insensitive headers of a response
+
+    The header fields are kept as the raw bytes received. Names are lowercased
+    when the headers are first looked up, and values are decoded only when
+    they are accessed. Repeated fields are kept apart, `getall` returns all of
+    them, while `headers[name]` joins them with ", ".
+    """
+
+    __slots__ = ("_fields", "_index", "encoding")
+
+    def __init__(self, encoding="utf-8"):
+        # [(name, value)], as bytes when received
+        self._fields = []
+        # lowered bytes name -> [value]
+        self._index = None
+        self.encoding = encoding
+
+    def __repr__(self):
+        return "<ResponseHeaders: {!r}>".format(dict(self.items()))
+
+    def _encode(self, name):
+        if isinstance(name, str):
+            return name.encode(self.encoding)
+        return name
+
+    def _decode(self, value):
+        if isinstance(value, bytes):
+            return value.decode(self.encoding)
+        return value
+
+    def _get_index(self):
+        if self._index is None:
+            index = {}
+            for name, value in self._fields:
+                index.setdefault(self._encode(name).lower(), []).append(value)
+            self._index = index
+        return self._index
+
+    def add(self, name, value):
+        """
+        Append a header field, repeated fields are kept
+        """
+
+        self._fields.append((name, value))
+        if self._index is not None:
+            self._index.setdefault(self._encode(name).lower(), []).append(value)
+
+    def getall(self, name, default=None):
+        values = self._get_index().get(self._encode(name).lower())
+        if values is None:
+            return [] if default is None else default
+        return [self._decode(value) for value in values]
+
+    def get(self, name, default=None):
+        values = self._get_index().get(self._encode(name).lower())
+        if values is None:
+            return default
+        if len(values) == 1:
+            return self._decode(values[0])
+        return ", ".join([self._decode(value) for value in values])
+
+    def __getitem__(self, name):
+        value = self.get(name)
+        if value is None:
+            raise KeyError(name)
+        return value
+
+    def __contains__(self, name):
+        return self._encode(name).lower() in self._get_index()
+
+    def __setitem__(self, name, value):
+        if name in self:
+            del self[name]
+        self.add(name, value)
+
+    def __delitem__(self, name):
+        lower_name = self._encode(name).lower()
+        if lower_name not in self._get_index():
+            raise KeyError(name)
+
+        self._fields = [
+            field
+            for field in self._fields
+            if self._encode(field[0]).lower() != lower_name
+        ]
+        self._index = None
+
+    def __iter__(self):
+        seen = set()
+        for name, _ in self._fields:
+            lower_name = self._encode(name).lower()
+            if lower_name not in seen:
+                seen.add(lower_name)
+                yield self._decode(name)
+
+    def __len__(self):
+        return len(self._get_index())
+
+
+class Timings(object):
+    """
+    Where a request spent its time, in seconds
+
+    `queue` is the wait for the rate limiter, the scheduler and the pool.
+    `ttfb` is from the request sent to the first byte of the response,
+    `transfer` is the reading of the body after the headers. `reused` tells
+    if the connection had served other requests, `reuse_count` how many.
+    """
+
+    __slots__ = (
+        "queue",
+        "dns",
+        "connect",
+        "tls",
+        "proxy",
+        "ttfb",
+        "transfer",
+        "decompress",
+        "reused",
+        "reuse_count",
+    )
+
+    def __init__(self):
+        self.queue = 0.0
+        self.dns = 0.0
+        self.connect = 0.0
+        self.tls = 0.0
+        self.proxy = 0.0
+        self.ttfb = 0.0
+        self.transfer = 0.0
+        self.decompress = 0.0
+        self.reused = False
+        self.reuse_count = 0
+
+    def __repr__(self):
+        return "<Timings: {}>".format(
+            ", ".join(
+                (
+                    "{}: {:.6f}".format(name, value)
+                    if isinstance(value, float)
+                    else "{}: {}".format(name, value)
+                )
+                for name, value in self.as_dict().items()
+            )
+        )
+
+    def as_dict(self):
+        return {name: getattr(self, name) for name in self.__slots__}
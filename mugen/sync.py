@@ -0,0 +1,135 @@
+import asyncio
+import logging
+import threading
+from concurrent.futures import CancelledError
+
+from mugen.session import Session
+from mugen.models import MAX_CONNECTION_POOL, MAX_POOL_TASKS
+
+logger = logging.getLogger(__name__)
+
+
+class SyncSession(object):
+    """
+    A blocking Session, for synchronous code
+
+    The Session runs on an event loop in a background thread, so its
+    connection pool, dns cache and cookies live across calls. `request`,
+    `get`, `post` and `head` block the calling thread until the response is
+    received, and are safe to call from many threads at once. The threads
+    share the warm pooled connections, which are not shared with the
+    sessions of other loops, and are closed with the SyncSession.
+
+        with mugen.SyncSession() as session:
+            resp = session.get("http://example.com")
+    """
+
+    def __init__(
+        self,
+        headers=None,
+        cookies=None,
+        recycle=True,
+        encoding=None,
+        max_pool=MAX_CONNECTION_POOL,
+        max_tasks=MAX_POOL_TASKS,
+    ):
+        self._lock = threading.Lock()
+        self._closed = False
+        self.loop = asyncio.new_event_loop()
+        self._thread = threading.Thread(
+            target=self._run, name="mugen-sync-session", daemon=True
+        )
+        self._thread.start()
+
+        async def make_session():
+            # The Session must be created on its loop
+            return Session(
+                headers=headers,
+                cookies=cookies,
+                recycle=recycle,
+                encoding=encoding,
+                max_pool=max_pool,
+                max_tasks=max_tasks,
+                loop=self.loop,
+            )
+
+        self.session = self._call(make_session())
+
+    def __repr__(self):
+        return "<SyncSession: closed: {}>".format(self._closed)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
+
+    def _run(self):
+        asyncio.set_event_loop(self.loop)
+        self.loop.run_forever()
+
+    def _submit(self, coro):
+        # Under the lock, nothing is submitted once close() begins
+        with self._lock:
+            if self._closed:
+                coro.close()
+                raise RuntimeError("SyncSession is closed")
+            return asyncio.run_coroutine_threadsafe(coro, self.loop)
+
+    def _call(self, coro):
+        future = self._submit(coro)
+        try:
+            return future.result()
+        except CancelledError:
+            # Cancelled by close()
+            if self._closed:
+                raise RuntimeError("SyncSession is closed") from None
+            raise
+
+    @property
+    def cookies(self):
+        return self.session.cookies
+
+    @property
+    def headers(self):
+        return self.session.headers
+
+    def request(self, method, url, **kwargs):
+        return self._call(self.session.request(method, url, **kwargs))
+
+    def head(self, url, **kwargs):
+        return self._call(self.session.head(url, **kwargs))
+
+    def get(self, url, **kwargs):
+        return self._call(self.session.get(url, **kwargs))
+
+    def post(self, url, **kwargs):
+        return self._call(self.session.post(url, **kwargs))
+
+    def close(self):
+        """
+        Close the session and its connections, then stop the loop thread
+
+        The calls still running fail with RuntimeError.
+        """
+
+        async def shutdown():
+            self.session.close()
+            current = asyncio.current_task()
+            tasks = [task for task in asyncio.all_tasks() if task is not current]
+            for task in tasks:
+                task.cancel()
+            # The futures of the calls are settled before the loop stops
+            await asyncio.gather(*tasks, return_exceptions=True)
+
+        with self._lock:
+            if self._closed:
+                return
+            self._closed = True
+            future = asyncio.run_coroutine_threadsafe(shutdown(), self.loop)
+
+        future.result()
+        self.loop.call_soon_threadsafe(self.loop.stop)
+        self._thread.join()
+        self.loop.close()
+        logger.debug("[SyncSession.close]: DONE")
@@ -0,0 +1,163 @@
+import asyncio
+import logging
+
+from mugen.exceptions import (
+    RequestTimeout,
+    PoolTimeout,
+    ConnectTimeout,
+    ReadTimeout,
+)
+
+logger = logging.getLogger(__name__)
+
+DEFAULT_READ_TIMEOUT = 1 * 60
+
+
+class Timeout(object):
+    """
+    Time budgets of a request, in seconds, None is no limit
+
+    `total` covers the whole request, redirections included. `pool_acquire`
+    is the wait for a free slot of the session scheduler, `connect` covers
+    dns, tcp, tls and proxy handshakes, and `read` is the longest time
+    without receiving data from the server.
+    """
+
+    __slots__ = ("total", "connect", "pool_acquire", "read")
+
+    def __init__(
+        self, total=None, connect=None, pool_acquire=None, read=DEFAULT_READ_TIMEOUT
+    ):
+        self.total = total
+        self.connect = connect
+        self.pool_acquire = pool_acquire
+        self.read = read
+
+    def __repr__(self):
+        return "<Timeout: total: {}, connect: {}, pool_acquire: {}, read: {}>".format(
+            self.total, self.connect, self.pool_acquire, self.read
+        )
+
+    @classmethod
+    def make(cls, value):
+        """
+        A number is the total timeout, None is the default timeout
+        """
+
+        if isinstance(value, cls):
+            return value
+        if value is None:
+            return DEFAULT_TIMEOUT
+        return cls(total=value)
+
+
+DEFAULT_TIMEOUT = Timeout()
+
+PHASE_ERRORS = {
+    "pool_acquire": PoolTimeout,
+    "connect": ConnectTimeout,
+    "read": ReadTimeout,
+}
+
+
+class Deadline(object):
+    """
+    The single timer of a request
+
+    The timer is set at the nearest of the total deadline and the deadline of
+    the current phase, and cancels the request task when it expires. The
+    read phase is not re-armed for every read: the timer checks how long the
+    connection has been idle when it fires, and sleeps again if data came in
+    meanwhile.
+
+        with Deadline(timeout) as deadline:
+            deadline.phase("connect")
+            ...
+            deadline.phase("read", conn)
+            ...
+    """
+
+    def __init__(self, timeout, loop=None):
+        self.timeout = timeout
+        self.loop = loop or asyncio.get_event_loop()
+        self.task = None
+        self.expires = None
+        self.current = None
+        self.phase_expires = None
+        self.connection = None
+        self.expired = None
+        self._handle = None
+
+    def __repr__(self):
+        return "<Deadline: phase: {}, expired: {}>".format(self.current, self.expired)
+
+    def __enter__(self):
+        self.task = asyncio.current_task(self.loop)
+        self.expired = None
+        if self.timeout.total is not None:
+            self.expires = self.loop.time() + self.timeout.total
+            self._schedule()
+        return self
+
+    def __exit__(self, exc_type, exc, tb):
+        self._cancel_timer()
+        if self.expired is None or exc_type is not asyncio.CancelledError:
+            return False
+
+        uncancel = getattr(self.task, "uncancel", None)
+        if uncancel is not None:  # Python 3.11+
+            uncancel()
+        error = PHASE_ERRORS.get(self.expired, RequestTimeout)
+        raise error("{} timeout".format(self.expired)) from None
+
+    def phase(self, name, connection=None):
+        """
+        Enter the phase `name`, None leaves only the total deadline
+        """
+
+        self.current = name
+        self.connection = connection
+        budget = getattr(self.timeout, name) if name else None
+        if budget is None:
+            self.phase_expires = None
+        else:
+            self.phase_expires = self.loop.time() + budget
+        self._schedule()
+
+    def _schedule(self):
+        when = self.expires
+        if self.phase_expires is not None:
+            when = self.phase_expires if when is None else min(when, self.phase_expires)
+
+        if when is None:
+            self._cancel_timer()
+            return
+        if self._handle is not None:
+            if self._handle.when() <= when:
+                # Fires earlier, then it will be put off
+                return
+            self._handle.cancel()
+        self._handle = self.loop.call_at(when, self._expire)
+
+    def _cancel_timer(self):
+        if self._handle is not None:
+            self._handle.cancel()
+            self._handle = None
+
+    def _expire(self):
+        self._handle = None
+        now = self.loop.time()
+        if self.expires is not None and now >= self.expires:
+            self.expired = "total"
+        else:
+            if self.current == "read" and self.phase_expires is not None:
+                if self.connection is not None:
+                    idle_expires = now + self.timeout.read - self.connection.idle()
+                    self.phase_expires = max(self.phase_expires, idle_expires)
+            if self.phase_expires is None or now < self.phase_expires:
+                self._schedule()
+                return
+            self.expired = self.current
+
+        logger.debug("[Deadline._expire]: {!r}".format(self))
+        self.task.cancel()
@@ -1,5 +1,6 @@
 from typing import Union
 import json
+import asyncio
 import re
 import gzip
 import zlib
@@ -9,6 +10,7 @@ from urllib.parse import urlparse
 
 from mugen.cookies import DictCookie
 from mugen.structures import CaseInsensitiveDict
+from mugen.exceptions import ResponseTooLarge
 
 
 def default_headers():
@@ -132,6 +134,128 @@ def decode_deflate(content):
         return zlib.decompress(content, -zlib.MAX_WBITS)
 
 
+class DeflateDecompressor(object):
+    """
+    Incremental decompressor of the "deflate" content coding, which is sent
+    zlib wrapped or raw
+    """
+
+    def __init__(self):
+        self._obj = None
+
+    def decompress(self, data, max_length=0):
+        if self._obj is None:
+            try:
+                obj = zlib.decompressobj()
+                content = obj.decompress(data, max_length)
+            except zlib.error:
+                obj = zlib.decompressobj(-zlib.MAX_WBITS)
+                content = obj.decompress(data, max_length)
+            self._obj = obj
+            return content
+        return self._obj.decompress(data, max_length)
+
+    @property
+    def unconsumed_tail(self):
+        if self._obj is None:
+            return b""
+        return self._obj.unconsumed_tail
+
+    def flush(self):
+        if self._obj is None:
+            return b""
+        return self._obj.flush()
+
+
+def make_decompressor(content_encoding):
+    """
+    Return an incremental decompressor for the content coding, or None
+    """
+
+    content_encoding = content_encoding.lower()
+    if content_encoding == "gzip":
+        return zlib.decompressobj(16 + zlib.MAX_WBITS)
+    elif content_encoding == "deflate":
+        return DeflateDecompressor()
+    return None
+
+
+def make_compressor(content_encoding):
+    """
+    Return an incremental compressor for the content coding, "gzip" or
+    "deflate" (zlib wrapped)
+    """
+
+    content_encoding = content_encoding.lower()
+    if content_encoding == "gzip":
+        return zlib.compressobj(wbits=16 + zlib.MAX_WBITS)
+    elif content_encoding == "deflate":
+        return zlib.compressobj()
+    raise ValueError("unknown content coding: {!r}".format(content_encoding))
+
+
+def encode_content(content_encoding, content):
+    compressor = make_compressor(content_encoding)
+    return compressor.compress(content) + compressor.flush()
+
+
+async def offload(func, data, offload_size):
+    """
+    Call func(data) in the default executor if data is larger than
+    offload_size, so big payloads do not block the event loop
+    """
+
+    if offload_size is None or len(data) <= offload_size:
+        return func(data)
+
+    loop = asyncio.get_event_loop()
+    return await loop.run_in_executor(None, func, data)
+
+
+def decompress_limited(decompressor, data, max_size):
+    """
+    Decompress data with an incremental decompressor, and raise
+    ResponseTooLarge as soon as it gives more than max_size bytes
+    """
+
+    content = decompressor.decompress(data, max_size + 1)
+    if len(content) > max_size or decompressor.unconsumed_tail:
+        raise ResponseTooLarge("decompressed body exceeds {} bytes".format(max_size))
+    return content
+
+
+def decode_limited(content_encoding, content, max_size):
+    """
+    Like decode_gzip and decode_deflate, with at most max_size bytes of
+    decompressed content
+    """
+
+    decompressor = make_decompressor(content_encoding)
+    content = decompress_limited(decompressor, content, max_size)
+    content += decompressor.flush()
+    if len(content) > max_size:
+        raise ResponseTooLarge("decompressed body exceeds {} bytes".format(max_size))
+    return content
+
+
+def parse_keep_alive(value):
+    """
+    Return (timeout, max) of a Keep-Alive header, None for what is missing
+
+        >>> parse_keep_alive("timeout=5, max=100")
+        (5, 100)
+    """
+
+    params = {}
+    for param in value.split(","):
+        name, _, number = param.partition("=")
+        try:
+            params[name.strip().lower()] = int(number.strip())
+        except ValueError:
+            continue
+    return params.get("timeout"), params.get("max")
+
+
 def find_encoding(content_type):
     if "charset" in content_type.lower():
         chucks = content_type.split(";")
@@ -149,3 +273,37 @@ def base64encode(buf: Union[str, bytes]) -> str:
         buf = buf.encode("utf-8")
 
     return base64.b64encode(buf).decode("utf-8")
+
+
+def install_fast_loop():
+    """
+    Use uvloop as the event loop policy if it is installed
+
+    Call it before any Session is created, the connection pool, the adapter
+    and the dns cache keep the loop they were created with.
+    Return True if uvloop is used.
+    """
+
+    try:
+        import uvloop
+    except ImportError:
+        return False
+
+    asyncio.set_event_loop_policy(uvloop.EventLoopPolicy())
+    return True
+
+
+def redirect_method(status_code, method, data=None):
+    """
+    Return the method and the data of the request following a redirection
+
+    303 changes the method to GET, and so does 301/302 for POST, as browsers
+    do. The body is dropped with the method.
+    """
+
+    method = method.upper()
+    if (status_code == 303 and method != "HEAD") or (
+        status_code in (301, 302) and method == "POST"
+    ):
+        return "GET", None
+    return method, data
@@ -0,0 +1,452 @@
+"""
+Local stand-in servers for tests and benchmarks.
+
+Every server listens on 127.0.0.1 with an ephemeral port, so no network
+access is needed.
+"""
+
+import os
+import ssl
+import shutil
+import asyncio
+import subprocess
+import threading
+from urllib.parse import urlparse
+
+
+def make_self_signed_cert(directory):
+    """
+    Create a self-signed certificate for localhost/127.0.0.1 with openssl.
+
+    Return (certfile, keyfile), or None if openssl is not available.
+    """
+
+    if not shutil.which("openssl"):
+        return None
+
+    certfile = os.path.join(directory, "cert.pem")
+    keyfile = os.path.join(directory, "key.pem")
+    subprocess.run(
+        [
+            "openssl",
+            "req",
+            "-x509",
+            "-newkey",
+            "rsa:2048",
+            "-nodes",
+            "-days",
+            "1",
+            "-subj",
+            "/CN=localhost",
+            "-addext",
+            "subjectAltName=DNS:localhost,IP:127.0.0.1",
+            "-keyout",
+            keyfile,
+            "-out",
+            certfile,
+        ],
+        check=True,
+        stdout=subprocess.DEVNULL,
+        stderr=subprocess.DEVNULL,
+    )
+    return certfile, keyfile
+
+
+def server_ssl_context(certfile, keyfile):
+    context = ssl.create_default_context(ssl.Purpose.CLIENT_AUTH)
+    context.load_cert_chain(certfile, keyfile)
+    return context
+
+
+async def _relay(reader, writer):
+    try:
+        while True:
+            data = await reader.read(65536)
+            if not data:
+                break
+            writer.write(data)
+            await writer.drain()
+    except (ConnectionError, asyncio.CancelledError):
+        pass
+    finally:
+        writer.close()
+
+
+class StandInRequest(object):
+    def __init__(self, method, target, headers, body):
+        self.method = method
+        self.target = target
+        self.path = urlparse(target).path or "/"
+        self.headers = headers
+        self.body = body
+
+
+class StandInResponse(object):
+    """
+    `body` is bytes, or a list of bytes which is sent chunked. The body, and
+    every chunk, are sent `delay` seconds after what comes before.
+    """
+
+    def __init__(self, status=200, headers=None, body=b"", reason="OK", delay=0):
+        self.status = status
+        self.headers = list(headers or [])
+        self.body = body
+        self.reason = reason
+        self.delay = delay
+
+    def blocks(self):
+        lines = ["HTTP/1.1 {} {}".format(self.status, self.reason)]
+        names = {name.lower() for name, _ in self.headers}
+        if isinstance(self.body, list):
+            if "transfer-encoding" not in names:
+                self.headers.append(("Transfer-Encoding", "chunked"))
+            payload = [
+                b"%x\r\n%s\r\n" % (len(chunk), chunk) for chunk in self.body if chunk
+            ]
+            payload.append(b"0\r\n\r\n")
+        else:
+            if "content-length" not in names:
+                self.headers.append(("Content-Length", str(len(self.body))))
+            payload = [self.body]
+        for name, value in self.headers:
+            lines.append("{}: {}".format(name, value))
+        head = ("\r\n".join(lines) + "\r\n\r\n").encode("latin-1")
+        return [head] + payload
+
+    def encode(self):
+        return b"".join(self.blocks())
+
+
+class StandInServer(object):
+    """
+    Listen on a unix socket if `unix_socket` is a path
+    """
+
+    def __init__(self, ssl=None, unix_socket=None):
+        self.ssl = ssl
+        self.unix_socket = unix_socket
+        self.server = None
+        self.port = None
+        self.connections = 0
+
+    async def start(self):
+        if self.unix_socket:
+            self.server = await asyncio.start_unix_server(
+                self._accept, self.unix_socket, ssl=self.ssl
+            )
+            return self
+
+        self.server = await asyncio.start_server(
+            self._accept, "127.0.0.1", 0, ssl=self.ssl
+        )
+        self.port = self.server.sockets[0].getsockname()[1]
+        return self
+
+    async def close(self):
+        self.server.close()
+        await self.server.wait_closed()
+
+    async def _accept(self, reader, writer):
+        self.connections += 1
+        try:
+            await self.handle(reader, writer)
+        except (ConnectionError, asyncio.IncompleteReadError, ssl.SSLError):
+            pass
+        finally:
+            writer.close()
+
+    async def handle(self, reader, writer):
+        raise NotImplementedError
+
+
+async def read_request_head(reader):
+    line = await reader.readline()
+    if not line:
+        return None
+    method, target, _ = line.decode("latin-1").split(" ", 2)
+    headers = {}
+    while True:
+        line = await reader.readline()
+        if line in (b"\r\n", b"\n", b""):
+            break
+        name, value = line.decode("latin-1").split(":", 1)
+        headers[name.strip().lower()] = value.strip()
+    return method, target, headers
+
+
+async def read_chunked_body(reader):
+    body = b""
+    while True:
+        size = int((await reader.readline()).split(b";")[0], 16)
+        if not size:
+            await reader.readline()
+            return body
+        body += await reader.readexactly(size)
+        await reader.readline()
+
+
+class StandInHTTPServer(StandInServer):
+    """
+    A keep-alive HTTP/1.1 server dispatching on the request path.
+
+    `routes` maps a path to a callable taking a `StandInRequest` and
+    returning a `StandInResponse`.
+    """
+
+    def __init__(self, routes=None, ssl=None, unix_socket=None):
+        super(StandInHTTPServer, self).__init__(ssl=ssl, unix_socket=unix_socket)
+        self.routes = dict(routes or {})
+        self.requests = []
+
+    def url(self, path="/"):
+        scheme = "https" if self.ssl else "http"
+        return "{}://127.0.0.1:{}{}".format(scheme, self.port, path)
+
+    async def handle(self, reader, writer):
+        while True:
+            head = await read_request_head(reader)
+            if head is None:
+                return
+            method, target, headers = head
+            body = b""
+            if headers.get("content-length"):
+                body = await reader.readexactly(int(headers["content-length"]))
+            elif headers.get("transfer-encoding", "").lower() == "chunked":
+                body = await read_chunked_body(reader)
+            request = StandInRequest(method, target, headers, body)
+            self.requests.append(request)
+
+            route = self.routes.get(request.path)
+            if route is None:
+                response = StandInResponse(404, body=b"not found", reason="Not Found")
+            else:
+                response = route(request)
+            head, *blocks = response.blocks()
+            if method == "HEAD":
+                blocks = []
+            writer.write(head)
+            for block in blocks:
+                if response.delay:
+                    await writer.drain()
+                    await asyncio.sleep(response.delay)
+                writer.write(block)
+            await writer.drain()
+            if headers.get("connection", "").lower() == "close":
+                return
+
+
+class StandInHTTPProxy(StandInServer):
+    """
+    An HTTP proxy supporting CONNECT tunnels and absolute-form requests.
+    """
+
+    def __init__(self, auth=None):
+        super(StandInHTTPProxy, self).__init__()
+        self.auth = auth
+        self.connects = []
+
+    def url(self):
+        return "http://127.0.0.1:{}".format(self.port)
+
+    async def handle(self, reader, writer):
+        head = await read_request_head(reader)
+        if head is None:
+            return
+        method, target, headers = head
+
+        if self.auth and headers.get("proxy-authorization") != "Basic " + self.auth:
+            writer.write(
+                b"HTTP/1.1 407 Proxy Authentication Required\r\n"
+                b"Content-Length: 0\r\n\r\n"
+            )
+            await writer.drain()
+            return
+
+        if method == "CONNECT":
+            self.connects.append(target)
+            host, port = target.rsplit(":", 1)
+            up_reader, up_writer = await asyncio.open_connection(host, int(port))
+            writer.write(b"HTTP/1.1 200 Connection established\r\n\r\n")
+            await writer.drain()
+        else:
+            parser = urlparse(target)
+            up_reader, up_writer = await asyncio.open_connection(
+                parser.hostname, parser.port or 80
+            )
+            path = parser.path or "/"
+            if parser.query:
+                path += "?" + parser.query
+            lines = ["{} {} HTTP/1.1".format(method, path)]
+            lines += [
+                "{}: {}".format(name, value)
+                for name, value in headers.items()
+                if not name.startswith("proxy-")
+            ]
+            up_writer.write(("\r\n".join(lines) + "\r\n\r\n").encode("latin-1"))
+
+        await asyncio.gather(_relay(reader, up_writer), _relay(up_reader, writer))
+
+
+class _FlightReader(object):
+    """
+    Buffer the client data and count the flights it arrives in. Every flight
+    costs `latency` seconds to emulate a network round trip.
+    """
+
+    def __init__(self, reader, latency=0):
+        self.reader = reader
+        self.latency = latency
+        self.buffer = b""
+        self.flights = 0
+
+    async def take(self, size):
+        while len(self.buffer) < size:
+            data = await self.reader.read(65536)
+            if not data:
+                raise asyncio.IncompleteReadError(self.buffer, size)
+            self.flights += 1
+            if self.latency:
+                await asyncio.sleep(self.latency)
+            self.buffer += data
+        data, self.buffer = self.buffer[:size], self.buffer[size:]
+        return data
+
+    async def take_until_nul(self):
+        data = b""
+        while True:
+            byte = await self.take(1)
+            if byte == b"\x00":
+                return data
+            data += byte
+
+
+class StandInSocksServer(StandInServer):
+    """
+    A SOCKS4/SOCKS4a/SOCKS5 server supporting CONNECT
+
+    Without `pipelining`, a SOCKS5 client sending more than its greeting
+    before the reply is disconnected.
+    """
+
+    def __init__(self, username=None, password=None, latency=0, pipelining=True):
+        super(StandInSocksServer, self).__init__()
+        self.username = username
+        self.password = password
+        self.latency = latency
+        self.pipelining = pipelining
+        # (version, host, port, flights) of each handshake
+        self.handshakes = []
+
+    def url(self, scheme="socks5"):
+        if self.username:
+            return "{}://{}:{}@127.0.0.1:{}".format(
+                scheme, self.username, self.password, self.port
+            )
+        return "{}://127.0.0.1:{}".format(scheme, self.port)
+
+    async def handle(self, reader, writer):
+        client = _FlightReader(reader, latency=self.latency)
+        version = (await client.take(1))[0]
+        if version == 4:
+            host, port = await self._socks4(client, writer)
+        elif version == 5:
+            address = await self._socks5(client, writer)
+            if address is None:
+                return
+            host, port = address
+        else:
+            return
+        self.handshakes.append((version, host, port, client.flights))
+
+        up_reader, up_writer = await asyncio.open_connection(host, port)
+        if version == 4:
+            writer.write(b"\x00\x5a" + port.to_bytes(2, "big") + bytes(4))
+        else:
+            writer.write(b"\x05\x00\x00\x01\x7f\x00\x00\x01" + port.to_bytes(2, "big"))
+        up_writer.write(client.buffer)
+        await asyncio.gather(_relay(reader, up_writer), _relay(up_reader, writer))
+
+    async def _socks4(self, client, writer):
+        data = await client.take(7)
+        port = int.from_bytes(data[1:3], "big")
+        ip = data[3:7]
+        await client.take_until_nul()  # user id
+        if ip[:3] == b"\x00\x00\x00" and ip[3]:
+            host = (await client.take_until_nul()).decode("idna")
+        else:
+            host = ".".join(str(b) for b in ip)
+        return host, port
+
+    async def _socks5(self, client, writer):
+        nmethods = (await client.take(1))[0]
+        methods = await client.take(nmethods)
+        if not self.pipelining and client.buffer:
+            writer.close()
+            return None
+        if self.username:
+            method = 0x02 if 0x02 in methods else 0xFF
+        else:
+            method = 0x00 if 0x00 in methods else methods[0]
+        writer.write(bytes([5, method]))
+        if method == 0xFF:
+            return None
+
+        if method == 0x02:
+            await client.take(1)
+            username = await client.take((await client.take(1))[0])
+            password = await client.take((await client.take(1))[0])
+            ok = not self.username or (
+                username.decode() == self.username
+                and password.decode() == self.password
+            )
+            writer.write(b"\x01\x00" if ok else b"\x01\x01")
+            if not ok:
+                return None
+
+        _, cmd, _, atyp = await client.take(4)
+        if atyp == 0x01:
+            host = ".".join(str(b) for b in await client.take(4))
+        elif atyp == 0x03:
+            host = (await client.take((await client.take(1))[0])).decode("idna")
+        else:
+            return None
+        port = int.from_bytes(await client.take(2), "big")
+        return host, port
+
+
+class ThreadedServer(object):
+    """
+    Run a stand-in server on its own event loop in a thread, for code which
+    blocks the calling thread
+
+        with ThreadedServer(lambda: StandInHTTPServer(routes)) as server:
+            ...
+    """
+
+    def __init__(self, make_server):
+        self.make_server = make_server
+        self.loop = asyncio.new_event_loop()
+        self.server = None
+        self.thread = threading.Thread(target=self.loop.run_forever, daemon=True)
+
+    async def _shutdown(self):
+        await self.server.close()
+        # Connections kept alive by clients are still handled
+        tasks = [
+            task for task in asyncio.all_tasks() if task is not asyncio.current_task()
+        ]
+        for task in tasks:
+            task.cancel()
+        await asyncio.gather(*tasks, return_exceptions=True)
+
+    def __enter__(self):
+        self.thread.start()
+        self.server = asyncio.run_coroutine_threadsafe(
+            self.make_server().start(), self.loop
+        ).result()
+        return self.server
+
+    def __exit__(self, *exc_info):
+        asyncio.run_coroutine_threadsafe(self._shutdown(), self.loop).result()
+        self.loop.call_soon_threadsafe(self.loop.stop)
+        self.thread.join()
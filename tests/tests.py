@@ -1,5 +1,30 @@
+import ssl
 import asyncio
+
+import pytest
+
 import mugen
+import mugen.connect
+
+
+@pytest.fixture
+def trusted_cert(tmp_path):
+    """
+    A self-signed certificate of localhost, trusted for the test only
+    """
+
+    from tests.servers import make_self_signed_cert
+
+    cert = make_self_signed_cert(str(tmp_path))
+    if cert is None:
+        pytest.skip("openssl is not available")
+
+    shared = mugen.connect._default_ssl_context
+    mugen.connect._default_ssl_context = ssl.create_default_context(cafile=cert[0])
+    try:
+        yield cert
+    finally:
+        mugen.connect._default_ssl_context = shared
 
 
 def test():
@@ -60,3 +85,1561 @@ def test():
             assert isinstance(err, asyncio.TimeoutError)
 
     loop.run_until_complete(test_timeout())
+
+
+def test_https_proxy_tunnel_reuse(trusted_cert):
+    from tests.servers import (
+        StandInHTTPServer,
+        StandInHTTPProxy,
+        StandInResponse,
+        server_ssl_context,
+    )
+
+    cert = trusted_cert
+    loop = asyncio.get_event_loop()
+
+    async def run():
+        server = await StandInHTTPServer(
+            {"/": lambda req: StandInResponse(body=b"tunneled")},
+            ssl=server_ssl_context(*cert),
+        ).start()
+        proxy = await StandInHTTPProxy().start()
+
+        ss = mugen.session()
+        for _ in range(3):
+            resp = await ss.get(server.url("/"), proxy=proxy.url())
+            assert resp.text == "tunneled"
+
+        # One CONNECT and one TLS handshake for all requests
+        assert len(proxy.connects) == 1
+        assert server.connections == 1
+        assert server.requests[0].target == "/"
+        assert "proxy-authorization" not in server.requests[0].headers
+
+        await proxy.close()
+        await server.close()
+
+    loop.run_until_complete(run())
+
+
+def test_https_proxy_tunnel_refused():
+    from tests.servers import StandInHTTPProxy
+    from mugen.proxy import HTTPProxyError
+
+    loop = asyncio.get_event_loop()
+
+    async def run():
+        proxy = await StandInHTTPProxy(auth="dTpw").start()
+        try:
+            await mugen.get("https://127.0.0.1:1/", proxy=proxy.url())
+            assert False, "CONNECT should be refused"
+        except HTTPProxyError as err:
+            assert "407" in str(err)
+        await proxy.close()
+
+    loop.run_until_complete(run())
+
+
+def test_socks_proxy():
+    from tests.servers import StandInHTTPServer, StandInResponse, StandInSocksServer
+    from mugen.proxy import SOCKS5AuthError
+
+    loop = asyncio.get_event_loop()
+
+    async def run():
+        server = await StandInHTTPServer(
+            {"/": lambda req: StandInResponse(body=req.headers["host"].encode())}
+        ).start()
+        socks5 = await StandInSocksServer().start()
+        socks4a = await StandInSocksServer().start()
+        socks4 = await StandInSocksServer().start()
+        socks_auth = await StandInSocksServer(username="u", password="p").start()
+
+        ss = mugen.session()
+        url = "http://localhost:{}/".format(server.port)
+        for proxy in (
+            socks5.url("socks5"),
+            socks4a.url("socks4a"),
+            socks4.url("socks4"),
+            socks_auth.url("socks5"),
+        ):
+            resp = await ss.get(url, proxy=proxy)
+            assert resp.text == "localhost:{}".format(server.port)
+            resp = await ss.get(url, proxy=proxy)
+            assert resp.text == "localhost:{}".format(server.port)
+
+        # The handshake is pipelined into one flight, and the tunnel is reused
+        assert socks5.handshakes == [(5, "localhost", server.port, 1)]
+        assert socks4a.handshakes == [(4, "localhost", server.port, 1)]
+        assert socks4.handshakes == [(4, "127.0.0.1", server.port, 1)]
+        assert socks_auth.handshakes == [(5, "localhost", server.port, 1)]
+
+        try:
+            await ss.get(url, proxy="socks5://x:p@127.0.0.1:{}".format(socks_auth.port))
+            assert False, "authentication should fail"
+        except SOCKS5AuthError:
+            pass
+
+        # A server which does not take a pipelined handshake is negotiated
+        # with again in lockstep, and so are the next connections to it
+        strict = await StandInSocksServer(
+            username="u", password="p", pipelining=False
+        ).start()
+        for _ in range(2):
+            resp = await ss.get(url, proxy=strict.url("socks5"), recycle=False)
+            assert resp.text == "localhost:{}".format(server.port)
+        assert strict.handshakes == [(5, "localhost", server.port, 3)] * 2
+        assert strict.connections == 3
+
+        for socks in (socks5, socks4a, socks4, socks_auth, strict):
+            await socks.close()
+        await server.close()
+
+    loop.run_until_complete(run())
+
+
+def test_socks5_handshake_latency():
+    from tests.servers import StandInHTTPServer, StandInSocksServer
+    from mugen.connect import Connection
+    from mugen.proxy import Socks5Proxy
+
+    loop = asyncio.get_event_loop()
+    rtt = 0.02
+
+    async def handshake(socks, port, pipeline):
+        conn = Connection("127.0.0.1", socks.port)
+        await conn.connect()
+        proxy = Socks5Proxy(conn, "127.0.0.1", port, False, "u", "p", pipeline)
+        start = loop.time()
+        await proxy.init()
+        elapsed = loop.time() - start
+        conn.close()
+        return elapsed
+
+    async def run():
+        server = await StandInHTTPServer().start()
+        socks = StandInSocksServer(username="u", password="p", latency=rtt)
+        await socks.start()
+
+        pipelined = await handshake(socks, server.port, True)
+        lockstep = await handshake(socks, server.port, False)
+        assert [h[3] for h in socks.handshakes] == [1, 3]
+        assert pipelined < lockstep
+        assert pipelined < 2 * rtt
+
+        await socks.close()
+        await server.close()
+
+    loop.run_until_complete(run())
+
+
+def test_response_headers():
+    from tests.servers import StandInHTTPServer, StandInResponse
+
+    loop = asyncio.get_event_loop()
+
+    async def run():
+        server = await StandInHTTPServer(
+            {
+                "/": lambda req: StandInResponse(
+                    headers=[
+                        ("Set-Cookie", "a=1; Expires=Wed, 21 Oct 2037 07:28:00 GMT"),
+                        ("X-Custom", "x"),
+                        ("Set-Cookie", "b=2; Path=/"),
+                    ],
+                    body=b"ok",
+                )
+            }
+        ).start()
+
+        resp = await mugen.get(server.url("/"))
+        assert resp.headers["x-custom"] == "x"
+        assert resp.headers.get("X-CUSTOM") == "x"
+        assert resp.headers.get("X-Missing") is None
+        assert "content-length" in resp.headers
+        assert resp.headers.getall("set-cookie") == [
+            "a=1; Expires=Wed, 21 Oct 2037 07:28:00 GMT",
+            "b=2; Path=/",
+        ]
+        assert list(resp.headers) == ["Set-Cookie", "X-Custom", "Content-Length"]
+        assert resp.cookies.get_dict()["a"] == "1"
+        assert resp.cookies.get_dict()["b"] == "2"
+
+        await server.close()
+
+    loop.run_until_complete(run())
+
+
+def test_cookie_jar():
+    from mugen.cookies import CookieJar
+
+    jar = CookieJar({"g": "1"})
+    jar.extract(
+        [
+            "a=1; Domain=.example.com; Path=/",
+            "b=2; Path=/docs",
+            "c=3; Secure",
+            "d=4; Domain=other.com",
+            "e=5; Max-Age=0",
+            "f=6; Expires=Wed, 21 Oct 2037 07:28:00 GMT",
+        ],
+        "www.example.com",
+        "/index.html",
+    )
+
+    assert jar.cookie_header("www.example.com", "/") == "g=1; f=6; a=1"
+    assert jar.cookie_header("www.example.com", "/docs/x") == "b=2; g=1; f=6; a=1"
+    assert jar.cookie_header("www.example.com", "/", secure=True) == (
+        "g=1; c=3; f=6; a=1"
+    )
+    assert jar.cookie_header("api.example.com", "/") == "g=1; a=1"
+    assert jar.cookie_header("other.com", "/") == "g=1"
+
+    # The cached header is dropped when the jar changes
+    jar.extract(["a=changed; Domain=example.com"], "example.com")
+    assert jar.cookie_header("api.example.com", "/") == "g=1; a=changed"
+    jar.extract(["a=; Domain=.example.com; Max-Age=0"], "www.example.com")
+    assert jar.cookie_header("api.example.com", "/") == "g=1"
+
+
+def test_cookie_jar_memory():
+    import tracemalloc
+    from mugen.cookies import CookieJar
+
+    # Crawling many hosts keeps the cache of the Cookie headers bounded
+    jar = CookieJar(cache_size=100)
+    jar.extract(["a=1; Domain=example.com"], "example.com")
+
+    def crawl(start, stop):
+        for i in range(start, stop):
+            assert jar.cookie_header("h{}.example.com".format(i)) == "a=1"
+            assert jar.cookie_header("h{}.other.org".format(i)) == ""
+
+    crawl(0, 1000)
+    tracemalloc.start()
+    try:
+        before = tracemalloc.get_traced_memory()[0]
+        crawl(1000, 5000)
+        grown = tracemalloc.get_traced_memory()[0] - before
+    finally:
+        tracemalloc.stop()
+    assert grown < 100 * 1024, grown
+
+    # Evicted and uncached hosts are still served right
+    jar.extract(["b=2; Domain=other.org"], "other.org")
+    assert jar.cookie_header("h5.other.org") == "b=2"
+    assert jar.cookie_header("h5.example.com") == "a=1"
+    jar.extract(["a=3; Domain=example.com"], "example.com")
+    assert jar.cookie_header("h4999.example.com") == "a=3"
+
+
+def test_session_cookies_per_host():
+    from tests.servers import StandInHTTPServer, StandInResponse
+
+    loop = asyncio.get_event_loop()
+
+    async def run():
+        server = await StandInHTTPServer(
+            {
+                "/set": lambda req: StandInResponse(
+                    headers=[("Set-Cookie", "k=v; Path=/")]
+                ),
+                "/": lambda req: StandInResponse(),
+            }
+        ).start()
+
+        ss = mugen.session(cookies={"g": "1"})
+        await ss.get(server.url("/set"))
+        await ss.get(server.url("/"))
+        await ss.get("http://localhost:{}/".format(server.port))
+
+        assert [req.headers.get("cookie") for req in server.requests] == [
+            "g=1",
+            "g=1; k=v",
+            "g=1",
+        ]
+        assert ss.cookies.get_dict() == {"g": "1", "k": "v"}
+
+        await server.close()
+
+    loop.run_until_complete(run())
+
+
+def test_response_text_and_json_cache():
+    import gzip
+    import json
+    from tests.servers import StandInHTTPServer, StandInResponse
+
+    loop = asyncio.get_event_loop()
+    data = {"items": list(range(1000))}
+    body = gzip.compress(json.dumps(data).encode())
+
+    async def run():
+        server = await StandInHTTPServer(
+            {
+                "/": lambda req: StandInResponse(
+                    headers=[("Content-Encoding", "gzip")], body=body
+                )
+            }
+        ).start()
+
+        resp = await mugen.get(server.url("/"))
+        assert resp.text is resp.text
+        assert resp.json() == data
+        assert resp.json() is resp.json()
+
+        resp = await mugen.get(server.url("/"))
+        resp.offload_size = 10
+        assert await resp.atext() is resp.text
+        assert await resp.ajson() == data
+        assert await resp.ajson() is resp.json()
+
+        await server.close()
+
+    loop.run_until_complete(run())
+
+
+def test_stream_lines_and_ndjson():
+    import zlib
+    from tests.servers import StandInHTTPServer, StandInResponse
+    from mugen.exceptions import LineTooLong
+
+    loop = asyncio.get_event_loop()
+    compressor = zlib.compressobj(wbits=16 + zlib.MAX_WBITS)
+    ndjson = b"".join(b'{"n": %d}\n' % i for i in range(100))
+    gzipped = compressor.compress(ndjson) + compressor.flush()
+
+    async def run():
+        server = await StandInHTTPServer(
+            {
+                "/lines": lambda req: StandInResponse(
+                    body=[b"a\r\nb", b"b\n", b"", b"c"]
+                ),
+                "/cr": lambda req: StandInResponse(body=[b"a\rb\r", b"\nc\n\rd"]),
+                "/ndjson": lambda req: StandInResponse(
+                    headers=[("Content-Encoding", "gzip")],
+                    body=[gzipped[i : i + 7] for i in range(0, len(gzipped), 7)],
+                ),
+                "/long": lambda req: StandInResponse(body=[b"x" * 500] * 10),
+            }
+        ).start()
+
+        ss = mugen.session()
+        resp = await ss.get(server.url("/lines"), stream=True)
+        assert resp.content is None
+        assert [line async for line in resp.iter_lines()] == [b"a", b"bb", b"c"]
+
+        resp = await ss.get(server.url("/cr"), stream=True)
+        lines = [line async for line in resp.iter_lines()]
+        assert lines == [b"a", b"b", b"c", b"", b"d"]
+
+        resp = await ss.get(server.url("/ndjson"), stream=True)
+        items = [item async for item in resp.iter_ndjson(chunk_size=16)]
+        assert items == [{"n": i} for i in range(100)]
+
+        resp = await ss.get(server.url("/long"), stream=True)
+        try:
+            [line async for line in resp.iter_lines(max_line_size=250)]
+            assert False, "the line is too long"
+        except LineTooLong:
+            pass
+
+        # The connection is reused after the streamed bodies
+        resp = await ss.get(server.url("/lines"))
+        assert resp.text == "a\r\nbb\nc"
+        assert server.connections == 2
+
+        await server.close()
+
+    loop.run_until_complete(run())
+
+
+def test_stream_server_sent_events(tmp_path):
+    from tests.servers import StandInHTTPServer, StandInResponse
+
+    loop = asyncio.get_event_loop()
+
+    calls = []
+
+    def events(req):
+        last_event_id = req.headers.get("last-event-id")
+        calls.append(last_event_id)
+        if last_event_id == "3" or len(calls) > 10:
+            return StandInResponse(204, reason="No Content")
+        if last_event_id == "2":
+            # The partial event of the broken stream is not continued here
+            return StandInResponse(
+                headers=[("Content-Type", "text/event-stream")],
+                body=[b"id: 3\ndata: next\n\n"],
+            )
+        return StandInResponse(
+            headers=[("Content-Type", "text/event-stream")],
+            body=[
+                b"retry: 10\n: comment\n\n",
+                b"id: 1\ndata: first\n\n",
+                b"event: update\rid: 2\r\ndata: line 1\ndata: line 2\r\r",
+                b"data: incomplete",
+            ],
+        )
+
+    async def run():
+        server = await StandInHTTPServer({"/events": events}).start()
+
+        resp = await mugen.get(server.url("/events"), stream=True)
+        received = [
+            (event.event, event.id, event.data)
+            async for event in resp.iter_events(reconnect=True)
+        ]
+        assert received == [
+            ("message", "1", "first"),
+            ("update", "2", "line 1\nline 2"),
+            ("message", "3", "next"),
+        ]
+        assert len(server.requests) == 3
+
+        await server.close()
+
+        # The reconnection goes through the unix socket of the request
+        path = str(tmp_path / "events.sock")
+        server = await StandInHTTPServer({"/events": events}, unix_socket=path).start()
+
+        calls.clear()
+        resp = await mugen.get(
+            "http://events/events", stream=True, unix_socket=path, timeout=5
+        )
+        received = [event.id async for event in resp.iter_events(reconnect=True)]
+        assert received == ["1", "2", "3"]
+        assert len(server.requests) == 3
+
+        await server.close()
+
+    loop.run_until_complete(run())
+
+
+async def _status_and_pid(session, url):
+    import os
+
+    resp = await session.get(url)
+    return resp.status_code, os.getpid()
+
+
+def test_run_parallel():
+    import os
+    from tests.servers import ThreadedServer, StandInHTTPServer, StandInResponse
+
+    routes = {"/": lambda req: StandInResponse(body=b"ok")}
+    with ThreadedServer(lambda: StandInHTTPServer(routes)) as server:
+        urls = [server.url("/?n={}".format(n)) for n in range(40)]
+        urls.append("http://127.0.0.1:1/")
+
+        results = list(mugen.run_parallel(urls, processes=2, concurrency_per_process=4))
+        assert len(results) == 41
+        ok = [result for result in results if result.error is None]
+        assert sorted(result.item for result in ok) == sorted(urls[:-1])
+        assert all(result.value.content == b"ok" for result in ok)
+        failed = [result for result in results if result.error is not None]
+        assert [result.item for result in failed] == urls[-1:]
+
+        results = list(
+            mugen.run_parallel(
+                iter(urls[:10]), handler=_status_and_pid, processes=2, queue_size=1
+            )
+        )
+        assert [result.value[0] for result in results] == [200] * 10
+        assert os.getpid() not in {result.value[1] for result in results}
+
+
+def test_sync_session():
+    import time
+    from concurrent.futures import ThreadPoolExecutor
+    from tests.servers import ThreadedServer, StandInHTTPServer, StandInResponse
+
+    routes = {
+        "/": lambda req: StandInResponse(body=b"ok"),
+        "/slow": lambda req: StandInResponse(body=b"ok", delay=0.01),
+    }
+    with ThreadedServer(lambda: StandInHTTPServer(routes)) as server:
+        with mugen.SyncSession() as session:
+            with ThreadPoolExecutor(8) as executor:
+                responses = list(
+                    executor.map(lambda _: session.get(server.url("/")), range(80))
+                )
+
+            assert [resp.text for resp in responses] == ["ok"] * 80
+            assert server.connections <= 8
+
+        try:
+            session.get(server.url("/"))
+            assert False, "the session is closed"
+        except RuntimeError:
+            pass
+
+        # Closed along the calls of other threads, every call returns or fails
+        session = mugen.SyncSession()
+
+        def call(n):
+            try:
+                return session.get(server.url("/slow?n={}".format(n))).text
+            except RuntimeError:
+                return None
+
+        with ThreadPoolExecutor(8) as executor:
+            futures = [executor.submit(call, n) for n in range(200)]
+            time.sleep(0.1)
+            session.close()
+            results = [future.result(timeout=5) for future in futures]
+        assert set(results) <= {"ok", None}
+        assert None in results
+
+        # Its loop has its own pool, adapter and dns cache: the sessions of
+        # other loops work before, along and after it
+        loop = asyncio.get_event_loop()
+        resp = loop.run_until_complete(mugen.get(server.url("/")))
+        assert resp.text == "ok"
+        with mugen.SyncSession() as session:
+            assert session.get(server.url("/")).text == "ok"
+            resp = loop.run_until_complete(mugen.get(server.url("/")))
+            assert resp.text == "ok"
+            assert session.session.connection_pool is not resp._session.connection_pool
+        resp = loop.run_until_complete(mugen.get(server.url("/")))
+        assert resp.text == "ok"
+
+        try:
+            resp = asyncio.run(mugen.get(server.url("/")))
+            assert resp.text == "ok"
+        finally:
+            asyncio.set_event_loop(loop)
+
+
+def test_rate_limit():
+    import time
+    from mugen.ratelimit import RateLimiter, parse_retry_after
+    from tests.servers import StandInHTTPServer, StandInResponse
+
+    assert parse_retry_after("2") == 2.0
+    assert parse_retry_after("Wed, 21 Oct 2015 07:28:00 GMT") == 0.0
+    assert parse_retry_after("soon") is None
+
+    throttled = []
+
+    def slow_down(request):
+        if not throttled:
+            throttled.append(request)
+            return StandInResponse(429, [("Retry-After", "1")], reason="Too Many")
+        return StandInResponse(body=b"ok")
+
+    routes = {
+        "/": lambda req: StandInResponse(body=b"ok"),
+        "/throttle": slow_down,
+        "/busy": lambda req: StandInResponse(503, reason="Busy"),
+    }
+
+    loop = asyncio.get_event_loop()
+
+    async def run():
+        server = await StandInHTTPServer(routes).start()
+        limiter = RateLimiter(20, burst=1)
+        session = mugen.session(rate_limit=limiter)
+
+        start = time.monotonic()
+        responses = await asyncio.gather(
+            *[session.get(server.url("/")) for _ in range(10)]
+        )
+        assert [resp.status_code for resp in responses] == [200] * 10
+        # 1 token at first, then one every 50ms
+        assert time.monotonic() - start >= 0.4
+
+        limiter = RateLimiter(20, burst=1, key=lambda request: "one")
+        session = mugen.session(rate_limit=limiter)
+        resp = await session.get(server.url("/throttle"))
+        assert resp.status_code == 429
+        assert limiter.get_bucket("one").rate == 10
+
+        start = time.monotonic()
+        resp = await session.get(server.url("/throttle"))
+        assert resp.status_code == 200
+        assert time.monotonic() - start >= 0.9
+        assert limiter.get_bucket("one").rate > 10
+
+        # A burst of throttled responses halves the rate once
+        limiter = RateLimiter(20)
+        session = mugen.session(rate_limit=limiter)
+        responses = await asyncio.gather(
+            *[session.get(server.url("/busy")) for _ in range(5)]
+        )
+        assert [resp.status_code for resp in responses] == [503] * 5
+        assert limiter.get_bucket("127.0.0.1").rate == 10
+
+        for rate in (0, -1):
+            try:
+                RateLimiter(rate)
+            except ValueError:
+                pass
+            else:
+                assert False, rate
+        try:
+            RateLimiter(10, rates={"slow": 0})
+        except ValueError:
+            pass
+        else:
+            assert False
+
+        await server.close()
+
+    loop.run_until_complete(run())
+
+
+def test_scheduler():
+    from mugen.scheduler import Scheduler
+    from tests.servers import StandInHTTPServer, StandInResponse
+
+    loop = asyncio.get_event_loop()
+
+    async def run():
+        # Unit: priorities first, then fair share by weight
+        scheduler = Scheduler(1, weights={"a": 2})
+        order = []
+
+        async def job(key, priority=0):
+            await scheduler.acquire(key, priority=priority)
+            order.append(key)
+            await asyncio.sleep(0)
+            scheduler.release(key)
+
+        await scheduler.acquire("busy")
+        tasks = [asyncio.ensure_future(job("a")) for _ in range(4)]
+        tasks += [asyncio.ensure_future(job("b")) for _ in range(2)]
+        tasks.append(asyncio.ensure_future(job("urgent", priority=10)))
+        await asyncio.sleep(0)
+        assert scheduler.waiting() == 7
+        scheduler.release("busy")
+        await asyncio.gather(*tasks)
+        assert order == ["urgent", "a", "b", "a", "a", "b", "a"]
+        assert scheduler.active == 0
+        assert Scheduler(1).max_per_key == 1
+        assert Scheduler(8).max_per_key == 4
+
+        # The tags of the keys are dropped with their queues: a key which
+        # waits again is not served after its past turns
+        scheduler = Scheduler(1)
+        order = []
+        for keys in ["aaaa", "ab"]:
+            await scheduler.acquire("busy")
+            tasks = [asyncio.ensure_future(job(key)) for key in keys]
+            await asyncio.sleep(0)
+            scheduler.release("busy")
+            await asyncio.gather(*tasks)
+        assert order == ["a"] * 5 + ["b"]
+
+        # Cancelled waiters give their turn away
+        await scheduler.acquire("a")
+        task = asyncio.ensure_future(scheduler.acquire("b"))
+        await asyncio.sleep(0)
+        task.cancel()
+        await asyncio.sleep(0)
+        scheduler.release("a")
+        assert scheduler.active == 0 and scheduler.waiting() == 0
+
+        # Session: one host can not take every slot
+        routes = {"/": lambda req: StandInResponse(body=b"ok")}
+        server = await StandInHTTPServer(routes).start()
+        other = await StandInHTTPServer(routes).start()
+        scheduler = Scheduler(4, max_per_key=2)
+        session = mugen.session(scheduler=scheduler)
+
+        urls = [server.url("/")] * 10 + [other.url("/")] * 2
+        responses = await asyncio.gather(
+            *[
+                session.get(url, tenant=url, priority=i % 3)
+                for i, url in enumerate(urls)
+            ]
+        )
+        assert [resp.content for resp in responses] == [b"ok"] * 12
+        assert scheduler.active == 0
+        assert server.connections <= 2
+
+        await server.close()
+        await other.close()
+
+    loop.run_until_complete(run())
+
+
+def test_timeouts():
+    from mugen.scheduler import Scheduler
+    from mugen.exceptions import (
+        RequestTimeout,
+        PoolTimeout,
+        ReadTimeout,
+    )
+    from tests.servers import StandInHTTPServer, StandInResponse
+
+    routes = {
+        "/": lambda req: StandInResponse(body=b"ok"),
+        "/stall": lambda req: StandInResponse(body=b"late", delay=0.3),
+        "/drip": lambda req: StandInResponse(body=[b"a"] * 5, delay=0.1),
+    }
+
+    loop = asyncio.get_event_loop()
+
+    async def run():
+        server = await StandInHTTPServer(routes).start()
+        session = mugen.session()
+
+        try:
+            await session.get(server.url("/stall"), timeout=mugen.Timeout(read=0.1))
+            assert False, "no data for 0.3s"
+        except ReadTimeout:
+            pass
+
+        # 0.6s in total, but never more than 0.1s without data
+        resp = await session.get(server.url("/drip"), timeout=mugen.Timeout(read=0.2))
+        assert resp.content == b"aaaaa"
+
+        try:
+            await session.get(server.url("/drip"), timeout=0.2)
+            assert False, "the total timeout is 0.2s"
+        except RequestTimeout as err:
+            assert type(err) is RequestTimeout
+            assert isinstance(err, asyncio.TimeoutError)
+
+        resp = await session.get(
+            server.url("/stall"), stream=True, timeout=mugen.Timeout(read=0.1)
+        )
+        try:
+            await resp.read()
+            assert False, "no body for 0.3s"
+        except ReadTimeout:
+            pass
+
+        session = mugen.session(scheduler=Scheduler(1))
+        slow = asyncio.ensure_future(session.get(server.url("/stall")))
+        await asyncio.sleep(0.05)
+        try:
+            await session.get(server.url("/"), timeout=mugen.Timeout(pool_acquire=0.1))
+            assert False, "the only slot is taken for 0.3s"
+        except PoolTimeout:
+            pass
+        assert (await slow).content == b"late"
+        resp = await session.get(
+            server.url("/"), timeout=mugen.Timeout(pool_acquire=0.1)
+        )
+        assert resp.content == b"ok"
+        assert session.scheduler.active == 0
+
+        # Not cancelled later by a finished request
+        await asyncio.sleep(0.4)
+
+        await server.close()
+
+    loop.run_until_complete(run())
+
+
+def test_session_warmup():
+    from tests.servers import StandInHTTPServer, StandInResponse
+
+    routes = {"/": lambda req: StandInResponse(body=b"ok")}
+
+    loop = asyncio.get_event_loop()
+
+    async def run():
+        server = await StandInHTTPServer(routes).start()
+        origin = "http://127.0.0.1:{}".format(server.port)
+        session = mugen.session()
+
+        opened = await session.warmup({origin: 4, "http://127.0.0.1:1": 2})
+        assert opened == {origin: 4, "http://127.0.0.1:1": 0}
+        await asyncio.sleep(0.05)
+        assert server.connections == 4
+
+        # Already warm
+        assert await session.warmup({origin: 4}, keep_warm=0.05) == {origin: 0}
+
+        responses = await asyncio.gather(
+            *[session.get(server.url("/")) for _ in range(4)]
+        )
+        assert [resp.content for resp in responses] == [b"ok"] * 4
+        assert server.connections == 4
+
+        # Topped up after the pooled connections are dropped
+        session.connection_pool.clear()
+        await asyncio.sleep(0.2)
+        assert server.connections == 8
+
+        session.close()
+        await server.close()
+
+    loop.run_until_complete(run())
+
+
+def test_session_warmup_tls(trusted_cert):
+    from tests.servers import StandInHTTPServer, StandInResponse, server_ssl_context
+
+    routes = {"/": lambda req: StandInResponse(body=b"ok")}
+
+    loop = asyncio.get_event_loop()
+
+    async def run():
+        server = await StandInHTTPServer(
+            routes, ssl=server_ssl_context(*trusted_cert)
+        ).start()
+        session = mugen.session()
+
+        # A bare host is https, resolved through the dns cache and
+        # handshaked with the host name
+        origin = "localhost:{}".format(server.port)
+        assert await session.warmup({origin: 2}) == {origin: 2}
+        assert ("localhost", server.port) in session.dns_cache
+
+        resp = await session.get("https://localhost:{}/".format(server.port))
+        assert resp.content == b"ok"
+        assert resp.timings.reused is False and resp.timings.connect == 0
+        assert server.connections == 2
+
+        session.close()
+        await server.close()
+
+    loop.run_until_complete(run())
+
+
+def test_adaptive_pool():
+    import itertools
+    from mugen.connection_pool import AdaptiveLimit, AdaptiveLimits
+    from tests.servers import StandInHTTPServer, StandInResponse
+
+    # Additive increase under demand, multiplicative decrease on errors
+    limit = AdaptiveLimit(2)
+    for _ in range(20):
+        limit.update(0.01, False, True, 0, 2, 10)
+    assert 6 < limit.target <= 10
+    grown = limit.target
+    limit.update(0.01, False, False, 0, 2, 10)
+    assert limit.target == grown
+    limit.update(0.01, True, True, 1, 2, 10)
+    assert limit.target == grown / 2
+    limit.update(0.01, True, True, 1, 2, 10)
+    assert limit.target == grown / 2, "one decrease per round trip"
+    for now in range(2, 10):
+        limit.update(0.01, True, True, now, 2, 10)
+    assert limit.target == 2
+    # Latency going up is congestion
+    limit = AdaptiveLimit(8)
+    for now in range(10):
+        limit.update(0.01 * (now + 1) ** 2, False, True, now, 2, 10)
+    assert limit.target == 2
+    # The floor is one connection
+    limits = AdaptiveLimits(min_per_host=0, max_per_host=4)
+    limit = limits.get_limit("key")
+    for now in range(10):
+        limit.update(0.01, True, True, now, limits.min_per_host, 4)
+    assert limit.target == 1
+    assert limit.available()
+    limit.update(0.01, False, True, 10, limits.min_per_host, 4)
+    assert limit.target == 2
+
+    routes = {
+        "/": lambda req: StandInResponse(body=b"ok"),
+        "/slow": lambda req: StandInResponse(body=b"slow", delay=next(slower)),
+    }
+    # Slower at every request
+    slower = (0.005 * n for n in itertools.count())
+
+    loop = asyncio.get_event_loop()
+
+    async def run():
+        fast = await StandInHTTPServer(routes).start()
+        sluggish = await StandInHTTPServer(routes).start()
+        session = mugen.session(adaptive_pool=True)
+        limits = session.adaptive_pool
+        responses = await asyncio.gather(
+            *[session.get(fast.url("/")) for _ in range(300)]
+        )
+        assert [resp.content for resp in responses] == [b"ok"] * 300
+        key = ("127.0.0.1", fast.port, False)
+        assert limits.get_limit(key).target > 4
+        assert fast.connections <= int(limits.get_limit(key).target) + 1
+
+        await asyncio.gather(*[session.get(sluggish.url("/slow")) for _ in range(30)])
+        key = ("127.0.0.1", sluggish.port, False)
+        assert limits.get_limit(key).target == 2
+        assert sluggish.connections <= 4
+        assert limits.get_limit(key).active == 0
+
+        # The limits are the session's, other sessions of the pool are free
+        other = mugen.session()
+        assert other.adaptive_pool is None
+        connections = sluggish.connections
+        await asyncio.gather(*[other.get(sluggish.url("/")) for _ in range(10)])
+        assert sluggish.connections - connections > 2
+        assert limits.get_limit(key).active == 0
+
+        await fast.close()
+        await sluggish.close()
+
+    loop.run_until_complete(run())
+
+
+def test_unix_socket(tmp_path):
+    from tests.servers import StandInHTTPServer, StandInResponse
+
+    routes = {"/": lambda req: StandInResponse(body=req.headers["host"].encode())}
+    path = str(tmp_path / "sidecar.sock")
+
+    loop = asyncio.get_event_loop()
+
+    async def run():
+        server = await StandInHTTPServer(routes, unix_socket=path).start()
+        session = mugen.session(unix_socket=path)
+
+        responses = await asyncio.gather(
+            *[session.get("http://sidecar/") for _ in range(5)]
+        )
+        assert [resp.content for resp in responses] == [b"sidecar"] * 5
+        responses = await asyncio.gather(
+            *[session.get("http://sidecar/") for _ in range(5)]
+        )
+        assert server.connections <= 5
+        assert session.connection_pool.count_idle((path, None, False)) >= 1
+
+        resp = await mugen.get("http://agent:8080/", unix_socket=path)
+        assert resp.content == b"agent:8080"
+
+        try:
+            await session.get("http://sidecar/", proxy="http://127.0.0.1:1")
+            assert False, "no proxy to a unix socket"
+        except ValueError:
+            pass
+
+        await server.close()
+
+    loop.run_until_complete(run())
+
+
+def test_unix_socket_tls(tmp_path, trusted_cert):
+    from tests.servers import StandInHTTPServer, StandInResponse, server_ssl_context
+
+    routes = {"/": lambda req: StandInResponse(body=req.headers["host"].encode())}
+    path = str(tmp_path / "tls.sock")
+
+    loop = asyncio.get_event_loop()
+
+    async def run():
+        # TLS is handshaked with the host of the url
+        tls = await StandInHTTPServer(
+            routes, ssl=server_ssl_context(*trusted_cert), unix_socket=path
+        ).start()
+        resp = await mugen.get("https://localhost/", unix_socket=path)
+        assert resp.content == b"localhost"
+        await tls.close()
+
+    loop.run_until_complete(run())
+
+
+def test_response_timings():
+    import gzip
+    from tests.servers import StandInHTTPServer, StandInResponse, StandInSocksServer
+
+    body = gzip.compress(b"x" * 100000)
+    routes = {
+        "/": lambda req: StandInResponse(body=b"ok"),
+        "/gzip": lambda req: StandInResponse(
+            headers=[("Content-Encoding", "gzip")], body=body, delay=0.05
+        ),
+    }
+
+    loop = asyncio.get_event_loop()
+
+    async def run():
+        server = await StandInHTTPServer(routes).start()
+        socks = await StandInSocksServer(latency=0.02).start()
+        session = mugen.session()
+
+        resp = await session.get(server.url("/"))
+        first = resp.timings
+        assert first.connect > 0 and first.tls == 0 and first.proxy == 0
+        assert not first.reused and first.reuse_count == 0
+
+        resp = await session.get(server.url("/gzip"))
+        timings = resp.timings
+        assert timings.reused and timings.reuse_count == 1
+        assert timings.connect == 0
+        assert timings.transfer >= 0.04
+        assert timings.decompress > 0
+        assert set(timings.as_dict()) == set(timings.__slots__)
+
+        resp = await session.get(server.url("/gzip"), stream=True)
+        assert resp.timings.transfer == 0
+        assert len(await resp.read()) == 100000
+        assert resp.timings.transfer >= 0.04 and resp.timings.decompress > 0
+
+        resp = await session.get(server.url("/"), proxy=socks.url())
+        assert resp.timings.proxy >= 0.02
+        assert resp.content == b"ok"
+
+        await socks.close()
+        await server.close()
+
+    loop.run_until_complete(run())
+
+
+def test_response_timings_https(trusted_cert):
+    from tests.servers import StandInHTTPServer, StandInResponse, server_ssl_context
+
+    routes = {"/": lambda req: StandInResponse(body=b"ok")}
+
+    loop = asyncio.get_event_loop()
+
+    async def run():
+        server = await StandInHTTPServer(
+            routes, ssl=server_ssl_context(*trusted_cert)
+        ).start()
+        session = mugen.session()
+
+        # A slow resolver is timed as dns, not as connect
+        get_ipaddrs = session.dns_cache.get_ipaddrs
+
+        async def slow_get_ipaddrs(host, port):
+            await asyncio.sleep(0.05)
+            return await get_ipaddrs(host, port)
+
+        session.dns_cache.get_ipaddrs = slow_get_ipaddrs
+        try:
+            resp = await session.get("https://localhost:{}/".format(server.port))
+        finally:
+            del session.dns_cache.get_ipaddrs
+        timings = resp.timings
+        assert resp.content == b"ok"
+        assert timings.dns >= 0.05
+        assert 0 < timings.connect < 0.05 and timings.tls > 0
+
+        # Resolved once, from the cache then
+        resp = await session.get(
+            "https://localhost:{}/".format(server.port), recycle=False
+        )
+        assert resp.timings.dns < 0.05 and resp.timings.connect > 0
+
+        await server.close()
+
+    loop.run_until_complete(run())
+
+
+def test_lean_responses_and_history():
+    from mugen.models import Request, RedirectRecord
+    from tests.servers import StandInHTTPServer, StandInResponse
+
+    routes = {
+        "/a": lambda req: StandInResponse(
+            302, [("Location", "/b")], body=b"moved a", reason="Found"
+        ),
+        "/b": lambda req: StandInResponse(
+            301, [("Location", "/c")], body=b"moved b", reason="Moved Permanently"
+        ),
+        "/c": lambda req: StandInResponse(body=b"ok"),
+    }
+
+    loop = asyncio.get_event_loop()
+
+    async def run():
+        server = await StandInHTTPServer(routes).start()
+        session = mugen.session()
+
+        resp = await session.get(server.url("/a"))
+        assert not hasattr(resp, "__dict__")
+        assert not hasattr(resp.request, "__dict__")
+        assert resp.connection is None
+        assert resp.content == b"ok"
+        assert resp.url == server.url("/c")
+        assert [r.content for r in resp.history] == [b"moved a", b"moved b"]
+        assert [r.url for r in resp.history] == [server.url("/a"), server.url("/b")]
+
+        session = mugen.session(full_history=False)
+        resp = await session.get(server.url("/a"))
+        assert all(isinstance(r, RedirectRecord) for r in resp.history)
+        assert [r.status_code for r in resp.history] == [302, 301]
+        assert [r.headers["Location"] for r in resp.history] == ["/b", "/c"]
+        assert resp.history[0].url == server.url("/a")
+
+        resp = await session.get(server.url("/c"), stream=True)
+        assert resp.connection is not None
+        await resp.read()
+        assert resp.connection is None
+
+        assert isinstance(resp.request, Request)
+        await server.close()
+
+    loop.run_until_complete(run())
+
+
+def test_redirect_cache_and_methods():
+    from tests.servers import StandInHTTPServer, StandInResponse
+
+    def redirect(status, location):
+        return lambda req: StandInResponse(
+            status, [("Location", location)], reason="Redirect"
+        )
+
+    def echo(req):
+        return StandInResponse(body=req.method.encode() + b" " + req.body)
+
+    routes = {
+        "/old": redirect(301, "/older"),
+        "/older": redirect(308, "/echo"),
+        "/see-other": redirect(303, "/echo"),
+        "/found": redirect(302, "/echo"),
+        "/temporary": redirect(307, "/echo"),
+        "/echo": echo,
+    }
+
+    loop = asyncio.get_event_loop()
+
+    async def run():
+        server = await StandInHTTPServer(routes).start()
+        session = mugen.session()
+        cache = session.redirect_cache
+
+        resp = await session.get(server.url("/old"))
+        assert resp.content == b"GET "
+        assert [r.status_code for r in resp.history] == [301, 308]
+        assert len(cache) == 2 and cache.hits == 0
+
+        del server.requests[:]
+        resp = await session.get(server.url("/old"))
+        assert resp.content == b"GET "
+        assert [req.path for req in server.requests] == ["/echo"]
+        assert cache.hits == 1
+
+        # 308 keeps the method and the body, 301 changes POST to GET
+        resp = await session.post(server.url("/older"), data=b"x=1")
+        assert resp.content == b"POST x=1"
+        resp = await session.post(server.url("/old"), data=b"x=1")
+        assert resp.content == b"GET "
+
+        for path, content in [
+            ("/see-other", b"GET "),
+            ("/found", b"GET "),
+            ("/temporary", b"POST x=1"),
+        ]:
+            resp = await session.post(server.url(path), data=b"x=1")
+            assert resp.content == content, path
+        resp = await session.head(server.url("/see-other"), allow_redirects=True)
+        assert resp.status_code == 200
+
+        # Not cached
+        assert len(cache) == 2
+
+        session = mugen.session(redirect_cache_size=0)
+        assert session.redirect_cache is None
+        resp = await session.get(server.url("/old"))
+        assert len(resp.history) == 2
+
+        await server.close()
+
+    loop.run_until_complete(run())
+
+
+def test_response_limits():
+    import gzip
+    from mugen.exceptions import ResponseTooLarge
+    from tests.servers import StandInHTTPServer, StandInResponse
+
+    bomb = gzip.compress(b"\0" * 1024 * 1024)
+    routes = {
+        "/small": lambda req: StandInResponse(body=b"ok"),
+        "/big": lambda req: StandInResponse(body=b"x" * 5000),
+        "/chunked": lambda req: StandInResponse(body=[b"x" * 500] * 10),
+        "/headers": lambda req: StandInResponse(
+            headers=[("X-Padding-{}".format(i), "p" * 100) for i in range(20)]
+        ),
+        "/bomb": lambda req: StandInResponse(
+            headers=[("Content-Encoding", "gzip")], body=bomb
+        ),
+        # Status line, Content-Length and the last header fit in 1024 bytes,
+        # the blank line ending the headers does not
+        "/last-header": lambda req: StandInResponse(
+            headers=[("Content-Length", "0"), ("X-Last", "l" * 977)]
+        ),
+        "/fit-header": lambda req: StandInResponse(
+            headers=[("Content-Length", "0"), ("X-Last", "l" * 976)]
+        ),
+    }
+
+    loop = asyncio.get_event_loop()
+
+    async def run():
+        server = await StandInHTTPServer(routes).start()
+        limits = mugen.Limits(
+            max_header_bytes=1024, max_body_bytes=2000, max_decompressed_bytes=4096
+        )
+        session = mugen.session(limits=limits)
+
+        for path in ("/big", "/chunked", "/headers", "/bomb", "/last-header"):
+            try:
+                await session.get(server.url(path))
+            except ResponseTooLarge:
+                pass
+            else:
+                assert False, path
+
+        resp = await session.get(server.url("/bomb"), stream=True)
+        try:
+            await resp.read()
+        except ResponseTooLarge:
+            pass
+        else:
+            assert False
+        assert resp.connection is None
+
+        # The aborted connections are closed, not recycled
+        connections = server.connections
+        resp = await session.get(server.url("/small"))
+        assert resp.content == b"ok"
+        assert server.connections == connections + 1
+        resp = await session.get(server.url("/fit-header"))
+        assert len(resp.headers["X-Last"]) == 976
+
+        # Limits of the request override the session ones
+        resp = await session.get(server.url("/big"), limits=mugen.Limits())
+        assert len(resp.content) == 5000
+        resp = await mugen.get(server.url("/bomb"))
+        assert len(resp.content) == 1024 * 1024
+        await server.close()
+
+    loop.run_until_complete(run())
+
+
+def test_spooled_response_bodies():
+    import gzip
+    import mmap
+    from tests.servers import StandInHTTPServer, StandInResponse
+
+    body = b"".join(b"line %d\n" % i for i in range(20000))
+    routes = {
+        "/small": lambda req: StandInResponse(body=b'{"ok": true}'),
+        "/large": lambda req: StandInResponse(body=body),
+        "/chunked": lambda req: StandInResponse(body=[body[:70000], body[70000:]]),
+        "/gzip": lambda req: StandInResponse(
+            headers=[("Content-Encoding", "gzip")], body=gzip.compress(body)
+        ),
+    }
+
+    loop = asyncio.get_event_loop()
+
+    async def run():
+        server = await StandInHTTPServer(routes).start()
+        session = mugen.session(spool_size=64 * 1024)
+
+        resp = await session.get(server.url("/small"))
+        assert resp.content == b'{"ok": true}'
+        assert resp.json() == {"ok": True}
+
+        for path in ("/large", "/chunked", "/gzip"):
+            resp = await session.get(server.url(path))
+            assert isinstance(resp.content, mmap.mmap), path
+            assert len(resp.content) == len(body)
+            assert resp.content[:7] == b"line 0\n"
+            assert resp.text == body.decode()
+            chunks = [chunk async for chunk in resp.iter_content(4096)]
+            assert b"".join(chunks) == body
+
+        resp = await session.get(server.url("/gzip"), stream=True)
+        content = await resp.read()
+        assert isinstance(content, mmap.mmap)
+        assert content[:] == body
+        await server.close()
+
+    loop.run_until_complete(run())
+
+
+def test_request_body_compression():
+    import gzip
+    import zlib
+    from tests.servers import StandInHTTPServer, StandInResponse
+
+    def echo(req):
+        body = req.body
+        coding = req.headers.get("content-encoding")
+        if coding == "gzip":
+            body = gzip.decompress(body)
+        elif coding == "deflate":
+            body = zlib.decompress(body)
+        framing = "chunked" if req.headers.get("transfer-encoding") else "length"
+        return StandInResponse(
+            headers=[("X-Coding", coding or "identity"), ("X-Framing", framing)],
+            body=body,
+        )
+
+    loop = asyncio.get_event_loop()
+    # Larger than the offload size, compressed in a thread
+    payload = b"".join(b"%d,row,%d\n" % (i, i * i) for i in range(200000))
+
+    async def chunks():
+        for i in range(0, len(payload), 65536):
+            yield payload[i : i + 65536]
+
+    async def run():
+        server = await StandInHTTPServer({"/echo": echo}).start()
+        session = mugen.session()
+
+        resp = await session.post(server.url("/echo"), data=payload, compress="gzip")
+        assert resp.headers["X-Coding"] == "gzip"
+        assert resp.headers["X-Framing"] == "length"
+        assert resp.content == payload
+        assert int(server.requests[-1].headers["content-length"]) < len(payload)
+
+        resp = await session.post(
+            server.url("/echo"), data={"a": "1"}, compress="deflate"
+        )
+        assert resp.headers["X-Coding"] == "deflate"
+        assert resp.content == b"a=1"
+
+        resp = await session.post(server.url("/echo"), data=chunks(), compress="gzip")
+        assert resp.headers["X-Framing"] == "chunked"
+        assert resp.content == payload
+
+        resp = await session.post(server.url("/echo"), data=iter([b"a", "b", b"c"]))
+        assert resp.headers["X-Coding"] == "identity"
+        assert resp.content == b"abc"
+
+        session = mugen.session(compress="deflate")
+        resp = await session.post(server.url("/echo"), data=b"hello")
+        assert resp.headers["X-Coding"] == "deflate"
+        assert resp.content == b"hello"
+        await server.close()
+
+    loop.run_until_complete(run())
+
+
+def test_multipart_upload(tmp_path):
+    import io
+    from email import policy
+    from email.parser import BytesParser
+    from mugen.connect import Connection
+    from mugen.exceptions import StreamConsumed
+    from mugen.multipart import MultipartEncoder
+    from tests.servers import StandInHTTPServer, StandInResponse
+
+    def parse(req):
+        head = "Content-Type: {}\r\n\r\n".format(req.headers["content-type"])
+        message = BytesParser(policy=policy.HTTP).parsebytes(head.encode() + req.body)
+        return [
+            (
+                part.get_param("name", header="content-disposition"),
+                part.get_filename(),
+                part.get_content_type(),
+                part.get_payload(decode=True),
+            )
+            for part in message.iter_parts()
+        ]
+
+    class Unseekable(io.RawIOBase):
+        def __init__(self, data):
+            self.data = io.BytesIO(data)
+
+        def readable(self):
+            return True
+
+        def read(self, size=-1):
+            return self.data.read(size)
+
+    path = tmp_path / "report.csv"
+    report = b"".join(b"%d,%d\n" % (i, i * i) for i in range(50000))
+    path.write_bytes(report)
+
+    sendfiles = []
+    sendfile = Connection.sendfile
+
+    async def counting_sendfile(self, file, offset=0, count=None):
+        sendfiles.append(count)
+        await sendfile(self, file, offset, count)
+
+    loop = asyncio.get_event_loop()
+
+    async def run():
+        server = await StandInHTTPServer(
+            {
+                "/upload": lambda req: StandInResponse(body=b"ok"),
+                "/moved": lambda req: StandInResponse(
+                    307, [("Location", "/upload")], reason="Temporary Redirect"
+                ),
+            }
+        ).start()
+        session = mugen.session()
+        Connection.sendfile = counting_sendfile
+        try:
+            with open(path, "rb") as f:
+                data = MultipartEncoder(
+                    [("kind", "daily"), ("report", f), ("note", ("n.txt", b"hi"))]
+                )
+                resp = await session.post(server.url("/upload"), data=data)
+        finally:
+            Connection.sendfile = sendfile
+        assert resp.content == b"ok"
+        assert sendfiles == [len(report)]
+
+        req = server.requests[-1]
+        assert int(req.headers["content-length"]) == len(req.body)
+        assert parse(req) == [
+            ("kind", None, "text/plain", b"daily"),
+            ("report", "report.csv", "text/csv", report),
+            ("note", "n.txt", "text/plain", b"hi"),
+        ]
+
+        # A file which can not seek has no known size, the body is chunked
+        data = MultipartEncoder({"blob": ("blob", Unseekable(b"x" * 100000))})
+        assert data.content_length is None
+        await session.post(server.url("/upload"), data=data)
+        req = server.requests[-1]
+        assert req.headers["transfer-encoding"] == "chunked"
+        assert parse(req) == [
+            ("blob", "blob", "application/octet-stream", b"x" * 100000)
+        ]
+
+        # It can not be sent again
+        try:
+            await session.post(server.url("/upload"), data=data)
+        except StreamConsumed:
+            pass
+        else:
+            assert False
+
+        # A 307 sends the files again from where they were first read
+        with open(path, "rb") as f:
+            f.seek(6)
+            data = MultipartEncoder({"report": f})
+            resp = await session.post(server.url("/moved"), data=data)
+        assert resp.status_code == 200
+        req = server.requests[-1]
+        assert int(req.headers["content-length"]) == len(req.body)
+        assert parse(req) == [("report", "report.csv", "text/csv", report[6:])]
+
+        # Event loops without sendfile, as uvloop, write the file in chunks
+        def no_sendfile(*args, **kwargs):
+            raise NotImplementedError
+
+        loop.sendfile = no_sendfile
+        try:
+            with open(path, "rb") as f:
+                data = MultipartEncoder({"report": f})
+                await session.post(server.url("/upload"), data=data)
+        finally:
+            del loop.sendfile
+        req = server.requests[-1]
+        assert parse(req) == [("report", "report.csv", "text/csv", report)]
+        await server.close()
+
+    loop.run_until_complete(run())
+
+
+def test_keep_alive_header():
+    from mugen.utils import parse_keep_alive
+    from tests.servers import StandInHTTPServer, StandInResponse
+
+    assert parse_keep_alive("timeout=5, max=100") == (5, 100)
+    assert parse_keep_alive("Timeout=5") == (5, None)
+    assert parse_keep_alive("max=x") == (None, None)
+
+    def keep_alive(value):
+        return lambda req: StandInResponse(headers=[("Keep-Alive", value)], body=b"ok")
+
+    routes = {
+        "/short": keep_alive("timeout=1"),
+        "/many": keep_alive("timeout=30, max=5"),
+        "/last": keep_alive("timeout=30, max=0"),
+    }
+
+    loop = asyncio.get_event_loop()
+
+    async def run():
+        server = await StandInHTTPServer(routes).start()
+        session = mugen.session()
+
+        await session.get(server.url("/many"))
+        await session.get(server.url("/many"))
+        assert server.connections == 1
+
+        # The server accepts no more requests on it
+        await session.get(server.url("/last"))
+        await session.get(server.url("/many"))
+        assert server.connections == 2
+
+        # Not reused when the server is about to close it
+        await session.get(server.url("/short"))
+        await session.get(server.url("/short"))
+        assert server.connections == 2
+        await asyncio.sleep(0.6)
+        await session.get(server.url("/many"))
+        assert server.connections == 3
+        await server.close()
+
+    loop.run_until_complete(run())
+
+
+def test_bench(tmp_path, capsys):
+    import json
+    from mugen.bench import run_bench, main, percentile
+    from tests.servers import ThreadedServer, StandInHTTPServer, StandInResponse
+
+    # Nearest rank
+    values = list(range(1, 11))
+    assert percentile(values, 50) == 5
+    assert percentile(values, 90) == 9
+    assert percentile(values, 99) == 10
+    assert percentile(values, 0) == 1
+    assert percentile([1, 2, 3, 4], 50) == 2
+    assert percentile([1, 2, 3, 4], 75) == 3
+    assert percentile([], 50) is None
+
+    def echo(req):
+        status = 201 if req.body == b"payload" else 200
+        return StandInResponse(status, body=req.headers.get("x-bench", "").encode())
+
+    routes = {"/": echo}
+    loop = asyncio.get_event_loop()
+
+    async def run(url):
+        result = await run_bench(url, concurrency=4, duration=0, requests=40)
+        assert result.requests == 40
+        assert result.status_codes == {200: 40}
+        assert result.reuse_ratio >= 0.8
+        assert sum(count for _, count in result.histogram()) == 40
+        assert "Requests/sec" in result.report()
+
+        # Paced at 100 req/s
+        result = await run_bench(url, concurrency=4, duration=0, requests=10, rate=100)
+        assert result.requests == 10
+        assert result.elapsed >= 0.09
+
+        result = await run_bench(
+            "http://127.0.0.1:1/", concurrency=2, duration=0, requests=4
+        )
+        assert result.requests == 0
+        assert sum(result.errors.values()) == 4
+
+    with ThreadedServer(lambda: StandInHTTPServer(routes)) as server:
+        loop.run_until_complete(run(server.url("/")))
+
+        body = tmp_path / "body"
+        body.write_bytes(b"payload")
+        capsys.readouterr()
+        code = main(
+            [
+                server.url("/"),
+                "-c",
+                "2",
+                "-d",
+                "0",
+                "-n",
+                "6",
+                "-m",
+                "POST",
+                "-H",
+                "X-Bench: 1",
+                "-D",
+                str(body),
+                "--json",
+            ]
+        )
+        assert code == 0
+        output = json.loads(capsys.readouterr().out)
+        assert output["requests"] == 6
+        assert output["status_codes"] == {"201": 6}
+        assert set(output["latency_ms"]) >= {"p50", "p99", "p99.9"}